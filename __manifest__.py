@@ -3,7 +3,7 @@
     "name": "Odoo CiviCRM Sync",
     "summary": """Odoo CiviCRM Sync""",
     "description": """Sync partner, invoice and payment records with CiviCRM.""",
-    "version": "1.0",
+    "version": "1.2",
     "author": "Compucorp Ltd.",
     "website": "https://www.compucorp.co.uk",
     "license": "LGPL-3",
@@ -15,8 +15,14 @@
         "product",
     ],
     'data': [
+        'security/ir.model.access.csv',
         'data/error_mail_template.xml',
         'data/sync_payments_to_civi.xml',
+        'data/sync_metrics.xml',
+        'data/sync_idempotency.xml',
+        'data/payment_sync_state.xml',
+        'data/sync_journal.xml',
+        'data/sync_pending.xml',
         'views/civicrm_sync_settings.xml',
         'data/product_data.xml',
     ],
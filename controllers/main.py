@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+import json
+import xmlrpc.client
+import zlib
+
+from odoo import http, _
+from odoo.exceptions import AccessError
+from odoo.http import dispatch_rpc, request, Response
+from odoo.service import security
+from odoo.service.wsgi_server import xmlrpc_handle_exception_int
+
+from ..models.sync_batch import (
+    BATCH_MODELS, iter_batch_results, iter_json_objects)
+from ..models.sync_compression import (
+    UnsupportedEncoding, compress, decompress, get_accepted_encoding,
+    iter_decompressed)
+
+METRICS_TOKEN_PARAM = 'odoo_civicrm_sync.metrics_token'
+
+# Maximal size of a decompressed inbound request body
+MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+# Model methods callable through the compressed XML-RPC endpoint
+INBOUND_METHODS = {
+    ('res.partner', 'civicrm_sync'),
+    ('account.invoice', 'civicrm_sync'),
+    ('account.invoice', 'civicrm_sync_plan'),
+}
+
+
+class CivicrmSyncController(http.Controller):
+
+    @http.route('/civicrm_sync/metrics', type='http', auth='public',
+                methods=['GET'], csrf=False)
+    def metrics(self, token=None, **kwargs):
+        """ Exposes CiviCRM sync metrics in the Prometheus text format.
+         The token of the 'odoo_civicrm_sync.metrics_token' system parameter
+         has to be passed as the 'token' query parameter. The metrics are
+         not exposed until the parameter is set.
+        """
+        expected_token = request.env['ir.config_parameter'].sudo().get_param(
+            METRICS_TOKEN_PARAM)
+        if not expected_token or not token or not hmac.compare_digest(
+                token.encode('utf-8'), expected_token.encode('utf-8')):
+            return Response('Forbidden', status=403)
+        body = request.env['civicrm.sync.metric'].sudo().render_prometheus()
+        return Response(body, headers=[
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+
+    @http.route('/civicrm_sync/xmlrpc/2/object', type='http', auth='none',
+                methods=['POST'], csrf=False)
+    def xmlrpc_object(self, **kwargs):
+        """ XML-RPC object endpoint accepting gzip or deflate compressed
+         requests (Content-Encoding header) and compressing its responses
+         if the client accepts it (Accept-Encoding header). Only the sync
+         methods of INBOUND_METHODS can be called.
+        """
+        headers = request.httprequest.headers
+        try:
+            data = decompress(request.httprequest.get_data(),
+                              headers.get('Content-Encoding'),
+                              max_size=MAX_REQUEST_SIZE)
+        except UnsupportedEncoding as error:
+            return Response(str(error), status=415)
+        except (ValueError, zlib.error) as error:
+            return Response(str(error), status=400)
+
+        try:
+            params, method = xmlrpc.client.loads(data)
+            if method not in ('execute', 'execute_kw') or len(params) < 5 or \
+                    tuple(params[3:5]) not in INBOUND_METHODS:
+                raise AccessError(_('Method not available through this '
+                                    'endpoint'))
+            result = dispatch_rpc('object', method, params)
+            body = xmlrpc.client.dumps((result,), methodresponse=1,
+                                       allow_none=False)
+        except Exception as error:
+            body = xmlrpc_handle_exception_int(error)
+
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        return self._compressed_response(body, 'text/xml')
+
+    @http.route('/civicrm_sync/<string:entity>/batch', type='http',
+                auth='none', methods=['POST'], csrf=False)
+    def sync_batch(self, entity, **kwargs):
+        """ Syncs a JSON array of contacts or contributions, each item
+         being the input parameters of civicrm_sync. The user is
+         authenticated once with HTTP basic authentication and items are
+         processed as they are decoded from the body, which can be gzip or
+         deflate compressed. The body must not be sent as application/json,
+         which Odoo reserves to JSON-RPC.
+         Returns the JSON array of the compact civicrm_sync responses, in
+         the order of the items, or on an invalid body HTTP 400 with the
+         error and the responses of the items processed before it. When the
+         company runs its maximal number of concurrent syncs, HTTP 429 is
+         returned with the responses up to the rejected item, which carries
+         'retry_after' and 'in_flight'; it and the next items have to be
+         sent again.
+        """
+        if entity not in BATCH_MODELS:
+            return Response('Unknown entity', status=404)
+        httprequest = request.httprequest
+        credentials = httprequest.authorization
+        uid = credentials and security.login(
+            request.db, credentials.username, credentials.password)
+        if not uid:
+            return Response('Unauthorized', status=401, headers=[
+                ('WWW-Authenticate', 'Basic realm="CiviCRM sync"')])
+
+        results = []
+        try:
+            chunks = iter_decompressed(
+                httprequest.stream,
+                httprequest.headers.get('Content-Encoding'),
+                max_size=MAX_REQUEST_SIZE)
+            batch = iter_batch_results(request.db, uid, entity,
+                                       iter_json_objects(chunks))
+            for result in batch:
+                results.append(result)
+                if result.get('retry_after'):
+                    # Saturated, the next items are not processed
+                    batch.close()
+                    return self._compressed_response(
+                        self._dump_results(results), 'application/json',
+                        status=429, headers=[
+                            ('Retry-After', str(result['retry_after']))])
+        except UnsupportedEncoding as error:
+            return Response(str(error), status=415)
+        except (ValueError, zlib.error) as error:
+            body = json.dumps({'error': str(error), 'results': results},
+                              separators=(',', ':'), default=str)
+            return self._compressed_response(body.encode('utf-8'),
+                                             'application/json', status=400)
+        return self._compressed_response(self._dump_results(results),
+                                         'application/json')
+
+    @staticmethod
+    def _dump_results(results):
+        return json.dumps(results, separators=(',', ':'),
+                          default=str).encode('utf-8')
+
+    @staticmethod
+    def _compressed_response(body, content_type, status=200, headers=None):
+        """ Builds a response compressed if the client accepts it
+         :param body: bytes
+         :param content_type: str
+         :param status: int HTTP status
+         :param headers: list of additional (name, value) headers
+         :return: Response
+        """
+        headers = [('Content-Type', content_type),
+                   ('Vary', 'Accept-Encoding')] + (headers or [])
+        encoding = get_accepted_encoding(
+            request.httprequest.headers.get('Accept-Encoding'))
+        if encoding:
+            body = compress(body, encoding)
+            headers.append(('Content-Encoding', encoding))
+        return Response(body, status=status, headers=headers)
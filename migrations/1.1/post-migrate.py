@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+""" Moves the payment sync fields from account_payment to the sync state
+ table and drops their columns
+"""
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Number of payment ids copied per statement
+BATCH_SIZE = 10000
+
+# Must match account_payment_sync_state.MAX_ERROR_LENGTH
+MAX_ERROR_LENGTH = 2000
+
+OLD_COLUMNS = ('x_sync_status', 'x_last_retry', 'x_retry_count',
+               'x_last_success_sync', 'x_error_log')
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    cr.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = 'account_payment' AND column_name IN %s
+    """, (OLD_COLUMNS,))
+    if {row[0] for row in cr.fetchall()} != set(OLD_COLUMNS):
+        return
+
+    cr.execute("SELECT min(id), max(id) FROM account_payment")
+    min_id, max_id = cr.fetchone()
+    copied = 0
+    for start in range(min_id or 0, (max_id or 0) + 1, BATCH_SIZE):
+        end = start + BATCH_SIZE
+        cr.execute("""
+            INSERT INTO account_payment_sync_error (digest, message)
+            SELECT DISTINCT ON (md5(x_error_log))
+                   md5(x_error_log), left(x_error_log, %s)
+            FROM account_payment
+            WHERE id >= %s AND id < %s AND x_error_log IS NOT NULL
+            ON CONFLICT (digest) DO NOTHING
+        """, (MAX_ERROR_LENGTH, start, end))
+        cr.execute("""
+            INSERT INTO account_payment_sync_state
+                (payment_id, status, last_retry, retry_count,
+                 last_success_sync, error_id)
+            SELECT p.id, p.x_sync_status, p.x_last_retry,
+                   coalesce(p.x_retry_count, 0), p.x_last_success_sync, e.id
+            FROM account_payment p
+            LEFT JOIN account_payment_sync_error e
+                ON e.digest = md5(p.x_error_log)
+            WHERE p.id >= %s AND p.id < %s
+              AND (p.x_sync_status IS NOT NULL
+                   OR p.x_last_retry IS NOT NULL
+                   OR p.x_retry_count > 0
+                   OR p.x_last_success_sync IS NOT NULL
+                   OR p.x_error_log IS NOT NULL)
+            ON CONFLICT (payment_id) DO NOTHING
+        """, (start, end))
+        copied += cr.rowcount
+
+    cr.execute("ALTER TABLE account_payment {}".format(', '.join(
+        'DROP COLUMN {}'.format(column) for column in OLD_COLUMNS)))
+    _logger.info('Moved the sync state of %s payments to '
+                 'account_payment_sync_state', copied)
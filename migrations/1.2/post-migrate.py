@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+""" Fills the CiviCRM id mapping table from the synced records """
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Must match sync_mapping.MAPPED_MODELS and sync_mapping.MAPPED_COMPANIES
+MAPPED_TABLES = (
+    ('contact', 'res_partner', '0'),
+    ('contribution', 'account_invoice', 'coalesce(company_id, 0)'),
+    ('line', 'account_invoice_line', 'coalesce(company_id, 0)'),
+    ('payment', 'account_payment',
+     '(SELECT coalesce(j.company_id, 0) FROM account_journal j '
+     'WHERE j.id = journal_id)'),
+)
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    for entity, table, company in MAPPED_TABLES:
+        cr.execute("""
+            INSERT INTO civicrm_sync_mapping
+                (entity, company_id, civicrm_id, res_id, superseded_ids)
+            SELECT %s, company_id, civicrm_id, ids[array_length(ids, 1)],
+                   NULLIF(array_to_string(
+                       ids[1:array_length(ids, 1) - 1], ','), '')
+            FROM (SELECT {company} AS company_id, x_civicrm_id AS civicrm_id,
+                         array_agg(id ORDER BY id) AS ids
+                  FROM {table}
+                  WHERE x_civicrm_id IS NOT NULL AND x_civicrm_id != 0
+                  GROUP BY 1, x_civicrm_id) AS records
+            ON CONFLICT (entity, company_id, civicrm_id) DO UPDATE SET
+                res_id = EXCLUDED.res_id,
+                superseded_ids = EXCLUDED.superseded_ids
+        """.format(company=company, table=table), (entity,))
+        _logger.info('%s CiviCRM %s ids mapped', cr.rowcount, entity)
@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
 from . import account_invoice
+from . import account_tax
 from . import civicrm_sync_settings
 from . import res_partner
+from . import payment_dispatcher
 from . import payment_sync
+from . import payment_sync_digest
+from . import account_payment_sync_state
 from . import account_payment
+from . import sync_idempotency
+from . import sync_metrics
+from . import sync_profiler
+from . import sync_admission
+from . import sync_journal
+from . import sync_pending
+from . import sync_mapping
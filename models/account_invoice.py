@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
 
+import copy
 import json
 import inspect
-import logging
 import time
 import sys
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 from datetime import datetime
 
 from odoo import api, fields, models, _
+from odoo.tools import DEFAULT_SERVER_DATE_FORMAT as DATE_FORMAT
 from odoo.tools import DEFAULT_SERVER_DATETIME_FORMAT as DATETIME_FORMAT
 
-_logger = logging.getLogger(__name__)
+from . import sync_log
+from .sync_admission import admitted
+from .sync_idempotency import idempotent
+from .sync_journal import journaled
+from .sync_lightweight import deferred_recompute, is_lightweight, lightweight
+from .sync_metrics import metrics, observe_inbound_sync
+from .sync_profiler import profiled
+
+_logger = sync_log.getLogger(__name__)
 
 UNKNOWN_ERROR = _("Unknown error when synchronize invoice data")
 EXCEPTION_ERROR_MESSAGE = _("Exception in file: '{}' line: {} type error: {} messege: {}")
@@ -26,6 +35,8 @@ ERROR_MESSAGE = {
         "Wrong CiviCRM request - missed required field: {}"),
     'lookup_id_error': _(
         "This {} doesn't exist in ODOO: {}"),
+    'not_cancellable': _(
+        "The invoice {} of this contribution can't be cancelled in state {}"),
 }
 
 LOOK_UP_MAP = {
@@ -41,10 +52,40 @@ LOOK_UP_MAP = {
                                 'x_civicrm_id'),
 }
 
+# Lookups of CiviCRM ids, resolved by the CiviCRM id mapping, by entity
+MAPPED_LOOK_UPS = {
+    'contact_civicrm_id': 'contact',
+    'invoice_civicrm_id': 'contribution',
+    'invoice_line_civicrm_id': 'line',
+}
+
 DUPLICATE_MAP = {
     'refund_date_invoice': 'date'
 }
 
+# Invoice line fields whose change alters the amounts or the accounting of
+# an invoice, so the open invoice is refunded and recreated. Changes of the
+# other fields, e.g. the line description, are written in place.
+FINANCIAL_LINE_FIELDS = ('price_unit', 'quantity', 'price_subtotal',
+                         'account_id', 'invoice_line_tax_ids', 'product_id')
+
+# Rough number of queries issued by each sync step, used by the plan mode
+# to predict the cost of a sync. Calibrate them against real syncs on the
+# target database before relying on them for capacity planning.
+PLAN_QUERY_ESTIMATE = {
+    'create': 60,
+    'open_draft': 40,
+    'refund_and_recreate': 180,
+    'update_payments': 0,
+    'update_in_place': 25,
+    'line': 15,
+    'skip_existing': 0,
+    'create_payment': 50,
+    'refund_reconcile': 120,
+    'refund_and_pay_out': 170,
+    'recreate_invoice_and_pay': 110,
+}
+
 
 class AccountInvoiceLine(models.Model):
     _inherit = "account.invoice.line"
@@ -52,6 +93,42 @@ class AccountInvoiceLine(models.Model):
     x_civicrm_id = fields.Integer(string='Civicrm Id', required=False,
                                   help='Civicrm Id')
 
+    @api.model
+    def create(self, vals):
+        """ Override method to map the CiviCRM id
+         :param vals: dictionary values
+         :return: new account.invoice.line object
+        """
+        invoice_line = super(AccountInvoiceLine, self).create(vals)
+        if vals.get('x_civicrm_id'):
+            self.env['civicrm.sync.mapping']._map('line', invoice_line)
+        return invoice_line
+
+    @api.multi
+    def write(self, vals):
+        """ Override method to keep the CiviCRM id mapping up to date
+         :param vals: dictionary values
+         :return: bool
+        """
+        if 'x_civicrm_id' not in vals:
+            return super(AccountInvoiceLine, self).write(vals)
+        mapping = self.env['civicrm.sync.mapping']
+        old_civicrm_ids = mapping._get_civicrm_ids('line', self)
+        res = super(AccountInvoiceLine, self).write(vals)
+        mapping._update('line', self, old_civicrm_ids)
+        return res
+
+    @api.multi
+    def unlink(self):
+        """ Override method to unmap the CiviCRM ids
+         :return: bool
+        """
+        mapping = self.env['civicrm.sync.mapping']
+        old_civicrm_ids = mapping._get_civicrm_ids('line', self)
+        res = super(AccountInvoiceLine, self).unlink()
+        mapping._remap('line', set(old_civicrm_ids.values()))
+        return res
+
 
 class AccountInvoice(models.Model):
     _inherit = "account.invoice"
@@ -60,20 +137,104 @@ class AccountInvoice(models.Model):
                                   help='Civicrm Id')
 
     @api.model
+    def create(self, vals):
+        """ Override method to map the CiviCRM id
+         :param vals: dictionary values
+         :return: new account.invoice object
+        """
+        invoice = super(AccountInvoice, self).create(vals)
+        if vals.get('x_civicrm_id'):
+            self.env['civicrm.sync.mapping']._map('contribution', invoice)
+        return invoice
+
+    @api.multi
+    def write(self, vals):
+        """ Override method to keep the CiviCRM id mapping up to date
+         :param vals: dictionary values
+         :return: bool
+        """
+        if 'x_civicrm_id' not in vals:
+            return super(AccountInvoice, self).write(vals)
+        mapping = self.env['civicrm.sync.mapping']
+        old_civicrm_ids = mapping._get_civicrm_ids('contribution', self)
+        res = super(AccountInvoice, self).write(vals)
+        mapping._update('contribution', self, old_civicrm_ids)
+        return res
+
+    @api.multi
+    def unlink(self):
+        """ Override method to unmap the CiviCRM ids
+         :return: bool
+        """
+        mapping = self.env['civicrm.sync.mapping']
+        old_civicrm_ids = mapping._get_civicrm_ids('contribution', self)
+        # Lines are deleted with their invoice without their unlink
+        old_line_civicrm_ids = mapping._get_civicrm_ids(
+            'line', self.mapped('invoice_line_ids'))
+        res = super(AccountInvoice, self).unlink()
+        mapping._remap('contribution', set(old_civicrm_ids.values()))
+        mapping._remap('line', set(old_line_civicrm_ids.values()))
+        return res
+
+    @api.multi
+    def get_taxes_values(self):
+        """ Override method to reuse the tax computations of identical lines
+         of synced invoices. The memo is disabled by the context key
+         'civicrm_sync_tax_memo' set to False.
+         :return: dictionary of tax line values by grouping key
+        """
+        if len(self) != 1 or not self.x_civicrm_id or \
+                not self.env.context.get('civicrm_sync_tax_memo', True):
+            return super(AccountInvoice, self).get_taxes_values()
+        tax_grouped = {}
+        for line in self.invoice_line_ids:
+            price_unit = line.price_unit * (
+                1 - (line.discount or 0.0) / 100.0)
+            taxes = line.invoice_line_tax_ids.compute_all_memoized(
+                price_unit, self.currency_id, line.quantity,
+                partner=self.partner_id)['taxes']
+            for tax in taxes:
+                val = self._prepare_tax_line_vals(line, tax)
+                key = self.env['account.tax'].browse(
+                    tax['id']).get_grouping_key(val)
+                if key not in tax_grouped:
+                    tax_grouped[key] = val
+                else:
+                    tax_grouped[key]['amount'] += val['amount']
+                    tax_grouped[key]['base'] += val['base']
+        return tax_grouped
+
+    @api.model
+    @admitted('contribution')
+    @journaled('contribution')
+    @profiled('contribution')
+    @observe_inbound_sync('contribution')
+    @idempotent('contribution', 'modified_date',
+                internal_fields=('modified_date',))
+    @sync_log.correlated('contribution')
+    @lightweight
     def civicrm_sync(self, input_params):
         """Synchronizes CiviCRM Contributions to Odoo invoice.
          Creates new invoice if not exists and updates it if it is not
          present in Odoo. Returns back to CiviCRM assigned invoice_id and
          update_date and data processing status.
+         A retried call, identified by its 'idempotency_key' or by its
+         x_civicrm_id and 'modified_date' timestamp, is answered with the
+         response of the first successful call.
+         A contribution whose contact is not synced yet is parked and
+         answered with 'deferred' 1, it is synced once the contact is.
         """
         try:
-            _logger.debug('Start CiviCRM contribution to invoice syncing')
+            _logger.debug('contribution sync started')
 
             self.error_log = []
 
             # Build response dictionary
             self.response_data = {'is_error': 0}
+            received_params = copy.deepcopy(input_params)
             if not self._validate_civicrm_sync_input_params(input_params):
+                if self._is_missing_contact_only():
+                    return self._defer_contribution(received_params)
                 return self._get_civicrm_sync_response()
             x_civicrm_invice_id = self.vals.get('x_civicrm_id')
 
@@ -81,27 +242,28 @@ class AccountInvoice(models.Model):
             self.response_data.update(contribution_id=x_civicrm_invice_id)
 
             # Check if CiviCRM contribution_id exists in ODOO
-            invoice = self.with_context(active_test=False).search(
-                [('x_civicrm_id', '=', x_civicrm_invice_id)], order='id desc',
-                limit=1)
-            _logger.debug('last invoice({}) with civicrm_id({})'.format(invoice, x_civicrm_invice_id))
+            invoice = self._get_last_invoice(x_civicrm_invice_id)
 
             if invoice:
                 self.response_data.update(invoice_number=invoice.number)
 
-            invoice_state = invoice.state
+            action = self._get_sync_action(invoice)
 
             # Create and post new invoice if not exist
-            if not invoice:
+            if action == 'create':
                 invoice = self.save_new_invoice()
                 self._invoice_open(invoice)
 
             # Start line items handling if invoice not posted
-            elif invoice_state in ('draft',):
+            elif action == 'open_draft':
                 self._invoice_open(invoice)
 
-            # Start line items match
-            elif not self.match_lines(invoice):
+            # Only descriptive fields of the line items changed
+            elif action == 'update_in_place':
+                self._update_lines_in_place(invoice)
+
+            # Line items do not match
+            elif action == 'refund_and_recreate':
                 # If no, unreconcile and cancel the invoice.
                 # Create a new one and do Line Items Handling.
                 # Posted invoice
@@ -114,14 +276,305 @@ class AccountInvoice(models.Model):
                 self._invoice_open(invoice)
                 invoice.re_reconcile_payment(credit_aml_ids=credit_aml_ids)
 
-            self.status_and_payment_handling(invoice)
+            payments = self.status_and_payment_handling(invoice)
+
+            if is_lightweight(self.env):
+                self._post_sync_summary(invoice, action, payments)
+
+            # A contribution parked before and failed is now synced
+            if not self.error_log and \
+                    not self.env.context.get('civicrm_sync_replay'):
+                self.env['civicrm.sync.pending']._forget(x_civicrm_invice_id)
 
         except Exception as error:
             self.exception_handler(error)
 
+        return self._get_civicrm_sync_response()
+
+    @api.model
+    @admitted('contribution')
+    @profiled('bulk_cancel')
+    @observe_inbound_sync('bulk_cancel')
+    @sync_log.correlated('bulk_cancel')
+    @lightweight
+    def civicrm_bulk_cancel(self, contribution_ids, description=None,
+                            date=None):
+        """Cancels CiviCRM contributions at once, e.g. when an event is
+         cancelled. The payment moves of the current invoices are reversed,
+         the invoices are refunded and reconciled with their credit notes,
+         with one set of operations per journal, each journal in its own
+         savepoint. A contribution whose current invoice is already a credit
+         note is reported as cancelled.
+         :param contribution_ids: list of CiviCRM contribution ids
+         :param description: str reason of the credit notes
+         :param date: int timestamp of the credit notes, today if not set
+         :return: data in dictionary format: {
+                                'is_error': int, 1 if a contribution failed
+                                'contributions': list of dict {
+                                    'contribution_id': int,
+                                    'is_error': int,
+                                    'error_log': list, when is_error = 1
+                                    'invoice_number': str,
+                                    'creditnote_number': str,
+                                    }
+                                'timestamp': int, respond timestamp
+                                }
+        """
+        contribution_ids = list(contribution_ids or [])
+        results = {contribution_id: {'contribution_id': contribution_id,
+                                     'is_error': 0}
+                   for contribution_id in contribution_ids}
+        res_ids = self.env['civicrm.sync.mapping']._get_res_ids(
+            'contribution', contribution_ids)
+        invoices = self.browse(sorted(set(res_ids.values())))
+        for contribution_id in contribution_ids:
+            if contribution_id not in res_ids:
+                results[contribution_id].update(is_error=1, error_log=[
+                    ERROR_MESSAGE['lookup_id_error'].format(
+                        'contribution_id', contribution_id)])
+
+        to_cancel = self.browse()
+        for invoice in invoices:
+            result = results[invoice.x_civicrm_id]
+            if invoice.type == 'out_refund' and \
+                    invoice.state in ('open', 'paid'):
+                result.update(creditnote_number=invoice.number)
+            elif invoice.type == 'out_invoice' and \
+                    invoice.state in ('open', 'paid'):
+                to_cancel |= invoice
+            else:
+                result.update(is_error=1, error_log=[
+                    ERROR_MESSAGE['not_cancellable'].format(
+                        invoice.number or invoice.id, invoice.state)])
+
+        date = datetime.fromtimestamp(date).strftime(DATE_FORMAT) \
+            if date else fields.Date.today()
+        description = description or _('Cancelled in CiviCRM')
+        journal_invoices = defaultdict(lambda: self.browse())
+        for invoice in to_cancel:
+            journal_invoices[invoice.journal_id] |= invoice
+        for journal, invoices in journal_invoices.items():
+            try:
+                with self.env.cr.savepoint():
+                    refunds = invoices._cancel_with_refunds(
+                        journal, description, date)
+            except Exception as error:
+                _logger.error('bulk cancel failed', journal=journal.id,
+                              invoices=invoices.ids, error=error)
+                for invoice in invoices:
+                    results[invoice.x_civicrm_id].update(
+                        is_error=1, error_log=[str(error)])
+                self.invalidate_cache()
+                continue
+            for refund in refunds:
+                results[refund.x_civicrm_id].update(
+                    invoice_number=refund.refund_invoice_id.number,
+                    creditnote_number=refund.number)
+
+        _logger.info('contributions cancelled', count=len(to_cancel))
+        contributions = [results[contribution_id] for contribution_id
+                         in dict.fromkeys(contribution_ids)]
+        return {
+            'is_error': int(any(result['is_error']
+                                for result in contributions)),
+            'contributions': contributions,
+            'timestamp': int(time.time()),
+        }
+
+    @api.multi
+    def _cancel_with_refunds(self, journal, description, date):
+        """ Reverses the payments of open or paid invoices of one journal,
+         refunds them and reconciles them with their credit notes
+         :param journal: account.journal object of the invoices
+         :param description: str reason of the credit notes
+         :param date: str credit notes date in DATE_FORMAT
+         :return: account.invoice objects, the opened credit notes
+        """
+        self._payments_reverse_move()
+        refunds = self.with_context(civicrm_sync_refund=True).refund(
+            date_invoice=date, date=date, description=description,
+            journal_id=journal.id)
+        refunds.action_invoice_open()
+        (self | refunds)._reconcile_receivables()
+        return refunds
+
+    @api.multi
+    def _reconcile_receivables(self):
+        """ Reconciles the open receivable and payable lines of the
+         invoices together, one reconciliation by account and partner
+        """
+        lines = self.mapped('move_id.line_ids').filtered(
+            lambda line: not line.reconciled and
+            line.account_id.internal_type in ('receivable', 'payable'))
+        groups = defaultdict(lambda: self.env['account.move.line'])
+        for line in lines:
+            groups[(line.account_id.id, line.partner_id.id)] |= line
+        for group in groups.values():
+            if len(group) > 1:
+                group.reconcile()
+
+    @api.model
+    def _prepare_refund(self, invoice, date_invoice=None, date=None,
+                        description=None, journal_id=None):
+        """ Override method to keep the CiviCRM id on the credit notes of
+         the sync, so they don't need a further write
+        """
+        values = super(AccountInvoice, self)._prepare_refund(
+            invoice, date_invoice=date_invoice, date=date,
+            description=description, journal_id=journal_id)
+        if self.env.context.get('civicrm_sync_refund'):
+            values['x_civicrm_id'] = invoice.x_civicrm_id
+        return values
 
+    @api.model
+    def civicrm_sync_plan(self, input_params):
+        """Plans the synchronization of CiviCRM Contributions without
+         changing anything. Runs the input validation and lookups, and
+         returns for each contribution the sync action, the payment actions
+         and the predicted query cost. Everything runs in a savepoint which
+         is rolled back.
+         :param input_params: dict of contribution data as for civicrm_sync,
+                              or list of them
+         :return: dict or list of dict, data in dictionary format: {
+                                'is_error': int, value from list [0, 1]
+                                'error_log': list, not empty when is_error = 1
+                                'contribution_id': int, CiviCRM contribution_id
+                                'invoice_number': str, last invoice number
+                                'action': str, one of 'create', 'open_draft',
+                                    'refund_and_recreate', 'update_in_place',
+                                    'update_payments'
+                                'payments': list of dict with x_civicrm_id
+                                    and action of each payment
+                                'query_count': int, queries used by the plan
+                                'estimated_query_count': int, predicted
+                                    queries of the sync
+                                }
+        """
+        contributions = input_params if isinstance(input_params, list) \
+            else [input_params]
+        cr = self.env.cr
+        plans = []
+        cr.execute('SAVEPOINT civicrm_sync_plan')
+        try:
+            for contribution in contributions:
+                plans.append(self._plan_contribution(
+                    copy.deepcopy(contribution)))
+        finally:
+            cr.execute('ROLLBACK TO SAVEPOINT civicrm_sync_plan')
+            cr.execute('RELEASE SAVEPOINT civicrm_sync_plan')
+            self.invalidate_cache()
+        return plans if isinstance(input_params, list) else plans[0]
+
+    def _plan_contribution(self, input_params):
+        """ Classifies contribution into the civicrm_sync branches
+         :param input_params: dictionary of input parameters
+         :return: plan in dictionary format
+        """
+        self.error_log = []
+        self.response_data = {'is_error': 0}
+        queries_before = self.env.cr.sql_log_count
+        try:
+            with self.env.cr.savepoint():
+                if self._validate_civicrm_sync_input_params(input_params):
+                    x_civicrm_invice_id = self.vals.get('x_civicrm_id')
+                    invoice = self._get_last_invoice(x_civicrm_invice_id)
+                    action = self._get_sync_action(invoice)
+                    payments = self._plan_payment_actions(invoice, action)
+                    self.response_data.update(
+                        contribution_id=x_civicrm_invice_id,
+                        invoice_number=invoice.number or False,
+                        action=action,
+                        payments=payments,
+                        estimated_query_count=self._estimate_query_count(
+                            action, payments))
+        except Exception as error:
+            self.exception_handler(error)
+        self.response_data.update(
+            query_count=self.env.cr.sql_log_count - queries_before)
         return self._get_civicrm_sync_response()
 
+    def _get_last_invoice(self, x_civicrm_id):
+        """ Gets the last invoice synced from the CiviCRM contribution
+         :param x_civicrm_id: CiviCRM contribution id
+         :return: invoice object
+        """
+        invoice = self.env['civicrm.sync.mapping']._get_record(
+            'contribution', x_civicrm_id)
+        sync_log.bind(invoice=invoice.id)
+        _logger.debug('last invoice found', invoice=invoice)
+        return invoice
+
+    def _get_sync_action(self, invoice):
+        """ Gets the civicrm_sync branch for the last synced invoice
+         :param invoice: invoice object
+         :return: str, one of 'create', 'open_draft', 'refund_and_recreate',
+                  'update_in_place' or 'update_payments'
+        """
+        if not invoice:
+            return 'create'
+        if invoice.state in ('draft',):
+            return 'open_draft'
+        line_changes = self._get_line_changes(invoice)
+        if line_changes is None:
+            return 'refund_and_recreate'
+        if line_changes:
+            return 'update_in_place'
+        return 'update_payments'
+
+    def _plan_payment_actions(self, invoice, action):
+        """ Classifies payments into the status_and_payment_handling
+         branches. The invoice state is assumed to stay unchanged by the
+         payments preceding a refund.
+         :param invoice: last synced invoice object
+         :param action: sync action of the invoice
+         :return: list of dict with x_civicrm_id and action of each payment
+        """
+        payments_data = self.vals.get('payments') or []
+        x_civicrm_payment_ids = [payment_data.get('x_civicrm_id') for
+                                 payment_data in payments_data]
+        existing_payment_ids = set(self.env[
+            'civicrm.sync.mapping']._get_res_ids('payment',
+                                                 x_civicrm_payment_ids))
+
+        if action in ('update_payments', 'update_in_place'):
+            invoice_type, invoice_state = invoice.type, invoice.state
+        else:
+            invoice_type, invoice_state = 'out_invoice', 'open'
+
+        plan = []
+        for payment_data in payments_data:
+            if payment_data.get('x_civicrm_id') in existing_payment_ids:
+                payment_action = 'skip_existing'
+            elif not payment_data.get('status'):
+                if invoice_state != 'paid':
+                    payment_action = 'refund_reconcile'
+                else:
+                    payment_action = 'refund_and_pay_out'
+                    invoice_type = 'out_refund'
+            elif 'refund' in invoice_type:
+                payment_action = 'recreate_invoice_and_pay'
+                invoice_type = 'out_invoice'
+            else:
+                payment_action = 'create_payment'
+            plan.append({'x_civicrm_id': payment_data.get('x_civicrm_id') or
+                                         False,
+                         'action': payment_action})
+        return plan
+
+    def _estimate_query_count(self, action, payments):
+        """ Predicts number of queries of the sync from PLAN_QUERY_ESTIMATE
+         :param action: sync action of the invoice
+         :param payments: list of planned payment actions
+         :return: int
+        """
+        count = PLAN_QUERY_ESTIMATE[action]
+        if action not in ('update_payments', 'update_in_place'):
+            count += PLAN_QUERY_ESTIMATE['line'] * len(
+                self.vals.get('line_items') or [])
+        for payment in payments:
+            count += PLAN_QUERY_ESTIMATE[payment['action']]
+        return count
+
     def _validate_civicrm_sync_input_params(self, input_params):
         """ Validates input parameters structure and data type
          :param input_params: dictionary of input parameters
@@ -129,6 +582,7 @@ class AccountInvoice(models.Model):
         """
         _logger.debug('validate input params')
         self.vals = input_params
+        self.missing_contact_civicrm_id = None
         ParamType = namedtuple('ParamType', ['type', 'required',
                                              'convert_method', 'default', 'weight'])
 
@@ -243,6 +697,8 @@ class AccountInvoice(models.Model):
         model, field, res = LOOK_UP_MAP.get(key)
         ids = self._lookup_id(key, value, model, field)
         if not ids:
+            if key == 'contact_civicrm_id':
+                self.missing_contact_civicrm_id = value
             return
         if isinstance(value, list):
             vals[res] = ids
@@ -281,8 +737,14 @@ class AccountInvoice(models.Model):
         """
         if not isinstance(value, list):
             value = [value]
-        ids = self.env[model].search(
-            [(field, 'in', value)]).ids
+        if key in MAPPED_LOOK_UPS:
+            res_ids = self.env['civicrm.sync.mapping']._get_res_ids(
+                MAPPED_LOOK_UPS[key], value)
+            ids = [res_ids[civicrm_id] for civicrm_id in value
+                   if civicrm_id in res_ids]
+        else:
+            ids = self.env[model].search(
+                [(field, 'in', value)]).ids
         if not ids:
             self.error_log.append(
                 ERROR_MESSAGE.get('lookup_id_error', UNKNOWN_ERROR).format(
@@ -300,7 +762,8 @@ class AccountInvoice(models.Model):
         vals = kwargs.get('vals')
         try:
             date_time = datetime.fromtimestamp(timestamp)
-            _logger.debug('date_time value is {} type is {}'.format(date_time, type(date_time)))
+            _logger.debug('timestamp converted', sample=100, key=key,
+                          date_time=date_time)
             vals[key] = date_time.strftime(DATETIME_FORMAT)
         except Exception as error:
             self.exception_handler(error)
@@ -310,7 +773,8 @@ class AccountInvoice(models.Model):
          :return: invoice object
         """
         invoice = self.create(self.vals)
-        _logger.debug('create new invoice({})'.format(invoice))
+        sync_log.bind(invoice=invoice.id)
+        _logger.debug('new invoice created', invoice=invoice)
         return invoice
 
     def create_line(self, line, invoice_id):
@@ -326,7 +790,7 @@ class AccountInvoice(models.Model):
         """ Handles line items, computes taxes and open invoice
          :param invoice: invoice object
         """
-        _logger.debug('start open new invoice({})'.format(invoice))
+        _logger.debug('open invoice', invoice=invoice)
         self.line_items_handling(invoice)
         invoice.compute_taxes()
         invoice.action_invoice_open()
@@ -336,27 +800,29 @@ class AccountInvoice(models.Model):
         """ Creates/updates or deletes invoice line
          :param invoice: invoice object
         """
-        _logger.debug('start line items handling')
+        _logger.debug('line items handling started')
         lines = self.vals.get('line_items')
         line_civicrm_id = set(line.get('x_civicrm_id') for line in lines)
-        for line in lines:
-            x_civicrm_id = line.get('x_civicrm_id')
-            invoice_line = invoice.invoice_line_ids.filtered(
-                lambda invoice_line: invoice_line.x_civicrm_id == x_civicrm_id)
-
-            if not invoice_line:
-                self.create_line(line, invoice.id)
-                continue
+        with deferred_recompute(invoice):
+            for line in lines:
+                x_civicrm_id = line.get('x_civicrm_id')
+                invoice_line = invoice.invoice_line_ids.filtered(
+                    lambda invoice_line:
+                    invoice_line.x_civicrm_id == x_civicrm_id)
+
+                if not invoice_line:
+                    self.create_line(line, invoice.id)
+                    continue
 
-            if not self.match_line(line, invoice_line):
-                self.update_line(line, invoice_line, invoice.id)
+                if not self.match_line(line, invoice_line):
+                    self.update_line(line, invoice_line, invoice.id)
 
-        line_to_delete = invoice.invoice_line_ids.filtered(
-            lambda invoice_line: invoice_line.x_civicrm_id not in
-                                 line_civicrm_id)
+            line_to_delete = invoice.invoice_line_ids.filtered(
+                lambda invoice_line: invoice_line.x_civicrm_id not in
+                                     line_civicrm_id)
 
-        for line in line_to_delete:
-            line.unlink()
+            for line in line_to_delete:
+                line.unlink()
 
     def match_line(self, match_line, line):
         """ Compares invoice line items
@@ -387,19 +853,52 @@ class AccountInvoice(models.Model):
          :param invoice:  invoice object
          :return: True if line is the same, otherwise False
         """
-        _logger.debug('start match lines')
-        new_lines = self.vals.get('line_items')
+        return self._get_line_changes(invoice) == {}
+
+    def _get_line_changes(self, invoice):
+        """ Classifies the differences between the invoice lines and the
+         CiviCRM line items
+         :param invoice: invoice object
+         :return: None if lines were added or removed or a field of
+                  FINANCIAL_LINE_FIELDS changed, else dict
+                  {invoice line id: values of the changed fields}
+        """
+        _logger.debug('match lines started')
+        new_lines = self.vals.get('line_items') or []
         if len(invoice.invoice_line_ids) != len(new_lines):
-            return False
+            return None
 
+        changes = {}
         for line in invoice.invoice_line_ids:
             match_line = self._get_match_invoice_line(new_lines,
                                                       line.x_civicrm_id)
             if match_line is None:
-                return False
-            if not self.match_line(match_line, line):
-                return False
-        return True
+                return None
+            line_vals = {}
+            for name, value in match_line.items():
+                first = self._get_value(line[name], line._fields[name])
+                second = self._get_value(value, name)
+                if first == second:
+                    continue
+                if name in FINANCIAL_LINE_FIELDS:
+                    return None
+                line_vals[name] = value
+            if line_vals:
+                changes[line.id] = line_vals
+        return changes
+
+    def _update_lines_in_place(self, invoice):
+        """ Writes descriptive line changes to the open invoice with one
+         write of its lines
+         :param invoice: invoice object
+        """
+        changes = self._get_line_changes(invoice)
+        if not changes:
+            return
+        _logger.debug('update lines in place', lines=sorted(changes))
+        invoice.write({'invoice_line_ids': [
+            (1, line_id, line_vals) for line_id, line_vals
+            in sorted(changes.items())]})
 
     def _get_match_invoice_line(self, lines, x_civicrm_id):
         """ Returns line with same x_civicrm_id
@@ -451,32 +950,35 @@ class AccountInvoice(models.Model):
                 for content in outstanding['content']:
                     if content.get('journal_name') == invoice_number:
                         credit_aml_ids.append(content['id'])
-        _logger.debug('assign credits({})'.format(credit_aml_ids))
+        _logger.debug('assign credits', credit_aml_ids=credit_aml_ids)
         for credit_aml_id in credit_aml_ids:
             self.assign_outstanding_credit(credit_aml_id)
 
     def status_and_payment_handling(self, invoice):
         """ Checks payment exists in odoo, refunds invoice
          :param invoice: invoice object
+         :return: account.payment objects created
         """
-        account_payment = self.env['account.payment']
-
         x_civicrm_payment_ids = [payment_data.get('x_civicrm_id') for
                                  payment_data in
                                  self.vals.get('payments')]
-        payments = account_payment.with_context(active_test=False).search(
-            [('x_civicrm_id', 'in', x_civicrm_payment_ids)])
+        existing_payment_ids = set(self.env[
+            'civicrm.sync.mapping']._get_res_ids('payment',
+                                                 x_civicrm_payment_ids))
 
+        payments = self.env['account.payment']
+        payments_vals = []
         for payment_data in self.vals.get('payments'):
-            _logger.debug('handling payment({})'.format(payment_data))
-            x_civicrm_payment_id = payment_data.get('x_civicrm_id')
-            payment = payments.filtered(
-                lambda payment: payment.x_civicrm_id == x_civicrm_payment_id)
-
-            if payment:
+            _logger.debug('handling payment', sample=10,
+                          payment_data=payment_data)
+            if payment_data.get('x_civicrm_id') in existing_payment_ids:
                 continue
 
             elif not payment_data.get('status'):
+                # The refund branch depends on the invoice state, so the
+                # payments queued so far have to be posted first
+                payments |= self._create_payments(payments_vals)
+                payments_vals = []
                 refund_invoice = self._refund_invoice(invoice)
                 if invoice.state != 'paid':
                     refund_invoice.re_reconcile_payment(invoice_number=invoice.number)
@@ -489,11 +991,15 @@ class AccountInvoice(models.Model):
                 payment_data.update(amount=amount)
 
             elif 'refund' in invoice.type:
+                payments |= self._create_payments(payments_vals)
+                payments_vals = []
                 invoice = self.save_new_invoice()
                 self._invoice_open(invoice)
 
-            payment = self._create_payment(payment_data, invoice)
-            self._validate_invoice_payment(payment, invoice)
+            payments_vals.append(
+                self._prepare_payment_vals(payment_data, invoice))
+
+        return payments | self._create_payments(payments_vals)
 
     def _refund_invoice(self, invoice):
         """ Creates account.invoice.refund object and
@@ -501,51 +1007,69 @@ class AccountInvoice(models.Model):
          :param invoice: invoice object
         """
         refund = self.save_refund()
-        _logger.debug('create refund_invoice({})'.format(refund))
-        view = refund.with_context(active_ids=invoice.ids).compute_refund(mode='refund')
+        _logger.debug('refund created', refund=refund)
+        view = refund.with_context(
+            active_ids=invoice.ids,
+            civicrm_sync_refund=True).compute_refund(mode='refund')
         domains = view.get('domain')
         for domain in domains:
             if domain[0] == 'id':
                 refund_invoice = invoice.browse(domain[2])
 
-        refund_invoice.write({'x_civicrm_id': invoice.x_civicrm_id})
         refund_invoice.action_invoice_open()
-        _logger.debug('open refund_invoice({})'.format(refund))
+        sync_log.bind(refund_invoice=refund_invoice.id)
+        _logger.debug('refund invoice opened', refund_invoice=refund_invoice)
         self.response_data.update(creditnote_number=refund_invoice.number)
         return refund_invoice
 
     @api.multi
     def _payments_reverse_move(self):
         """ Gets payments move for invoices and make a reverse payment for
-         total amount received from the customer
+         total amount received from the customer. A move paying several of
+         the invoices is reversed once.
         """
-        for invoice in self:
-            payments_vals = invoice._get_payments_vals()
-            move_ids = [payment.get('move_id') for payment in payments_vals]
-            payment_moves = self.env['account.move'].browse(move_ids)
+        payment_moves = self.mapped('payment_move_line_ids.move_id')
+        if payment_moves:
             payment_moves.reverse_moves()
 
-    def _create_payment(self, payment_data, invoice):
-        """ Updates payment_data, creates payment
+    def _prepare_payment_vals(self, payment_data, invoice):
+        """ Updates payment_data with the invoice relation and the sync
+         status, so the payment can be created without further writes
          :param payment_data: dictionary payment from input params
          :param invoice: invoice object
+         :return: dictionary payment values
         """
         account_payment = self.env['account.payment']
         payment_data.update(invoice_ids=[(6, 0, invoice.ids)])
         payment_data.update(partner_id=invoice.partner_id.id)
         payment_data.update(account_id=invoice.account_id.id)
-        payment = account_payment.create(payment_data)
-        _logger.debug('create payment({})'.format(payment))
-        return payment
-
-    def _validate_invoice_payment(self, payment, invoice):
-        """ Creates the journal items for the payment and updates the
-         payment's state to 'posted'.
-         :param payment: payment object
+        payment_data.update(x_sync_status=account_payment._get_sync_status(
+            invoice, payment_data.get('x_civicrm_id')))
+        return payment_data
+
+    def _create_payments(self, payments_vals):
+        """ Creates payments and posts them together
+         :param payments_vals: list of dictionary payment values
+         :return: account.payment objects
+        """
+        account_payment = self.env['account.payment']
+        payments = account_payment.browse()
+        with deferred_recompute(account_payment):
+            for payment_vals in payments_vals:
+                payments |= account_payment.create(payment_vals)
+        sync_log.bind(payments=payments.ids)
+        _logger.debug('payments created', payments=payments)
+        if payments:
+            self._validate_invoice_payment(payments)
+        return payments
+
+    def _validate_invoice_payment(self, payments):
+        """ Creates the journal items for the payments and updates the
+         payments' state to 'posted'.
+         :param payments: payment objects
         """
-        _logger.debug('start validate payment')
-        payment.invoice_ids = invoice.ids
-        payment.action_validate_invoice_payment()
+        _logger.debug('validate payments', payments=payments)
+        payments.action_validate_invoice_payment()
 
     def save_refund(self):
         """ Creates refund objects """
@@ -560,6 +1084,48 @@ class AccountInvoice(models.Model):
             refund = account_invoice_refund.create(refund_data)
         return refund
 
+    def _is_missing_contact_only(self):
+        """ Checks if the contribution failed validation only because its
+         contact is not synced yet
+         :return: bool
+        """
+        return bool(self.missing_contact_civicrm_id) and \
+            len(self.error_log) == 1
+
+    def _defer_contribution(self, input_params):
+        """ Parks the contribution until its contact is synced
+         :param input_params: dictionary input parameters as received
+         :return: response in dictionary format, with 'deferred' 1
+        """
+        self.env['civicrm.sync.pending']._park(
+            self.missing_contact_civicrm_id, input_params)
+        metrics.inc('civicrm_sync_inbound_deferred_total')
+        self.error_log = []
+        self.response_data.update(
+            deferred=1, contribution_id=input_params.get('x_civicrm_id'),
+            contact_civicrm_id=self.missing_contact_civicrm_id)
+        return self._get_civicrm_sync_response()
+
+    def _post_sync_summary(self, invoice, action, payments):
+        """ Posts the single chatter message of a lightweight sync, in place
+         of the tracking messages of each write. Nothing is posted when the
+         sync changed nothing.
+         :param invoice: invoice object
+         :param action: sync action of the invoice
+         :param payments: account.payment objects created by the sync
+        """
+        changed = action != 'update_payments' or payments or \
+            self.response_data.get('creditnote_number')
+        if not changed or not invoice.exists():
+            return
+        invoice.message_post(body=_(
+            'Synced from CiviCRM contribution {}: {}, {} payment(s) received, '
+            'invoice {}{}').format(
+            invoice.x_civicrm_id, action.replace('_', ' '), len(payments),
+            self.response_data.get('invoice_number') or '-',
+            ', credit note {}'.format(self.response_data['creditnote_number'])
+            if self.response_data.get('creditnote_number') else ''))
+
     def _get_civicrm_sync_response(self):
         """ Checks errors and return dictionary response
          :return: response in dictionary format
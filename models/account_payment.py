@@ -4,8 +4,28 @@ import logging
 
 from odoo import api, fields, models
 
+from .account_payment_sync_state import SYNC_STATUSES
+from .payment_dispatcher import dispatcher
+
 _logger = logging.getLogger(__name__)
 
+# Sync fields of the payment and their column in the sync state table
+SYNC_STATE_COLUMNS = {
+    'x_sync_status': 'status',
+    'x_last_retry': 'last_retry',
+    'x_retry_count': 'retry_count',
+    'x_last_success_sync': 'last_success_sync',
+    'x_error_log': 'error_id',
+}
+
+SYNC_STATE_COLUMN_TYPES = {
+    'status': 'varchar',
+    'last_retry': 'timestamp',
+    'retry_count': 'int4',
+    'last_success_sync': 'timestamp',
+    'error_id': 'int4',
+}
+
 
 class account_payment(models.Model):
     _inherit = "account.payment"
@@ -13,21 +33,26 @@ class account_payment(models.Model):
     x_civicrm_id = fields.Integer(string='Civicrm Id', required=False,
                                   help='Civicrm Id')
 
-    x_sync_status = fields.Selection([
-        ('awaiting', 'Awaiting Sync'),
-        ('synced', 'Synced'),
-        ('failed', 'Sync failed'),
-        (None, 'None'),
-    ], default=None, string='Sync Status',
+    x_sync_status = fields.Selection(
+        SYNC_STATUSES + [(None, 'None')], string='Sync Status',
+        compute='_compute_sync_state', inverse='_inverse_sync_state',
+        search='_search_x_sync_status',
         help='When a payment is registered to an invoice whose x_civicrm_id '
              'is not empty, this field should be set to "Awaiting sync".')
 
-    x_last_retry = fields.Datetime(string='Last Retry', help='Last Retry')
-    x_retry_count = fields.Integer(string='Retry Count', default=0,
-                                   help='Retry Count')
+    x_last_retry = fields.Datetime(string='Last Retry', help='Last Retry',
+                                   compute='_compute_sync_state',
+                                   inverse='_inverse_sync_state')
+    x_retry_count = fields.Integer(string='Retry Count', help='Retry Count',
+                                   compute='_compute_sync_state',
+                                   inverse='_inverse_sync_state')
     x_last_success_sync = fields.Datetime(string='Last Successful Sync Date',
-                                         default=0, help='Last Successful Sync Date')
-    x_error_log = fields.Text(string='Error Log', help='Error Log')
+                                          help='Last Successful Sync Date',
+                                          compute='_compute_sync_state',
+                                          inverse='_inverse_sync_state')
+    x_error_log = fields.Text(string='Error Log', help='Error Log',
+                              compute='_compute_sync_state',
+                              inverse='_inverse_sync_state')
 
     @api.model
     def create(self, vals):
@@ -35,11 +60,161 @@ class account_payment(models.Model):
          :param vals: dictionary values
          :return: new account_payment object
         """
+        vals = dict(vals)
+        sync_vals = self._pop_sync_state_vals(vals)
         payment = super(account_payment, self).create(vals)
-        invoices = payment.invoice_ids
-        if invoices and len(invoices) > 1:
-            return payment
-        invoice = invoices.filtered(lambda invoice: invoice.x_civicrm_id)
-        if invoice and not payment.x_civicrm_id:
-            payment.x_sync_status = 'awaiting'
+        if 'x_sync_status' not in sync_vals:
+            sync_status = self._get_sync_status(payment.invoice_ids,
+                                                payment.x_civicrm_id)
+            if sync_status:
+                sync_vals['x_sync_status'] = sync_status
+        if sync_vals:
+            payment._write_sync_state(sync_vals)
+        if vals.get('x_civicrm_id'):
+            self.env['civicrm.sync.mapping']._map('payment', payment)
         return payment
+
+    @api.multi
+    def write(self, vals):
+        """ Override method to store sync fields in the sync state table
+         and push payments marked as awaiting sync. Keeps the CiviCRM id
+         mapping up to date.
+         :param vals: dictionary values
+         :return: bool
+        """
+        vals = dict(vals)
+        sync_vals = self._pop_sync_state_vals(vals)
+        mapping = self.env['civicrm.sync.mapping']
+        if 'x_civicrm_id' in vals:
+            old_civicrm_ids = mapping._get_civicrm_ids('payment', self)
+        res = super(account_payment, self).write(vals) if vals else True
+        if 'x_civicrm_id' in vals:
+            mapping._update('payment', self, old_civicrm_ids)
+        if sync_vals:
+            self._write_sync_state(sync_vals)
+        return res
+
+    @api.multi
+    def unlink(self):
+        """ Override method to unmap the CiviCRM ids
+         :return: bool
+        """
+        mapping = self.env['civicrm.sync.mapping']
+        old_civicrm_ids = mapping._get_civicrm_ids('payment', self)
+        res = super(account_payment, self).unlink()
+        mapping._remap('payment', set(old_civicrm_ids.values()))
+        return res
+
+    @api.model
+    def _pop_sync_state_vals(self, vals):
+        """ Removes the sync fields from the values
+         :param vals: dictionary values
+         :return: dictionary of the sync field values
+        """
+        return {field: vals.pop(field) for field in SYNC_STATE_COLUMNS
+                if field in vals}
+
+    @api.multi
+    def _write_sync_state(self, sync_vals):
+        """ Upserts the sync state of the payments
+         :param sync_vals: dictionary of sync field values
+         :return: void
+        """
+        if not self.ids:
+            return
+        columns, values = [], []
+        for field, value in sync_vals.items():
+            if field == 'x_error_log':
+                value = value and self.env[
+                    'account.payment.sync.error']._get_error_id(value)
+            columns.append(SYNC_STATE_COLUMNS[field])
+            values.append(value or (0 if field == 'x_retry_count' else None))
+        self.env.cr.execute("""
+            INSERT INTO account_payment_sync_state (payment_id, {columns})
+            SELECT payment_id, {placeholders}
+            FROM unnest(%s::int[]) AS payment_id
+            ON CONFLICT (payment_id) DO UPDATE SET {updates}
+        """.format(
+            columns=', '.join(columns),
+            placeholders=', '.join('%s::{}'.format(
+                SYNC_STATE_COLUMN_TYPES[column]) for column in columns),
+            updates=', '.join('{0} = EXCLUDED.{0}'.format(column)
+                              for column in columns),
+        ), values + [list(self.ids)])
+        self.invalidate_cache(fnames=list(SYNC_STATE_COLUMNS), ids=self.ids)
+        if sync_vals.get('x_sync_status') == 'awaiting':
+            self._enqueue_sync_push()
+
+    @api.multi
+    def _compute_sync_state(self):
+        """ Reads the sync fields from the sync state table """
+        payment_ids = [payment_id for payment_id in self.ids
+                       if isinstance(payment_id, int)]
+        states = {}
+        if payment_ids:
+            self.env.cr.execute("""
+                SELECT s.payment_id, s.status, s.last_retry, s.retry_count,
+                       s.last_success_sync, e.message
+                FROM account_payment_sync_state s
+                LEFT JOIN account_payment_sync_error e ON e.id = s.error_id
+                WHERE s.payment_id IN %s
+            """, (tuple(payment_ids),))
+            states = {row[0]: row[1:] for row in self.env.cr.fetchall()}
+        for payment in self:
+            status, last_retry, retry_count, last_success_sync, error_log = \
+                states.get(payment.id, (None, None, 0, None, None))
+            payment.x_sync_status = status
+            # Timestamps are read as strings, like Datetime field values
+            payment.x_last_retry = last_retry
+            payment.x_retry_count = retry_count
+            payment.x_last_success_sync = last_success_sync
+            payment.x_error_log = error_log
+
+    @api.multi
+    def _inverse_sync_state(self):
+        """ Stores the sync fields set outside of write, e.g. on new
+         records
+        """
+        for payment in self:
+            payment._write_sync_state({field: payment[field]
+                                       for field in SYNC_STATE_COLUMNS})
+
+    @api.model
+    def _search_x_sync_status(self, operator, value):
+        """ Searches payments by their status in the sync state table """
+        query = self.env['account.payment.sync.state'].sudo()._where_calc(
+            [('status', operator, value)])
+        from_clause, where_clause, params = query.get_sql()
+        domain = [('id', 'inselect', (
+            'SELECT payment_id FROM {} WHERE {}'.format(
+                from_clause, where_clause or 'TRUE'), params))]
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if (operator in ('=', 'in') and not all(values)) or \
+                (operator in ('!=', 'not in') and all(values)):
+            # Payments without sync state have no status
+            domain = ['|'] + domain + [('id', 'not inselect', (
+                'SELECT payment_id FROM account_payment_sync_state', []))]
+        return domain
+
+    @api.multi
+    def _enqueue_sync_push(self):
+        """ Enqueues payments to be pushed to CiviCRM once the current
+         transaction is committed
+        """
+        if not self.ids or self.pool.in_test_mode():
+            return
+        dbname = self.env.cr.dbname
+        payment_ids = list(self.ids)
+        self.env.cr.after(
+            'commit', lambda: dispatcher.enqueue(dbname, payment_ids))
+
+    @api.model
+    def _get_sync_status(self, invoices, x_civicrm_id):
+        """ Gets the initial sync status of a payment registered to invoices
+         :param invoices: account.invoice objects the payment is for
+         :param x_civicrm_id: civicrm id of the payment
+         :return: 'awaiting' if the payment has to be synced, else False
+        """
+        if len(invoices) != 1 or x_civicrm_id:
+            return False
+        return 'awaiting' if invoices.x_civicrm_id else False
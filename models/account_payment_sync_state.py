@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from odoo import api, fields, models, _
+
+# Maximal length of a stored CiviCRM error message
+MAX_ERROR_LENGTH = 2000
+
+SYNC_STATUSES = [
+    ('awaiting', 'Awaiting Sync'),
+    ('synced', 'Synced'),
+    ('failed', 'Sync failed'),
+]
+
+# Classes of payment sync failures, each retried with its own backoff
+ERROR_CLASSES = [
+    ('connection', 'Connection Error'),
+    ('server', 'CiviCRM Server Error'),
+    ('client', 'Rejected Request'),
+    ('malformed', 'Malformed Response'),
+    ('civicrm', 'CiviCRM Error'),
+]
+
+
+def get_error_digest(message):
+    """ Gets the digest identifying an error message. md5 is used so the
+     digest can be computed by Postgres too.
+     :param message: str error message
+     :return: str md5 hex digest
+    """
+    return hashlib.md5(message.encode('utf-8')).hexdigest()
+
+
+class AccountPaymentSyncError(models.Model):
+    """ CiviCRM error messages of payment syncs, stored once however many
+     payments failed with them
+    """
+    _name = 'account.payment.sync.error'
+    _description = 'Payment Sync Error'
+    _log_access = False
+
+    digest = fields.Char(string='Digest', size=32, required=True)
+    message = fields.Text(string='Message', required=True)
+
+    _sql_constraints = [
+        ('digest_uniq', 'unique(digest)',
+         _('The payment sync error digest must be unique')),
+    ]
+
+    @api.model
+    def _get_error_id(self, message):
+        """ Gets the id of the stored error message, storing it if needed
+         :param message: str error message
+         :return: int account_payment_sync_error id
+        """
+        self.env.cr.execute("""
+            INSERT INTO account_payment_sync_error (digest, message)
+            VALUES (%s, %s)
+            ON CONFLICT (digest) DO UPDATE SET digest = EXCLUDED.digest
+            RETURNING id
+        """, (get_error_digest(message), message[:MAX_ERROR_LENGTH]))
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def cron_gc(self):
+        """ Deletes error messages no payment refers to anymore """
+        self.env.cr.execute("""
+            DELETE FROM account_payment_sync_error e
+            WHERE NOT EXISTS (
+                SELECT 1 FROM account_payment_sync_state s
+                WHERE s.error_id = e.id)
+        """)
+
+
+class AccountPaymentSyncState(models.Model):
+    """ CiviCRM sync state of payments, kept out of account_payment so sync
+     updates don't rewrite payment rows. Payments which are not synced have
+     no row.
+    """
+    _name = 'account.payment.sync.state'
+    _description = 'Payment Sync State'
+    _log_access = False
+
+    payment_id = fields.Many2one('account.payment', string='Payment',
+                                 required=True, ondelete='cascade')
+    status = fields.Selection(SYNC_STATUSES, string='Sync Status',
+                              index=True)
+    last_retry = fields.Datetime(string='Last Retry')
+    retry_count = fields.Integer(string='Retry Count', default=0)
+    last_success_sync = fields.Datetime(string='Last Successful Sync Date')
+    error_id = fields.Many2one('account.payment.sync.error', string='Error',
+                               ondelete='set null')
+    lease_owner = fields.Char(string='Lease Owner',
+                              help='Sync worker pushing the payment')
+    lease_until = fields.Datetime(string='Lease Expiry')
+    error_class = fields.Selection(ERROR_CLASSES, string='Error Class')
+    next_retry = fields.Datetime(string='Next Retry',
+                                 help='Failed payments are not retried '
+                                      'before this date')
+
+    _sql_constraints = [
+        ('payment_uniq', 'unique(payment_id)',
+         _('A payment can have only one sync state')),
+    ]
+
+    @api.model_cr
+    def init(self):
+        # Awaiting payments are claimed in payment id order
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_payment_sync_state_awaiting_idx
+            ON account_payment_sync_state (payment_id)
+            WHERE status = 'awaiting'
+        """)
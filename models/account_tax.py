@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import copy
+
+from odoo import api, models, tools
+
+# Tax amount types whose result depends only on the tax configuration,
+# the price, the quantity and the currency. Python code taxes also depend on
+# the product and the partner and are never memoized.
+MEMOIZED_AMOUNT_TYPES = ('fixed', 'percent', 'division', 'group')
+
+# Context keys changing compute_all results which are not part of the key
+UNMEMOIZED_CONTEXT_KEYS = ('round', 'base_values', 'force_price_include')
+
+
+class AccountTax(models.Model):
+    """ Memoizes tax computations of synced invoices, which repeat the same
+     products, prices and taxes over thousands of invoices. Results are kept
+     in the registry LRU cache, cleared on any tax change.
+    """
+    _inherit = 'account.tax'
+
+    @api.multi
+    def compute_all_memoized(self, price_unit, currency, quantity,
+                             partner=None):
+        """ Computes taxes like compute_all, reusing the result of the same
+         taxes, price, quantity, currency and rounding
+         :param price_unit: float unit price
+         :param currency: res.currency object
+         :param quantity: float quantity
+         :param partner: res.partner object, for the tax names language
+         :return: dictionary, see compute_all
+        """
+        if not self._is_memoizable():
+            return self.compute_all(price_unit, currency, quantity,
+                                    partner=partner)
+        company = self[:1].company_id or self.env.user.company_id
+        currency = currency or company.currency_id
+        lang = partner.lang if partner else self.env.context.get('lang')
+        result = self._compute_all_memo(
+            tuple(self.ids), price_unit, quantity, currency.id,
+            currency.rounding, currency.decimal_places, company.id,
+            company.tax_calculation_rounding_method, lang)
+        # The cached result is shared, callers get their own copy
+        return copy.deepcopy(result)
+
+    @api.multi
+    def _is_memoizable(self):
+        """ Checks that the taxes result depends only on the memo key """
+        if not self or any(key in self.env.context
+                           for key in UNMEMOIZED_CONTEXT_KEYS):
+            return False
+        taxes = self
+        while taxes:
+            if any(tax.amount_type not in MEMOIZED_AMOUNT_TYPES
+                   for tax in taxes):
+                return False
+            taxes = taxes.mapped('children_tax_ids')
+        return True
+
+    @api.model
+    @tools.ormcache('tax_ids', 'price_unit', 'quantity', 'currency_id',
+                    'currency_rounding', 'decimal_places', 'company_id',
+                    'rounding_method', 'lang')
+    def _compute_all_memo(self, tax_ids, price_unit, quantity, currency_id,
+                          currency_rounding, decimal_places, company_id,
+                          rounding_method, lang):
+        """ Cached compute_all. The currency rounding and the company
+         rounding method are part of the key, so changing them doesn't
+         reuse stale results.
+        """
+        taxes = self.with_context(lang=lang).browse(tax_ids)
+        return taxes.compute_all(price_unit, self.env['res.currency'].browse(
+            currency_id), quantity)
+
+    @api.model
+    def create(self, vals):
+        self.clear_caches()
+        return super(AccountTax, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        return super(AccountTax, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(AccountTax, self).unlink()
@@ -36,6 +36,35 @@ class ResCompany(models.Model):
              'sent to. Multiple email addresses can be entered and separated '
              'by comma.')
 
+    error_digest_interval = fields.Integer(
+        string='Error Digest Interval',
+        default=60,
+        help='The minimal number of minutes between two sync error report '
+             'emails. Errors occurring in between are grouped in the next '
+             'report.')
+
+    civicrm_compress_requests = fields.Boolean(
+        string='Compress Requests',
+        default=True,
+        help='Send request bodies to CiviCRM gzip compressed. Falls back to '
+             'uncompressed requests if CiviCRM rejects them.')
+
+    civicrm_max_concurrent_syncs = fields.Integer(
+        string='Max Concurrent Syncs',
+        default=0,
+        help='The maximal number of contact and contribution syncs from '
+             'CiviCRM processed at the same time for the company. Further '
+             'syncs are answered with a retry after response. 0 disables '
+             'the limit.')
+
+    civicrm_lightweight_sync = fields.Boolean(
+        string='Lightweight Sync',
+        default=False,
+        help='Write contacts, contributions and payments from CiviCRM '
+             'without field tracking, followers and per record chatter '
+             'messages, recomputing stored fields once per batch of '
+             'writes. Each synced invoice gets one summary message.')
+
 
 class CivicrmSyncSettings(models.TransientModel):
     _inherit = 'res.config.settings'
@@ -76,3 +105,33 @@ class CivicrmSyncSettings(models.TransientModel):
         help='The email addresses that the sync error report email should be '
              'sent to. Multiple email addresses can be entered and separated '
              'by comma.')
+
+    error_digest_interval = fields.Integer(
+        related='company_id.error_digest_interval',
+        string='Error Digest Interval',
+        default=60,
+        help='The minimal number of minutes between two sync error report '
+             'emails. Errors occurring in between are grouped in the next '
+             'report.')
+
+    civicrm_compress_requests = fields.Boolean(
+        related='company_id.civicrm_compress_requests',
+        string='Compress Requests',
+        help='Send request bodies to CiviCRM gzip compressed. Falls back to '
+             'uncompressed requests if CiviCRM rejects them.')
+
+    civicrm_max_concurrent_syncs = fields.Integer(
+        related='company_id.civicrm_max_concurrent_syncs',
+        string='Max Concurrent Syncs',
+        help='The maximal number of contact and contribution syncs from '
+             'CiviCRM processed at the same time for the company. Further '
+             'syncs are answered with a retry after response. 0 disables '
+             'the limit.')
+
+    civicrm_lightweight_sync = fields.Boolean(
+        related='company_id.civicrm_lightweight_sync',
+        string='Lightweight Sync',
+        help='Write contacts, contributions and payments from CiviCRM '
+             'without field tracking, followers and per record chatter '
+             'messages, recomputing stored fields once per batch of '
+             'writes. Each synced invoice gets one summary message.')
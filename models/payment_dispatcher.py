@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import defaultdict
+
+import odoo
+from odoo import api, SUPERUSER_ID
+
+from . import sync_log
+
+_logger = sync_log.getLogger(__name__)
+
+# Seconds during which enqueued payments are coalesced before the push
+DEBOUNCE_SECONDS = 5
+
+# Maximal number of payments pushed in one transaction
+DISPATCH_BATCH_SIZE = 50
+
+
+class PaymentDispatcher(object):
+    """ Pushes payments to CiviCRM shortly after they are marked as
+     awaiting sync. Payments are enqueued once their transaction is
+     committed and pushed in small batches by a background thread of the
+     worker process. Payments lost with the process (e.g. worker recycled)
+     are still awaiting sync and are pushed by the hourly scheduled action.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = defaultdict(set)
+        self._thread = None
+
+    def enqueue(self, dbname, payment_ids):
+        """ Adds payments to the next push
+         :param dbname: str database name
+         :param payment_ids: list of account_payment ids
+        """
+        with self._condition:
+            self._pending[dbname].update(payment_ids)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='odoo.civicrm_payment_dispatcher')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+            # Let the payments of the next transactions join the push
+            time.sleep(DEBOUNCE_SECONDS)
+            with self._condition:
+                pending, self._pending = self._pending, defaultdict(set)
+            for dbname, payment_ids in pending.items():
+                self._dispatch(dbname, sorted(payment_ids))
+
+    def _dispatch(self, dbname, payment_ids):
+        """ Pushes payments of the database in batches
+         :param dbname: str database name
+         :param payment_ids: list of account_payment ids
+        """
+        threading.current_thread().dbname = dbname
+        for index in range(0, len(payment_ids), DISPATCH_BATCH_SIZE):
+            batch = payment_ids[index:index + DISPATCH_BATCH_SIZE]
+            try:
+                with api.Environment.manage(), \
+                        odoo.registry(dbname).cursor() as cr:
+                    env = api.Environment(cr, SUPERUSER_ID, {})
+                    env['payment.sync'].push_payments(batch)
+            except Exception as error:
+                _logger.error('payment push failed', payments=batch,
+                              error=error)
+
+
+dispatcher = PaymentDispatcher()
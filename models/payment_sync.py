@@ -1,80 +1,628 @@
 # -*- coding: utf-8 -*-
-import logging
+import os
 import requests
+import socket
+import threading
 import time
 import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from odoo import api, models, fields
 from odoo.exceptions import UserError
 from odoo.tools import DEFAULT_SERVER_DATE_FORMAT as DATE_FORMAT
 
-_logger = logging.getLogger(__name__)
+from . import sync_log
+from .sync_compression import COMPRESSION_MIN_SIZE, compress
+from .sync_metrics import metrics
+from .sync_profiler import profiled
+
+_logger = sync_log.getLogger(__name__)
+
+# Maximal number of companies whose payments are synced in parallel
+MAX_PARALLEL_COMPANIES = 4
+
+# Number of payments whose sync data is fetched together
+PAYLOAD_CHUNK_SIZE = 200
+
+# Number of awaiting payments claimed at once by a sync worker
+CLAIM_CHUNK_SIZE = 50
+
+# Number of payments claimed at once in the retry lane, kept small so the
+# time spent on slow failing payments is checked often
+RETRY_CLAIM_CHUNK_SIZE = 10
+
+# Scheduler lanes of the payment sync: payments never tried and payments
+# which failed before
+LANES = ('fresh', 'retry')
+
+# Claim filters of the lanes. Failed payments are retried once their backoff
+# is elapsed.
+LANE_FILTERS = {
+    'fresh': "AND s.retry_count = 0",
+    'retry': "AND s.retry_count > 0 AND (s.next_retry IS NULL "
+             "OR s.next_retry <= (now() AT TIME ZONE 'UTC'))",
+}
+
+# Seconds a payment sync run may last, 0 for no limit. Payments left are
+# synced by the next run.
+BUDGET_SECONDS_PARAM = 'odoo_civicrm_sync.payment_sync_budget_seconds'
+DEFAULT_BUDGET_SECONDS = 3000
+
+# Share of the run time guaranteed to fresh payments while there are some,
+# the retry lane getting the rest
+FRESH_SHARE_PARAM = 'odoo_civicrm_sync.payment_sync_fresh_share'
+DEFAULT_FRESH_SHARE = 0.8
+
+# Maximal number of failed payments retried by a run, 0 for no limit
+RETRY_CAP_PARAM = 'odoo_civicrm_sync.payment_sync_retry_cap'
+DEFAULT_RETRY_CAP = 500
+
+# Backoff of failed payments by error class: (first delay, maximal delay)
+# in seconds, the delay doubling at each failure
+RETRY_BACKOFF = {
+    'connection': (300, 3600),
+    'server': (300, 3600),
+    'client': (3600, 86400),
+    'malformed': (900, 21600),
+    'civicrm': (3600, 86400),
+}
+
+# Context key of the time after which a sync run pushes no more payments
+DEADLINE_CONTEXT = 'civicrm_payment_sync_deadline'
+
+# Time budget of a payment sync run and its share by lane
+LaneSchedule = namedtuple('LaneSchedule', ['budget', 'shares', 'retry_cap'])
+
+# Minutes after which the payments claimed by a worker which died can be
+# claimed again
+LEASE_MINUTES_PARAM = 'odoo_civicrm_sync.payment_lease_minutes'
+DEFAULT_LEASE_MINUTES = 30
+
+# Seconds a payment push waits for CiviCRM, far below the lease, which is
+# renewed before each push
+REQUEST_TIMEOUT_PARAM = 'odoo_civicrm_sync.payment_request_timeout'
+DEFAULT_REQUEST_TIMEOUT = 60
+
+# Context key of the lease owner of the pushed payments
+LEASE_OWNER_CONTEXT = 'civicrm_payment_sync_lease_owner'
+
+# Snapshot of the CiviCRM settings of a company, loaded once per sync run
+CompanySettings = namedtuple('CompanySettings', [
+    'company_id', 'url', 'api_key', 'site_key', 'retry_threshold',
+    'compress', 'timeout'])
+
+# Response of CiviCRM extension versions which don't accept compressed
+# requests. Some answer 400 instead, with an error about the body encoding.
+UNSUPPORTED_COMPRESSION_STATUS = 415
+UNDECODED_BODY_STATUS = 400
+UNDECODED_BODY_MARKERS = ('gzip', 'encoding', 'decod', 'compress')
+
+# Seconds during which a CiviCRM URL which rejected a compressed request
+# gets uncompressed requests, before compression is tried again
+UNCOMPRESSED_SECONDS = 3600
+
+# Time at which CiviCRM URLs rejected a compressed request
+uncompressed_urls = {}
+
+# Data of a payment sent to CiviCRM
+PaymentPayload = namedtuple('PaymentPayload', [
+    'payment_id', 'journal_name', 'amount', 'payment_date', 'currency',
+    'invoice_id', 'invoice_civicrm_id', 'invoice_state',
+    'debit_account_code'])
+
+PAYLOAD_QUERY = """
+    SELECT p.id, j.name, p.amount, p.payment_date, c.name,
+           inv.id, inv.x_civicrm_id, inv.state, debit.code
+    FROM account_payment p
+    JOIN account_journal j ON j.id = p.journal_id
+    JOIN res_currency c ON c.id = p.currency_id
+    LEFT JOIN LATERAL (
+        SELECT i.id, i.x_civicrm_id, i.state
+        FROM account_invoice_payment_rel rel
+        JOIN account_invoice i ON i.id = rel.invoice_id
+        WHERE rel.payment_id = p.id
+        ORDER BY i.id DESC
+        LIMIT 1
+    ) inv ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT a.code
+        FROM account_move_line l
+        JOIN account_account a ON a.id = l.account_id
+        WHERE l.payment_id = p.id AND l.debit != 0
+        ORDER BY l.id
+        LIMIT 1
+    ) debit ON TRUE
+    WHERE p.id IN %s
+"""
+
+# Claims awaiting payments which are not leased by another worker. Rows
+# locked by a concurrent claim are skipped instead of waited for.
+CLAIM_QUERY = """
+    WITH claimable AS (
+        SELECT s.id, s.lease_owner AS previous_owner
+        FROM account_payment_sync_state s
+        JOIN account_payment p ON p.id = s.payment_id
+        WHERE s.status = 'awaiting'
+          AND s.payment_id > %(after_id)s
+          AND p.payment_date <= %(today)s
+          AND (s.lease_until IS NULL
+               OR s.lease_until < (now() AT TIME ZONE 'UTC'))
+          {payment_filter}
+        ORDER BY s.payment_id
+        LIMIT %(limit)s
+        FOR UPDATE OF s SKIP LOCKED
+    )
+    UPDATE account_payment_sync_state s
+    SET lease_owner = %(owner)s,
+        lease_until = (now() AT TIME ZONE 'UTC') + %(lease)s::interval
+    FROM claimable
+    WHERE s.id = claimable.id
+    RETURNING s.payment_id, claimable.previous_owner
+"""
 
 
 class PaymentSync(models.TransientModel):
     _name = "payment.sync"
 
-    payments = fields.Many2many('account.payment', string='Payments')
-
     @api.model
     def sync(self):
-        """ Syncs Odoo payments to CiviCRM
+        """ Syncs Odoo payments to CiviCRM. Each company with awaiting
+         payments has its own worker, claiming and pushing the payments of
+         the company by chunks, so a slow CiviCRM instance doesn't delay the
+         others. Claims let the scheduled action run on several nodes at
+         the same time, each pushing other payments.
          :return:
         """
-        _logger.debug("Payment Sync Started")
-        payments = self._get_awaiting_payments()
-        if payments:
-            self._process_payments(payments)
-        else:
-            _logger.debug("No payments were found")
+        _logger.debug('payment sync started')
+        schedule = self._get_lane_schedule()
+        deadline = time.time() + schedule.budget if schedule.budget else None
+        companies = self._get_awaiting_companies()
+        if not companies:
+            _logger.debug('no payments were found')
+            return
+
+        if len(companies) < 2 or self.pool.in_test_mode():
+            for settings in companies:
+                self._sync_company(settings, schedule, deadline)
+            return
+
+        workers = min(MAX_PARALLEL_COMPANIES, len(companies))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._sync_company_in_thread,
+                                       settings, schedule, deadline)
+                       for settings in companies]
+            for settings, future in zip(companies, futures):
+                error = future.exception()
+                if error:
+                    _logger.error('company payment sync failed',
+                                  company=settings.company_id, error=error)
+
+    @api.model
+    def _get_awaiting_companies(self):
+        """ Gets the settings of the companies having awaiting payments
+         :return: list of CompanySettings
+        """
+        self.env.cr.execute("""
+            SELECT DISTINCT j.company_id
+            FROM account_payment_sync_state s
+            JOIN account_payment p ON p.id = s.payment_id
+            JOIN account_journal j ON j.id = p.journal_id
+            WHERE s.status = 'awaiting'
+        """)
+        company_ids = sorted(row[0] for row in self.env.cr.fetchall())
+        companies = []
+        for company in self.env['res.company'].browse(company_ids):
+            settings = self._get_company_settings(company)
+            if settings:
+                companies.append(settings)
+            else:
+                _logger.warning('CiviCRM settings not filled',
+                                company=company.id)
+        return companies
+
+    def _sync_company_in_thread(self, settings, schedule, deadline):
+        """ Syncs the awaiting payments of one company with a new cursor
+         :param settings: CompanySettings
+         :param schedule: LaneSchedule of the run
+         :param deadline: float timestamp after which no payment is pushed,
+                          no limit if None
+         :return: void
+        """
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, self.env.context)
+            env['payment.sync']._sync_company(settings, schedule, deadline)
+
+    def _sync_company(self, settings, schedule, deadline):
+        """ Claims and pushes the awaiting payments of one company.
+         Fresh and failed payments are claimed in two lanes sharing the time
+         budget of the run: the next chunk comes from the lane which used
+         the least of its share, so failing payments can't starve the fresh
+         ones, and a lane left empty leaves its time to the other.
+         :param settings: CompanySettings
+         :param schedule: LaneSchedule of the run
+         :param deadline: float timestamp after which no payment is pushed,
+                          no limit if None
+         :return: void
+        """
+        owner = self._get_lease_owner()
+        after_ids = dict.fromkeys(LANES, 0)
+        spent = dict.fromkeys(LANES, 0.0)
+        claimed = dict.fromkeys(LANES, 0)
+        lanes = list(LANES)
+        while lanes:
+            if deadline and time.time() >= deadline:
+                _logger.info('payment sync time budget exhausted',
+                             budget=schedule.budget,
+                             company=settings.company_id, **claimed)
+                break
+            lane = min(lanes, key=lambda name: spent[name] /
+                       schedule.shares[name] if schedule.shares[name]
+                       else float('inf'))
+            limit = CLAIM_CHUNK_SIZE if lane == 'fresh' else \
+                RETRY_CLAIM_CHUNK_SIZE
+            if lane == 'retry' and schedule.retry_cap:
+                limit = min(limit, schedule.retry_cap - claimed[lane])
+            payment_ids = self._claim_payments(
+                owner, after_id=after_ids[lane], lane=lane, limit=limit,
+                company_id=settings.company_id)
+            if not payment_ids:
+                lanes.remove(lane)
+                continue
+            start = time.time()
+            self._sync_claimed_payments(payment_ids, owner,
+                                        deadline=deadline)
+            elapsed = time.time() - start
+            metrics.inc('civicrm_sync_outbound_lane_seconds_total', elapsed,
+                        lane=lane)
+            spent[lane] += elapsed
+            claimed[lane] += len(payment_ids)
+            after_ids[lane] = payment_ids[-1]
+            if lane == 'retry' and schedule.retry_cap and \
+                    claimed[lane] >= schedule.retry_cap:
+                _logger.info('payment sync retry cap reached',
+                             retry_cap=schedule.retry_cap,
+                             company=settings.company_id)
+                lanes.remove(lane)
+        if any(claimed.values()):
+            _logger.info('payment sync finished',
+                         company=settings.company_id,
+                         fresh=claimed['fresh'], retry=claimed['retry'],
+                         fresh_seconds=round(spent['fresh'], 3),
+                         retry_seconds=round(spent['retry'], 3))
+
+    @api.model
+    def _get_lane_schedule(self):
+        """ Loads the time budget of a sync run and its share by lane
+         :return: LaneSchedule
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        fresh_share = float(params.get_param(FRESH_SHARE_PARAM,
+                                             DEFAULT_FRESH_SHARE))
+        fresh_share = min(max(fresh_share, 0.0), 1.0)
+        return LaneSchedule(
+            budget=float(params.get_param(BUDGET_SECONDS_PARAM,
+                                          DEFAULT_BUDGET_SECONDS)),
+            shares={'fresh': fresh_share, 'retry': 1.0 - fresh_share},
+            retry_cap=int(params.get_param(RETRY_CAP_PARAM,
+                                           DEFAULT_RETRY_CAP)),
+        )
+
+    @api.model
+    def push_payments(self, payment_ids):
+        """ Syncs the given payments which are still awaiting sync
+         :param payment_ids: list of account_payment ids
+         :return: void
+        """
+        owner = self._get_lease_owner()
+        claimed_ids = self._claim_payments(owner, payment_ids=payment_ids)
+        if claimed_ids:
+            self._sync_claimed_payments(claimed_ids, owner)
+
+    @staticmethod
+    def _get_lease_owner():
+        return '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                 threading.current_thread().ident)
+
+    def _claim_payments(self, owner, after_id=0, payment_ids=None, lane=None,
+                        limit=CLAIM_CHUNK_SIZE, company_id=None):
+        """ Leases a chunk of awaiting payments to the worker. The lease is
+         committed with its own cursor, so concurrent workers see it at
+         once. Leases of a worker which died expire and are claimed again.
+         :param owner: str lease owner
+         :param after_id: int, only payments with a greater id are claimed
+         :param payment_ids: list of account_payment ids to claim among,
+                             all awaiting payments if None
+         :param lane: str key of LANE_FILTERS, payments of any lane if None
+         :param limit: int maximal number of payments claimed, ignored when
+                       payment_ids are given
+         :param company_id: int res.company id, only payments of this company
+                            are claimed if given
+         :return: sorted list of claimed account_payment ids
+        """
+        params = {
+            'after_id': after_id,
+            'today': fields.Date.today(),
+            'limit': len(payment_ids) if payment_ids else limit,
+            'owner': owner,
+            'lease': self._get_lease_interval(),
+        }
+        payment_filter = LANE_FILTERS[lane] if lane else ''
+        if company_id:
+            payment_filter += ' AND p.journal_id IN (SELECT id FROM ' \
+                              'account_journal WHERE company_id = ' \
+                              '%(company_id)s)'
+            params['company_id'] = company_id
+        if payment_ids is not None:
+            if not payment_ids:
+                return []
+            payment_filter += ' AND s.payment_id IN %(payment_ids)s'
+            params['payment_ids'] = tuple(payment_ids)
+        with self.pool.cursor() as cr:
+            cr.execute(CLAIM_QUERY.format(payment_filter=payment_filter),
+                       params)
+            rows = cr.fetchall()
+        recovered = [payment_id for payment_id, previous_owner in rows
+                     if previous_owner]
+        if recovered:
+            _logger.warning('expired payment leases recovered',
+                            payments=recovered)
+        return sorted(payment_id for payment_id, _ in rows)
+
+    def _get_lease_interval(self):
+        """ Gets the duration of payment leases
+         :return: str Postgres interval
+        """
+        return '{} minutes'.format(
+            self.env['ir.config_parameter'].sudo().get_param(
+                LEASE_MINUTES_PARAM, DEFAULT_LEASE_MINUTES))
 
-    def _process_payments(self, payments):
+    def _renew_leases(self, payment_ids, owner):
+        """ Extends the leases of the worker on payments, with its own
+         cursor so concurrent workers see them at once
+         :param payment_ids: list of account_payment ids
+         :param owner: str lease owner
+         :return: set of the account_payment ids still leased to the worker
+        """
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                UPDATE account_payment_sync_state
+                SET lease_until = (now() AT TIME ZONE 'UTC') + %s::interval
+                WHERE payment_id IN %s AND lease_owner = %s
+                RETURNING payment_id
+            """, (self._get_lease_interval(), tuple(payment_ids), owner))
+            return {row[0] for row in cr.fetchall()}
+
+    def _sync_claimed_payments(self, payment_ids, owner, deadline=None):
+        """ Syncs claimed payments in a new transaction, started after the
+         claim was committed, and releases their lease. Payments left when
+         the deadline is reached are released unsynced.
+         :param payment_ids: list of claimed account_payment ids
+         :param owner: str lease owner
+         :param deadline: float timestamp after which no payment is pushed,
+                          no limit if None
+         :return: void
+        """
+        context = dict(self.env.context, **{LEASE_OWNER_CONTEXT: owner})
+        if deadline:
+            context[DEADLINE_CONTEXT] = deadline
+        try:
+            with api.Environment.manage(), self.pool.cursor() as cr:
+                env = api.Environment(cr, self.env.uid, context)
+                env['payment.sync']._sync_payments(
+                    env['account.payment'].browse(payment_ids))
+        finally:
+            self._release_leases(payment_ids, owner)
+
+    def _release_leases(self, payment_ids, owner):
+        """ Releases the leases of the worker on payments
+         :param payment_ids: list of account_payment ids
+         :param owner: str lease owner
+         :return: void
+        """
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                UPDATE account_payment_sync_state
+                SET lease_owner = NULL, lease_until = NULL
+                WHERE payment_id IN %s AND lease_owner = %s
+            """, (tuple(payment_ids), owner))
+
+    def _sync_payments(self, payments):
+        """ Syncs payments to the CiviCRM instance of their company.
+         Companies are processed in parallel, each in its own transaction,
+         so a slow CiviCRM instance doesn't delay the others.
+         :param payments: account_payment models
+         :return: void
+        """
+        partitions = []
+        for company in payments.mapped('company_id'):
+            settings = self._get_company_settings(company)
+            if not settings:
+                _logger.warning('CiviCRM settings not filled',
+                                company=company.id)
+                continue
+            company_payments = payments.filtered(
+                lambda payment: payment.company_id == company)
+            partitions.append((settings, company_payments.ids))
+
+        if len(partitions) < 2 or self.pool.in_test_mode():
+            for settings, payment_ids in partitions:
+                self._sync_company_payments(settings, payment_ids)
+            return
+
+        workers = min(MAX_PARALLEL_COMPANIES, len(partitions))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._sync_company_payments_in_thread,
+                                       settings, payment_ids)
+                       for settings, payment_ids in partitions]
+            for (settings, payment_ids), future in zip(partitions, futures):
+                error = future.exception()
+                if error:
+                    _logger.error('company payment sync failed',
+                                  company=settings.company_id, error=error)
+
+    def _sync_company_payments_in_thread(self, settings, payment_ids):
+        """ Syncs payments of one company with a new cursor
+         :param settings: CompanySettings
+         :param payment_ids: list of account_payment ids
+         :return: void
+        """
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, self.env.context)
+            env['payment.sync']._sync_company_payments(settings, payment_ids)
+
+    @profiled('payment_sync')
+    def _sync_company_payments(self, settings, payment_ids):
+        """ Syncs payments of one company using a dedicated HTTP session.
+         Profiled as the unit of work of the payment sync, on the cursor and
+         in the thread pushing the payments.
+         :param settings: CompanySettings
+         :param payment_ids: list of account_payment ids
+         :return: void
+        """
+        payments = self.env['account.payment'].browse(payment_ids)
+        with sync_log.correlate(company=settings.company_id), \
+                requests.Session() as session:
+            self._process_payments(payments, settings, session)
+
+    @staticmethod
+    def _get_company_settings(company):
+        """ Loads the CiviCRM settings of the company
+         :param company: res.company model
+         :return: CompanySettings or None if settings are not filled
+        """
+        if not company.civicrm_instance_url or not company.civicrm_api_key \
+                or not company.civicrm_site_key:
+            return None
+        return CompanySettings(
+            company_id=company.id,
+            url=company.civicrm_instance_url,
+            api_key=company.civicrm_api_key,
+            site_key=company.civicrm_site_key,
+            retry_threshold=company.retry_threshold,
+            compress=company.civicrm_compress_requests,
+            timeout=float(company.env['ir.config_parameter'].sudo().get_param(
+                REQUEST_TIMEOUT_PARAM, DEFAULT_REQUEST_TIMEOUT)),
+        )
+
+    def _process_payments(self, payments, settings, session):
         """ Processing payments sync
          :param payments: list of payments
-         :return: list of failed payments
+         :param settings: CompanySettings of the payments company
+         :param session: requests.Session to the company's CiviCRM
+         :return: void
         """
-        for payment in payments:
-            if not payment.invoice_ids:
+        deadline = self.env.context.get(DEADLINE_CONTEXT)
+        owner = self.env.context.get(LEASE_OWNER_CONTEXT)
+        for index in range(0, len(payments), PAYLOAD_CHUNK_SIZE):
+            chunk = payments[index:index + PAYLOAD_CHUNK_SIZE]
+            payloads = self._fetch_payloads(chunk)
+            for position, payment in enumerate(chunk):
+                if deadline and time.time() >= deadline:
+                    _logger.info('payment sync deadline reached, payments '
+                                 'left for the next run')
+                    break
+                payload = payloads.get(payment.id)
+                if not payload or not payload.invoice_id:
+                    continue
+                # The leases of the payments not pushed yet are renewed, the
+                # pushed ones being locked by this transaction until commit
+                if owner and payment.id not in self._renew_leases(
+                        payments.ids[index + position:], owner):
+                    _logger.warning('payment lease lost, payment left to '
+                                    'its new owner', payment=payment.id)
+                    continue
+                with sync_log.correlate(payment=payment.id):
+                    self._sync_single_payment(payment, payload, settings,
+                                              session)
+            else:
                 continue
-            self._sync_single_payment(payment)
-        self._send_error_email(payments)
+            break
+        self.env['civicrm.sync.metric'].flush_if_due()
+        self._send_error_email(
+            payments, self.env['res.company'].browse(settings.company_id))
 
-    def _sync_single_payment(self, payment):
+    def _sync_single_payment(self, payment, payload, settings, session):
         """ Syncs single record of Payment to CiviCRM
          :param payment: account_payment model
-         :return: bool True on success, False on failure
+         :param payload: PaymentPayload of the payment
+         :param settings: CompanySettings of the payment company
+         :param session: requests.Session to the company's CiviCRM
+         :return: str error class on failure, None on success
         """
-        # get url to sync
-        url = self.env.user.company_id.civicrm_instance_url
-        api_key = self.env.user.company_id.civicrm_api_key
-        site_key = self.env.user.company_id.civicrm_site_key
-        if not url or not api_key or not site_key:
-            raise UserError("CiviCRM setting not filled")
-
-        data = self._fill_sync_data(payment)
+        data = self._fill_sync_data(payload)
         xml_doc = self._create_xml_with_data(data)
-        response = self._do_request(url, api_key, site_key, xml_doc)
-        _logger.debug('CiviCRM sync responce = {}'.format(response.text))
-        result = self._validate_sync_response(response, payment)
-        self._change_payment_status(payment, 'synced' if not result else
-        'failed')
-        return result
+        lane = 'retry' if payment.x_retry_count else 'fresh'
+        if payment.x_retry_count:
+            metrics.inc('civicrm_sync_outbound_retries_total')
+        start = time.time()
+        try:
+            response = self._do_request(session, settings, xml_doc)
+        except requests.RequestException as error:
+            _logger.warning('CiviCRM sync request failed', error=error)
+            payment.write({'x_last_retry': fields.Datetime.now(),
+                           'x_error_log': str(error)})
+            error_class = 'connection'
+        else:
+            _logger.debug('CiviCRM sync response',
+                          status=response.status_code,
+                          response=response.text)
+            error_class = self._validate_sync_response(response, payment)
+        metrics.observe('civicrm_sync_outbound_request_duration_seconds',
+                        time.time() - start)
+        metrics.inc('civicrm_sync_outbound_total')
+        metrics.inc('civicrm_sync_outbound_lane_total', lane=lane)
+        if error_class:
+            metrics.inc('civicrm_sync_outbound_failures_total')
+        self._change_payment_status(payment, 'synced' if not error_class else
+        'failed', settings, error_class=error_class)
+        return error_class
 
     @staticmethod
-    def _do_request(url, api_key, site_key, xml_doc):
-        """ Does request to civiCRM
-         :param url: Url to perform request
+    def _do_request(session, settings, xml_doc):
+        """ Does request to civiCRM. The body is gzip compressed if the
+         company allows it, and sent again uncompressed if CiviCRM rejects
+         it. Compressed responses are decoded by requests.
+         :param session: requests.Session to the company's CiviCRM
+         :param settings: CompanySettings with url and keys
          :param xml_doc: xml doc request body
          :return: xml response
         """
         headers = {'Content-Type': 'application/xml'}
         api = "entity=OdooSync&action=transaction"
-        return requests.post(
-            "{}?{}&key={}&api_key={}".
-                format(url, api, site_key, api_key),
-            data=xml_doc,
-            headers=headers
-        )
+        url = "{}?{}&key={}&api_key={}".format(
+            settings.url, api, settings.site_key, settings.api_key)
+        rejected_at = uncompressed_urls.get(settings.url)
+        if settings.compress and len(xml_doc) >= COMPRESSION_MIN_SIZE and \
+                (not rejected_at or
+                 time.time() - rejected_at >= UNCOMPRESSED_SECONDS):
+            response = session.post(
+                url, data=compress(xml_doc),
+                headers=dict(headers, **{'Content-Encoding': 'gzip'}),
+                timeout=settings.timeout)
+            if not PaymentSync._is_compression_rejected(response):
+                uncompressed_urls.pop(settings.url, None)
+                return response
+            uncompressed_urls[settings.url] = time.time()
+            _logger.info('CiviCRM rejected compressed request, sending '
+                         'uncompressed requests', status=response.status_code,
+                         company=settings.company_id)
+        return session.post(url, data=xml_doc, headers=headers,
+                            timeout=settings.timeout)
+
+    @staticmethod
+    def _is_compression_rejected(response):
+        """ Checks whether CiviCRM rejected a request because its body is
+         compressed, rather than because of its content
+         :param response: CiviCRM response
+         :return: bool
+        """
+        if response.status_code == UNSUPPORTED_COMPRESSION_STATUS:
+            return True
+        if response.status_code != UNDECODED_BODY_STATUS:
+            return False
+        body = response.text.lower()
+        return any(marker in body for marker in UNDECODED_BODY_MARKERS)
 
     @staticmethod
     def _create_xml_with_data(data):
@@ -102,17 +650,21 @@ class PaymentSync(models.TransientModel):
 
         return ElementTree.tostring(request_xml, 'utf8', 'xml')
 
-    def _change_payment_status(self, payment, status):
+    def _change_payment_status(self, payment, status, settings,
+                               error_class=None):
         """ Changes status of payment according to
          :param payment: account_payment model
          :param status: str status to change
+         :param settings: CompanySettings of the payment company
+         :param error_class: str key of RETRY_BACKOFF of a failure
          :return: void
         """
         prev_status = payment.x_sync_status
         if status == 'failed':
             payment.write({'x_retry_count': payment.x_retry_count + 1})
-            if payment.x_retry_count >= self.env.user.company_id.retry_threshold:
+            if payment.x_retry_count >= settings.retry_threshold:
                 payment.write({'x_sync_status': status})
+            self._schedule_retry(payment, error_class)
         elif status == 'synced':
             payment.write({
                 'x_sync_status': status,
@@ -121,63 +673,104 @@ class PaymentSync(models.TransientModel):
                 'x_error_log': None,
                 'x_last_retry': None,
             })
-        if prev_status == payment.x_sync_status:
-            _logger.debug(
-                "Status of payment with civi_crm_id: {} was changed from {} to {}".
-                    format(payment.x_civicrm_id, prev_status, status))
+            self._schedule_retry(payment, None)
+        if prev_status != payment.x_sync_status:
+            _logger.debug('payment status changed',
+                          civicrm_id=payment.x_civicrm_id,
+                          prev_status=prev_status, status=status)
+
+    def _schedule_retry(self, payment, error_class):
+        """ Sets when a failed payment is retried, after the backoff of its
+         error class doubled at each failure
+         :param payment: account_payment model
+         :param error_class: str key of RETRY_BACKOFF, None once synced
+         :return: void
+        """
+        delay = None
+        if error_class:
+            first_delay, max_delay = RETRY_BACKOFF[error_class]
+            doublings = min(max(payment.x_retry_count - 1, 0), 16)
+            delay = min(max_delay, first_delay * 2 ** doublings)
+        self.env.cr.execute("""
+            UPDATE account_payment_sync_state
+            SET error_class = %s,
+                next_retry = (now() AT TIME ZONE 'UTC')
+                             + %s * interval '1 second'
+            WHERE payment_id = %s
+        """, (error_class, delay, payment.id))
 
     @staticmethod
     def _validate_sync_response(response, payment):
         """ Validates response on failure
-         :param response:
-         :return:
+         :param response: CiviCRM response
+         :param payment: account_payment model
+         :return: str key of RETRY_BACKOFF on failure, None on success
         """
         update = {'x_last_retry': fields.Datetime.now()}
         if response.status_code >= 400:
             update.update({
                 'x_error_log': response.text,
             })
-            return False
-        response_xml = ElementTree.XML(response.text)
-        if not response_xml:
-            return False
-        result_set = response_xml.find('Result')
-        is_error = int(result_set.find('is_error').text)
+            payment.write(update)
+            return 'server' if response.status_code >= 500 else 'client'
+        try:
+            result_set = ElementTree.XML(response.text).find('Result')
+            is_error = int(result_set.findtext('is_error'))
+            if not is_error:
+                transaction_id = int(result_set.findtext('transaction_id'))
+        except (ElementTree.ParseError, AttributeError, TypeError,
+                ValueError):
+            # Not XML, or without the Result, is_error or transaction_id
+            # elements CiviCRM always answers with
+            update.update({
+                'x_error_log': response.text,
+            })
+            payment.write(update)
+            return 'malformed'
         if is_error:
-            error_message = str(result_set.find('error_message').text)
             update.update({
-                'x_error_log': error_message,
+                'x_error_log': result_set.findtext('error_message',
+                                                   response.text),
             })
         else:
-            transaction_id = int(result_set.find('transaction_id').text)
             update.update({
                 'x_civicrm_id': transaction_id
             })
         payment.write(update)
-        return bool(is_error)
+        return 'civicrm' if is_error else None
+
+    def _fetch_payloads(self, payments):
+        """ Fetches the sync data of payments with a single query
+         :param payments: account_payment models
+         :return: dict {payment id: PaymentPayload}
+        """
+        if not payments:
+            return {}
+        self.env.cr.execute(PAYLOAD_QUERY, (tuple(payments.ids),))
+        return {row[0]: PaymentPayload(*row)
+                for row in self.env.cr.fetchall()}
 
-    def _fill_sync_data(self, payment):
+    def _fill_sync_data(self, payload):
         """ Fills request body with payment's data
-         :param payment: account_payment model
+         :param payload: PaymentPayload
          :return: dict with data
         """
-        payment_to_invoice = max(payment.invoice_ids)
-
-        if not payment_to_invoice:
+        if not payload.invoice_id:
             raise UserError('No invoice connected to payment was found')
 
-        dt = datetime.strptime(payment.payment_date, DATE_FORMAT)
-        payment_date = time.mktime(dt.timetuple())
-        invoice_state = payment_to_invoice.state
-        debit_line = payment.move_line_ids.filtered(lambda l: l.debit)
+        payment_date = payload.payment_date
+        if isinstance(payment_date, str):
+            payment_date = datetime.strptime(payment_date, DATE_FORMAT)
+        payment_date = time.mktime(payment_date.timetuple())
         return [
-            {"to_financial_account_name": payment.journal_id.name},
-            {"total_amount": payment.amount},
+            {"to_financial_account_name": payload.journal_name},
+            {"total_amount": payload.amount},
             {"trxn_date": int(payment_date)},
-            {"currency": payment.currency_id.name},
-            {"invoice_id": payment_to_invoice.x_civicrm_id},
-            {"credit_account_code": debit_line.account_id.code},
-            {"contribution_status": self._convert_invoice_state(invoice_state)},
+            {"currency": payload.currency},
+            {"invoice_id": payload.invoice_civicrm_id},
+            {"credit_account_code": payload.debit_account_code},
+            {"contribution_status": self._convert_invoice_state(
+                payload.invoice_state)},
         ]
 
     @staticmethod
@@ -190,24 +783,11 @@ class PaymentSync(models.TransientModel):
                        'open': 'Partially Paid'}
         return convert_map.get(state, state)
 
-    def _get_awaiting_payments(self):
-        """ Gets payments from db
-         :return: account_payment models list
-        """
-        return self.env['account.payment'].search(
-            [
-                ('x_sync_status', '=', 'awaiting'),
-                ('payment_date', '<=', fields.Date.today())
-            ],
-        )
-
-    def _send_error_email(self, payments):
-        """ Sends email with information regarding payment sync error
-         :param payment: account.payment model
+    def _send_error_email(self, payments, company):
+        """ Adds failed payments to the error digest, which is emailed
+         according to the company's error digest interval
+         :param payments: account.payment models
+         :param company: res.company model of the payments
          :return: void
         """
-        template = self.env.ref('odoo_civicrm_sync.odoo_sivicrm_sync_error')
-        payments = payments.filtered(lambda payment: payment.x_sync_status == 'failed')
-        if payments:
-            sync = self.create({'payments':[(6, 0, payments.ids)]})
-            self.env['mail.template'].browse(template.id).send_mail(sync.id)
+        self.env['payment.sync.digest'].add_failures(payments, company)
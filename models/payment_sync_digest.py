@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+from datetime import timedelta
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+# Maximal number of error signatures rendered in the report email
+MAX_REPORT_LINES = 20
+
+# Maximal number of payment ids kept as samples of an error signature
+MAX_SAMPLE_IDS = 5
+
+# Maximal length of an error signature and of its sample message
+MAX_SIGNATURE_LENGTH = 200
+MAX_MESSAGE_LENGTH = 1000
+
+UNKNOWN_ERROR = _("Unknown error")
+
+
+def get_error_signature(error):
+    """ Normalizes error message, so the same failure of different payments
+     gets the same signature
+     :param error: str error log
+     :return: str signature
+    """
+    lines = (error or '').strip().splitlines()
+    message = lines[0] if lines else UNKNOWN_ERROR
+    signature = re.sub(r'\d+', '#', message.lower())
+    signature = re.sub(r'\s+', ' ', signature).strip()
+    return signature[:MAX_SIGNATURE_LENGTH]
+
+
+class PaymentSyncDigest(models.Model):
+    _name = 'payment.sync.digest'
+    _description = 'CiviCRM Payment Sync Error Digest'
+    _order = 'id desc'
+
+    company_id = fields.Many2one('res.company', string='Company',
+                                 required=True, index=True)
+    state = fields.Selection([
+        ('draft', 'Collecting'),
+        ('sent', 'Sent'),
+        ('suppressed', 'Suppressed'),
+    ], string='State', default='draft', required=True, index=True,
+        help='Digest is "Suppressed" when it contains only errors which '
+             'were already reported by the previous digest.')
+    sent_date = fields.Datetime(string='Sent Date')
+    failure_count = fields.Integer(string='Failed Payments', default=0)
+    line_ids = fields.One2many('payment.sync.digest.line', 'digest_id',
+                               string='Errors')
+
+    @api.model
+    def add_failures(self, payments, company):
+        """ Adds failed payments to the collecting digest of the company
+         and sends it if the notification interval is elapsed
+         :param payments: account.payment models processed by the sync
+         :param company: res.company model
+         :return: void
+        """
+        failed = payments.filtered(
+            lambda payment: payment.x_sync_status == 'failed')
+        digest = self.search([('company_id', '=', company.id),
+                              ('state', '=', 'draft')], limit=1)
+        if failed:
+            if not digest:
+                digest = self.create({'company_id': company.id})
+            digest._add_payments(failed)
+        if digest:
+            digest._send_if_due()
+
+    def _add_payments(self, payments):
+        """ Groups payments by error signature and updates digest lines
+         :param payments: failed account.payment models
+         :return: void
+        """
+        self.ensure_one()
+        groups = {}
+        for payment in payments:
+            signature = get_error_signature(payment.x_error_log)
+            message, payment_ids = groups.setdefault(
+                signature, ((payment.x_error_log or UNKNOWN_ERROR)[
+                            :MAX_MESSAGE_LENGTH], []))
+            payment_ids.append(payment.id)
+
+        digest_line = self.env['payment.sync.digest.line']
+        lines = {line.signature: line for line in self.line_ids}
+        for signature, (message, payment_ids) in groups.items():
+            line = lines.get(signature)
+            if line:
+                sample_ids = line._get_sample_ids() + payment_ids
+                line.write({
+                    'count': line.count + len(payment_ids),
+                    'sample_ids': line._format_sample_ids(sample_ids),
+                })
+            else:
+                digest_line.create({
+                    'digest_id': self.id,
+                    'signature': signature,
+                    'message': message,
+                    'count': len(payment_ids),
+                    'sample_ids': digest_line._format_sample_ids(payment_ids),
+                })
+        self.failure_count += len(payments)
+
+    def _send_if_due(self):
+        """ Sends digest unless the previous one was sent less than the
+         company's error digest interval ago. Digest which contains only
+         the errors of the previous one is suppressed instead of sent.
+         :return: void
+        """
+        self.ensure_one()
+        previous = self.search([('company_id', '=', self.company_id.id),
+                                ('state', '=', 'sent')],
+                               order='sent_date desc', limit=1)
+        now = fields.Datetime.from_string(fields.Datetime.now())
+        if previous:
+            interval = timedelta(minutes=self.company_id.error_digest_interval)
+            if fields.Datetime.from_string(previous.sent_date) + interval > now:
+                return
+
+        previous_signatures = set(previous.line_ids.mapped('signature'))
+        new_lines = self.line_ids.filtered(
+            lambda line: line.signature not in previous_signatures)
+        new_lines.write({'is_new': True})
+        if not new_lines:
+            _logger.debug('Error digest %s suppressed: no new errors', self.id)
+            self.write({'state': 'suppressed'})
+            return
+
+        template = self.env.ref('odoo_civicrm_sync.odoo_civicrm_sync_error_digest')
+        template.send_mail(self.id)
+        self.write({'state': 'sent', 'sent_date': fields.Datetime.to_string(now)})
+
+    def _get_report_lines(self):
+        """ Gets the lines rendered in the report email
+         :return: payment.sync.digest.line models
+        """
+        self.ensure_one()
+        return self.line_ids.sorted(
+            key=lambda line: (not line.is_new, -line.count))[:MAX_REPORT_LINES]
+
+    def _get_omitted_line_count(self):
+        """ Gets the number of lines not rendered in the report email
+         :return: int
+        """
+        self.ensure_one()
+        return max(len(self.line_ids) - MAX_REPORT_LINES, 0)
+
+
+class PaymentSyncDigestLine(models.Model):
+    _name = 'payment.sync.digest.line'
+    _description = 'CiviCRM Payment Sync Error Digest Line'
+    _order = 'count desc'
+
+    digest_id = fields.Many2one('payment.sync.digest', string='Digest',
+                                required=True, ondelete='cascade', index=True)
+    signature = fields.Char(string='Signature', required=True)
+    message = fields.Text(string='Sample Error')
+    count = fields.Integer(string='Failed Payments', default=0)
+    sample_ids = fields.Char(string='Sample Payment Ids')
+    is_new = fields.Boolean(string='New',
+                            help='The error was not in the previous digest.')
+
+    def _get_sample_ids(self):
+        """ Parses sample payment ids
+         :return: list of int
+        """
+        self.ensure_one()
+        return [int(payment_id) for payment_id in
+                (self.sample_ids or '').split(',') if payment_id]
+
+    @staticmethod
+    def _format_sample_ids(payment_ids):
+        """ Formats at most MAX_SAMPLE_IDS payment ids
+         :param payment_ids: list of int
+         :return: str
+        """
+        return ','.join(str(payment_id) for payment_id in
+                        payment_ids[:MAX_SAMPLE_IDS])
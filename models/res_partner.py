@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import logging
 import time
 from collections import namedtuple
 from datetime import datetime
@@ -8,7 +7,15 @@ from datetime import datetime
 from odoo import api, fields, models, _
 from odoo.tools import DEFAULT_SERVER_DATETIME_FORMAT as DATETIME_FORMAT
 
-_logger = logging.getLogger(__name__)
+from . import sync_log
+from .sync_admission import admitted
+from .sync_idempotency import idempotent
+from .sync_journal import journaled
+from .sync_lightweight import deferred_recompute, lightweight
+from .sync_metrics import observe_inbound_sync
+from .sync_profiler import profiled
+
+_logger = sync_log.getLogger(__name__)
 
 UNKNOWN_ERROR = _("Unknown error when updating res.partner data")
 
@@ -36,6 +43,49 @@ class ResPartner(models.Model):
     ]
 
     @api.model
+    def create(self, vals):
+        """ Override method to map the CiviCRM id
+         :param vals: dictionary values
+         :return: new res.partner object
+        """
+        partner = super(ResPartner, self).create(vals)
+        if vals.get('x_civicrm_id'):
+            self.env['civicrm.sync.mapping']._map('contact', partner)
+        return partner
+
+    @api.multi
+    def write(self, vals):
+        """ Override method to keep the CiviCRM id mapping up to date
+         :param vals: dictionary values
+         :return: bool
+        """
+        if 'x_civicrm_id' not in vals:
+            return super(ResPartner, self).write(vals)
+        mapping = self.env['civicrm.sync.mapping']
+        old_civicrm_ids = mapping._get_civicrm_ids('contact', self)
+        res = super(ResPartner, self).write(vals)
+        mapping._update('contact', self, old_civicrm_ids)
+        return res
+
+    @api.multi
+    def unlink(self):
+        """ Override method to unmap the CiviCRM ids
+         :return: bool
+        """
+        mapping = self.env['civicrm.sync.mapping']
+        old_civicrm_ids = mapping._get_civicrm_ids('contact', self)
+        res = super(ResPartner, self).unlink()
+        mapping._remap('contact', set(old_civicrm_ids.values()))
+        return res
+
+    @api.model
+    @admitted('contact')
+    @journaled('contact')
+    @profiled('contact')
+    @observe_inbound_sync('contact')
+    @idempotent('contact', 'write_date')
+    @sync_log.correlated('contact')
+    @lightweight
     def civicrm_sync(self, input_params):
         """Synchronizes CiviCRM contact to Odoo partner.
          Creates new partners if not exists and updates is it is
@@ -61,7 +111,8 @@ class ResPartner(models.Model):
                                 'create_date': int,
                                 'write_date': int,
                                 'active': bool,
-                                'customer': bool
+                                'customer': bool,
+                                'idempotency_key': str, optional
                                 }
          :return: data in dictionary format: {
                                 'is_error': int, value from list [0, 1]
@@ -81,13 +132,14 @@ class ResPartner(models.Model):
             return self._get_civicrm_sync_response()
 
         # Check if CiviCRM contact id exists in ODOO
-        partner = self.with_context(active_test=False).search(
-            [('x_civicrm_id', '=', self.vals.get('x_civicrm_id'))])
+        partner = self.env['civicrm.sync.mapping']._get_record(
+            'contact', self.vals.get('x_civicrm_id'))
 
         # Assign ODOO partner_id if exists
         self.response_data.update(partner_id=partner.id)
 
-        _logger.debug('partner = {}'.format(partner))
+        sync_log.bind(partner=partner.id)
+        _logger.debug('partner found', partner=partner)
 
         # Create or update res.partner data
         self.save_partner(partner)
@@ -144,7 +196,7 @@ class ResPartner(models.Model):
 
             if value and param_type.convert_method:
                 new_param = param_type.convert_method(key=key, value=value)
-                _logger.debug(new_param)
+                _logger.debug('param converted', key=key, value=new_param)
                 self.vals[key] = new_param
 
         # Check if CiviCMR contact's title and country_iso_code exists
@@ -163,7 +215,7 @@ class ResPartner(models.Model):
         try:
             return datetime.fromtimestamp(timestamp).strftime(DATETIME_FORMAT)
         except Exception as error:
-            _logger.error(error)
+            _logger.error('timestamp conversion failed', error=error)
             self.error_log.append(str(error))
             self.error_handler()
 
@@ -225,14 +277,21 @@ class ResPartner(models.Model):
         status = True
         try:
             # Create or update res.partner
-            if partner:
-                status = partner.write(self.vals)
-            else:
-                partner = self.create(self.vals)
-
+            created = not partner
+            with deferred_recompute(self):
+                if partner:
+                    status = partner.write(self.vals)
+                else:
+                    partner = self.create(self.vals)
+
+            if created:
                 # Assign CiviCRM partner_id
                 self.response_data.update(partner_id=partner.id)
 
+                # Sync the contributions which arrived before the contact
+                self.env['civicrm.sync.pending']._enqueue(
+                    partner.x_civicrm_id)
+
             if not (partner or status):
                 self.error_log.append(UNKNOWN_ERROR)
                 return
@@ -242,7 +301,7 @@ class ResPartner(models.Model):
             self.response_data.update(timestamp=int(timestamp))
 
         except Exception as error:
-            _logger.error(error)
+            _logger.error('partner save failed', error=error)
             self.error_log.append(str(error))
             self.error_handler()
 
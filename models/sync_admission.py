@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import time
+
+from odoo import api, models
+
+from . import sync_log
+from .sync_metrics import metrics
+
+_logger = sync_log.getLogger(__name__)
+
+# First key of the advisory locks used as inbound sync slots
+ADVISORY_LOCK_NAMESPACE = 0x43495649
+
+# Slots of a company are the advisory lock keys
+# company_id * MAX_SLOTS_PER_COMPANY + slot
+MAX_SLOTS_PER_COMPANY = 1000
+
+# Number of seconds a rejected caller is told to wait before retrying
+RETRY_AFTER_PARAM = 'odoo_civicrm_sync.retry_after_seconds'
+DEFAULT_RETRY_AFTER = 5
+
+
+def admitted(entity):
+    """ Decorator rejecting inbound civicrm_sync calls with a retry after
+     response when the company of the user already runs its maximal number
+     of concurrent syncs
+     :param entity: str, name of the synced entity
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            admission = self.env['civicrm.sync.admission']
+            company = self.env.user.company_id
+            if admission._acquire_slot(company):
+                return method(self, *args, **kwargs)
+            in_flight = admission._get_in_flight([company.id])[company.id]
+            metrics.inc('civicrm_sync_inbound_rejected_total', entity=entity)
+            _logger.info('inbound sync rejected', entity=entity,
+                         company=company.id, in_flight=in_flight)
+            return {
+                'is_error': 1,
+                'retry_after': admission._get_retry_after(),
+                'in_flight': in_flight,
+                'timestamp': int(time.time()),
+            }
+        return wrapper
+    return decorator
+
+
+class CivicrmSyncAdmission(models.AbstractModel):
+    """ Caps the number of concurrent inbound syncs of each company. A sync
+     holds one of the company slots, a transaction level advisory lock, so
+     slots are shared by all the Odoo workers and released when the sync
+     transaction ends.
+    """
+    _name = 'civicrm.sync.admission'
+    _description = 'CiviCRM Sync Admission Control'
+
+    @api.model
+    def _acquire_slot(self, company):
+        """ Takes a free inbound sync slot of the company for the current
+         transaction
+         :param company: res.company model
+         :return: bool True if a slot was taken or the company has no limit
+        """
+        max_syncs = min(company.civicrm_max_concurrent_syncs,
+                        MAX_SLOTS_PER_COMPANY)
+        if max_syncs <= 0:
+            return True
+        first_key = company.id * MAX_SLOTS_PER_COMPANY
+        self.env.cr.execute("""
+            SELECT slot
+            FROM generate_series(%s, %s) AS slot
+            WHERE pg_try_advisory_xact_lock(%s, slot)
+            LIMIT 1
+        """, (first_key, first_key + max_syncs - 1,
+              ADVISORY_LOCK_NAMESPACE))
+        return bool(self.env.cr.fetchone())
+
+    @api.model
+    def _get_in_flight(self, company_ids=None):
+        """ Counts the inbound syncs running in all the workers
+         :param company_ids: list of res.company ids, all if None
+         :return: dict {company id: number of running syncs}
+        """
+        self.env.cr.execute("""
+            SELECT objid::bigint / %s, count(*)
+            FROM pg_locks
+            WHERE locktype = 'advisory' AND classid = %s AND objsubid = 2
+              AND granted
+            GROUP BY 1
+        """, (MAX_SLOTS_PER_COMPANY, ADVISORY_LOCK_NAMESPACE))
+        in_flight = dict.fromkeys(company_ids or [], 0)
+        for company_id, count in self.env.cr.fetchall():
+            if company_ids is None or company_id in in_flight:
+                in_flight[company_id] = count
+        return in_flight
+
+    @api.model
+    def _get_retry_after(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            RETRY_AFTER_PARAM, DEFAULT_RETRY_AFTER))
+
+    @api.model
+    def get_load(self):
+        """ Gets the inbound sync load of the user's company, so CiviCRM
+         can adapt its push rate
+         :return: dict {'company_id': int, 'in_flight': int,
+                        'max_concurrent_syncs': int, 0 if unlimited}
+        """
+        company = self.env.user.company_id
+        return {
+            'company_id': company.id,
+            'in_flight': self._get_in_flight([company.id])[company.id],
+            'max_concurrent_syncs': company.civicrm_max_concurrent_syncs,
+        }
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import copy
+import json
+import random
+import time
+
+from psycopg2 import OperationalError
+
+import odoo
+from odoo import api
+from odoo.service.model import (
+    MAX_TRIES_ON_CONCURRENCY_FAILURE, PG_CONCURRENCY_ERRORS_TO_RETRY)
+
+from . import sync_log
+
+_logger = sync_log.getLogger(__name__)
+
+# Models synced by the batch endpoint, by entity name
+BATCH_MODELS = {
+    'contact': 'res.partner',
+    'contribution': 'account.invoice',
+}
+
+
+def iter_json_objects(chunks):
+    """ Decodes a JSON array of objects incrementally, so items can be
+     processed while the body is still being received
+     :param chunks: iterable of UTF-8 encoded bytes chunks
+     :return: generator of dictionaries
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    # start: expects '[', first: '{' or ']', item: '{', next: ',' or ']'
+    state = 'start'
+    while True:
+        buffer = buffer.lstrip()
+        if buffer and state == 'end':
+            raise ValueError('Unexpected data after the JSON array')
+        if buffer:
+            char = buffer[0]
+            if state == 'start' and char == '[':
+                buffer, state = buffer[1:], 'first'
+                continue
+            if state in ('first', 'next') and char == ']':
+                buffer, state = buffer[1:], 'end'
+                continue
+            if state == 'next' and char == ',':
+                buffer, state = buffer[1:], 'item'
+                continue
+            if state not in ('first', 'item') or char != '{':
+                raise ValueError('A JSON array of objects is expected')
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # Incomplete object, wait for the next chunk
+                pass
+            else:
+                buffer, state = buffer[end:], 'next'
+                yield item
+                continue
+        chunk = next(chunks, None)
+        if chunk is None:
+            if state != 'end' or buffer.strip():
+                raise ValueError('Incomplete or invalid JSON array')
+            return
+        buffer += text_decoder.decode(chunk)
+
+
+def get_compact_response(response):
+    """ Removes empty values from a sync response
+     :param response: dictionary response of civicrm_sync
+     :return: dictionary
+    """
+    return {key: value for key, value in response.items()
+            if value is not None and value != [] and value != ''}
+
+
+def iter_batch_results(dbname, uid, entity, items, context=None):
+    """ Syncs items one by one, each in its own transaction like an
+     XML-RPC call, with one cursor for the whole batch. Items failing on a
+     concurrent update are retried like Odoo retries RPC calls.
+     :param dbname: str database name
+     :param uid: int id of the authenticated user
+     :param entity: str key of BATCH_MODELS
+     :param items: iterable of input parameter dictionaries
+     :param context: dictionary context of the syncs
+     :return: generator of compact response dictionaries
+    """
+    model = BATCH_MODELS[entity]
+    with api.Environment.manage(), \
+            odoo.registry(dbname).cursor() as cr:
+        env = api.Environment(cr, uid, context or {})
+        for item in items:
+            yield get_compact_response(_sync_item(env, model, item))
+
+
+def _sync_item(env, model, item):
+    """ Syncs one item and commits it
+     :param env: Environment of the batch cursor
+     :param model: str model name
+     :param item: dictionary input parameters
+     :return: dictionary response
+    """
+    cr = env.cr
+    for tries in range(1, MAX_TRIES_ON_CONCURRENCY_FAILURE + 1):
+        try:
+            response = env[model].civicrm_sync(copy.deepcopy(item))
+            cr.commit()
+            return response
+        except OperationalError as error:
+            cr.rollback()
+            if error.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY or \
+                    tries == MAX_TRIES_ON_CONCURRENCY_FAILURE:
+                return _get_error_response(item, error)
+            time.sleep(random.uniform(0.0, 2 ** tries))
+        except Exception as error:
+            cr.rollback()
+            _logger.warning('batch item sync failed', model=model,
+                            civicrm_id=item.get('x_civicrm_id'), error=error)
+            return _get_error_response(item, error)
+        finally:
+            # The next item is a new transaction, like a new RPC call
+            env.clear()
+
+
+def _get_error_response(item, error):
+    return {
+        'is_error': 1,
+        'error_log': [str(error)],
+        'x_civicrm_id': item.get('x_civicrm_id'),
+        'timestamp': int(time.time()),
+    }
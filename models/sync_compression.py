@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import zlib
+
+# Bodies smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = 256
+
+# Supported content encodings, preferred first
+ENCODINGS = ('gzip', 'deflate')
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+def compress(data, encoding='gzip'):
+    """ Compresses a body
+     :param data: bytes
+     :param encoding: str content encoding, 'gzip' or 'deflate'
+     :return: bytes
+    """
+    if encoding == 'gzip':
+        return gzip.compress(data)
+    if encoding == 'deflate':
+        return zlib.compress(data)
+    raise UnsupportedEncoding(
+        'Unsupported content encoding: {}'.format(encoding))
+
+
+def decompress(data, encoding, max_size=None):
+    """ Decompresses a body according to its Content-Encoding header
+     :param data: bytes
+     :param encoding: str Content-Encoding header value, may be empty
+     :param max_size: int maximal size of the decompressed body
+     :return: bytes
+    """
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return data
+    if encoding in ('gzip', 'x-gzip'):
+        wbits = [16 + zlib.MAX_WBITS]
+    elif encoding == 'deflate':
+        # Some clients send raw deflate data without zlib header
+        wbits = [zlib.MAX_WBITS, -zlib.MAX_WBITS]
+    else:
+        raise UnsupportedEncoding(
+            'Unsupported content encoding: {}'.format(encoding))
+    for index, bits in enumerate(wbits):
+        decompressor = zlib.decompressobj(bits)
+        try:
+            result = decompressor.decompress(
+                data, max_size + 1 if max_size else 0)
+        except zlib.error:
+            if index == len(wbits) - 1:
+                raise
+            continue
+        if max_size and len(result) > max_size:
+            raise ValueError('Decompressed body exceeds {} bytes'.format(
+                max_size))
+        return result
+
+
+def get_accepted_encoding(accept_encoding):
+    """ Chooses the encoding of a response from the Accept-Encoding header
+     :param accept_encoding: str Accept-Encoding header value, may be empty
+     :return: str encoding or None to answer uncompressed
+    """
+    accepted = set()
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().lower().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0'):
+            continue
+        accepted.add(name.strip())
+    for encoding in ENCODINGS:
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+def iter_decompressed(stream, encoding, chunk_size=65536, max_size=None):
+    """ Reads and decompresses a body by chunks
+     :param stream: file-like object of the body
+     :param encoding: str Content-Encoding header value, may be empty
+     :param chunk_size: int number of bytes read at once
+     :param max_size: int maximal size of the decompressed body
+     :return: generator of bytes chunks
+    """
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding not in ('identity', 'gzip', 'x-gzip', 'deflate'):
+        raise UnsupportedEncoding(
+            'Unsupported content encoding: {}'.format(encoding))
+    decompressor = None
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if encoding != 'identity':
+            if decompressor is None:
+                decompressor = zlib.decompressobj(
+                    _get_wbits(encoding, chunk))
+            chunk = decompressor.decompress(chunk)
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise ValueError('Decompressed body exceeds {} bytes'.format(
+                max_size))
+        yield chunk
+    if decompressor is not None:
+        yield decompressor.flush()
+
+
+def _get_wbits(encoding, head):
+    """ Gets the zlib window bits of a compressed body. Deflate bodies
+     without zlib header are accepted.
+    """
+    if encoding != 'deflate':
+        return 16 + zlib.MAX_WBITS
+    if len(head) >= 2 and head[0] & 0x0F == 8 and \
+            (head[0] * 256 + head[1]) % 31 == 0:
+        return zlib.MAX_WBITS
+    return -zlib.MAX_WBITS
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import hashlib
+import json
+
+from odoo import api, fields, models, _
+
+from . import sync_log
+
+_logger = sync_log.getLogger(__name__)
+
+# Number of hours a completed sync response is replayed to retried calls
+TTL_PARAM = 'odoo_civicrm_sync.idempotency_ttl_hours'
+DEFAULT_TTL_HOURS = 24
+
+# Input parameters used only for the idempotency key, by entity
+INTERNAL_FIELDS = {}
+
+
+def get_idempotency_key(entity, input_params, timestamp_field):
+    """ Gets the idempotency key of an inbound call. Uses the key sent by
+     CiviCRM, else the entity id with its CiviCRM modification timestamp,
+     else the content of the call.
+     :param entity: str, name of the synced entity
+     :param input_params: dictionary of input parameters
+     :param timestamp_field: name of the CiviCRM modification timestamp
+     :return: str, sha1 hex digest
+    """
+    key = input_params.pop('idempotency_key', None)
+    if key:
+        source = 'key:{}'.format(key)
+    elif input_params.get('x_civicrm_id') and \
+            input_params.get(timestamp_field):
+        source = 'id:{}:{}'.format(input_params['x_civicrm_id'],
+                                   input_params[timestamp_field])
+    else:
+        source = 'content:{}'.format(json.dumps(
+            input_params, sort_keys=True, default=str))
+    return hashlib.sha1('{}:{}'.format(entity, source).encode(
+        'utf-8')).hexdigest()
+
+
+def strip_internal_fields(entity, input_params):
+    """ Removes the input parameters used only for the idempotency key,
+     e.g. from a journaled payload which is replayed without its key
+     :param entity: str, name of the synced entity
+     :param input_params: dictionary of input parameters
+     :return: dictionary input parameters
+    """
+    if isinstance(input_params, dict):
+        for field in INTERNAL_FIELDS.get(entity, ('idempotency_key',)):
+            input_params.pop(field, None)
+    return input_params
+
+
+def idempotent(entity, timestamp_field, internal_fields=()):
+    """ Decorator answering retried civicrm_sync calls with the stored
+     response of the first successful call
+     :param entity: str, name of the synced entity
+     :param timestamp_field: name of the CiviCRM modification timestamp
+     :param internal_fields: input parameters used only for the key, which
+                             are removed before the call is processed
+    """
+    INTERNAL_FIELDS[entity] = ('idempotency_key',) + tuple(internal_fields)
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, input_params, *args, **kwargs):
+            if not isinstance(input_params, dict) or \
+                    self.env.context.get('civicrm_sync_replay'):
+                return method(self, input_params, *args, **kwargs)
+            key = get_idempotency_key(entity, input_params, timestamp_field)
+            for field in internal_fields:
+                input_params.pop(field, None)
+            idempotency = self.env['civicrm.sync.idempotency']
+            response = idempotency._claim(entity, key)
+            if response is not None:
+                _logger.debug('replayed sync response', key=key)
+                return response
+            response = method(self, input_params, *args, **kwargs)
+            idempotency._complete(key, response)
+            return response
+        return wrapper
+    return decorator
+
+
+class CivicrmSyncIdempotency(models.Model):
+    _name = 'civicrm.sync.idempotency'
+    _description = 'CiviCRM Sync Idempotency Key'
+    _log_access = False
+
+    key = fields.Char(string='Key', size=40, required=True)
+    entity = fields.Char(string='Entity', required=True)
+    state = fields.Selection([
+        ('running', 'Running'),
+        ('done', 'Done'),
+    ], string='State', required=True, default='running')
+    response = fields.Text(string='Response')
+    expires_at = fields.Datetime(string='Expires At', required=True,
+                                 index=True)
+
+    _sql_constraints = [
+        ('key_uniq', 'unique(key)', _('The idempotency key must be unique')),
+    ]
+
+    @api.model
+    def _get_ttl_hours(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            TTL_PARAM, DEFAULT_TTL_HOURS))
+
+    @api.model
+    def _claim(self, entity, key):
+        """ Claims the key for the current call. The key row is inserted
+         in the call transaction, so a concurrent call with the same key
+         waits on the unique index until the first one is committed and
+         is then retried by Odoo with the stored response visible.
+         :param entity: str, name of the synced entity
+         :param key: str idempotency key
+         :return: stored response or None if the call has to be processed
+        """
+        cr = self.env.cr
+        ttl = '{} hours'.format(self._get_ttl_hours())
+        cr.execute("""
+            INSERT INTO civicrm_sync_idempotency
+                (key, entity, state, expires_at)
+            VALUES (%s, %s, 'running',
+                    (now() AT TIME ZONE 'UTC') + %s::interval)
+            ON CONFLICT (key) DO NOTHING
+            RETURNING id
+        """, (key, entity, ttl))
+        if cr.fetchone():
+            return None
+
+        cr.execute("""
+            SELECT state, response,
+                   expires_at < (now() AT TIME ZONE 'UTC')
+            FROM civicrm_sync_idempotency
+            WHERE key = %s
+            FOR UPDATE
+        """, (key,))
+        row = cr.fetchone()
+        if not row:
+            return None
+        state, response, expired = row
+        if state == 'done' and not expired:
+            return json.loads(response)
+        cr.execute("""
+            UPDATE civicrm_sync_idempotency
+            SET state = 'running', response = NULL,
+                expires_at = (now() AT TIME ZONE 'UTC') + %s::interval
+            WHERE key = %s
+        """, (ttl, key))
+        return None
+
+    @api.model
+    def _complete(self, key, response):
+        """ Stores the response of a successful call, releases the key of a
+         failed or deferred one so it is processed again when CiviCRM
+         retries it
+         :param key: str idempotency key
+         :param response: dictionary response of the call
+         :return: void
+        """
+        try:
+            if response.get('is_error') or response.get('deferred'):
+                self.env.cr.execute("""
+                    DELETE FROM civicrm_sync_idempotency WHERE key = %s
+                """, (key,))
+            else:
+                self.env.cr.execute("""
+                    UPDATE civicrm_sync_idempotency
+                    SET state = 'done', response = %s
+                    WHERE key = %s
+                """, (json.dumps(response, separators=(',', ':'),
+                                 default=str), key))
+        except Exception as error:
+            # The transaction is already aborted and the claim is rolled
+            # back with it
+            _logger.warning('idempotency key not stored', key=key,
+                            error=error)
+
+    @api.model
+    def cron_evict(self):
+        """ Deletes expired idempotency keys """
+        self.env.cr.execute("""
+            DELETE FROM civicrm_sync_idempotency
+            WHERE expires_at < (now() AT TIME ZONE 'UTC')
+        """)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import gzip
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from odoo import api, fields, models
+from odoo.tools import config
+from odoo.tools import DEFAULT_SERVER_DATETIME_FORMAT as DATETIME_FORMAT
+
+from . import sync_log
+from .sync_batch import BATCH_MODELS, iter_batch_results
+from .sync_idempotency import strip_internal_fields
+
+_logger = sync_log.getLogger(__name__)
+
+# Directory of the journal segments in the database filestore
+JOURNAL_DIRECTORY = 'civicrm_sync_journal'
+
+# A new segment is started when the current one reaches this size or was
+# started on a previous day
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+
+# Number of days payloads are kept
+RETENTION_PARAM = 'odoo_civicrm_sync.journal_retention_days'
+DEFAULT_RETENTION_DAYS = 30
+
+# Number of payloads replayed by one replay call, which must end well
+# within the time limits of an RPC request
+REPLAY_PAGE_SIZE = 100
+
+
+class SyncJournal(object):
+    """ Process wide writer of the inbound payload journal. Each process
+     appends to its own segment file, each payload being a separate gzip
+     member, so a payload can be read alone from its position and a segment
+     can be read with any gzip reader.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._segments = {}
+
+    def append(self, dbname, data):
+        """ Appends a payload to the current segment of the database
+         :param dbname: str database name
+         :param data: bytes payload
+         :return: (segment name, position, length) of the payload
+        """
+        member = gzip.compress(data)
+        with self._lock:
+            segment = self._get_segment(dbname, len(member))
+            position = segment.tell()
+            segment.write(member)
+            segment.flush()
+            return os.path.basename(segment.name), position, len(member)
+
+    def _get_segment(self, dbname, size):
+        segment = self._segments.get(dbname)
+        today = time.strftime('%Y%m%d')
+        if segment and (segment.tell() + size > SEGMENT_MAX_BYTES or
+                        not os.path.basename(segment.name).startswith(today)):
+            segment.close()
+            segment = None
+        if not segment:
+            directory = get_journal_directory(dbname)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            name = '{}-{}-{}.gz'.format(time.strftime('%Y%m%d%H%M%S'),
+                                        socket.gethostname(), os.getpid())
+            segment = open(os.path.join(directory, name), 'ab')
+            self._segments[dbname] = segment
+        return segment
+
+
+journal = SyncJournal()
+
+
+def get_journal_directory(dbname):
+    return os.path.join(config.filestore(dbname), JOURNAL_DIRECTORY)
+
+
+def journaled(entity):
+    """ Decorator appending the inbound civicrm_sync payload to the journal
+     before it is processed. Replayed payloads are not journaled again.
+     :param entity: str, name of the synced entity
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, input_params, *args, **kwargs):
+            if not self.env.context.get('civicrm_sync_replay'):
+                self.env['civicrm.sync.journal']._append(entity, input_params)
+            return method(self, input_params, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class CivicrmSyncJournal(models.Model):
+    """ Index of the journaled inbound payloads """
+    _name = 'civicrm.sync.journal'
+    _description = 'CiviCRM Sync Journal'
+    _log_access = False
+    _order = 'received_at, id'
+
+    entity = fields.Char(string='Entity', required=True, index=True)
+    civicrm_id = fields.Integer(string='CiviCRM Id', index=True)
+    received_at = fields.Datetime(string='Received At', required=True,
+                                  index=True)
+    segment = fields.Char(string='Segment', required=True, index=True)
+    position = fields.Integer(string='Position', required=True)
+    length = fields.Integer(string='Length', required=True)
+
+    @api.model
+    def _append(self, entity, input_params):
+        """ Journals an inbound payload. The index row is written with its
+         own cursor, so the payload stays journaled if the sync fails.
+         :param entity: str, name of the synced entity
+         :param input_params: payload of the sync
+         :return: void
+        """
+        try:
+            data = json.dumps(input_params, separators=(',', ':'),
+                              default=str).encode('utf-8')
+            segment, position, length = journal.append(self.env.cr.dbname,
+                                                       data)
+            civicrm_id = input_params.get('x_civicrm_id') \
+                if isinstance(input_params, dict) else None
+            with self.pool.cursor() as cr:
+                cr.execute("""
+                    INSERT INTO civicrm_sync_journal
+                        (entity, civicrm_id, received_at, segment, position,
+                         length)
+                    VALUES (%s, %s, now() AT TIME ZONE 'UTC', %s, %s, %s)
+                """, (entity, civicrm_id if isinstance(civicrm_id, int)
+                      else None, segment, position, length))
+        except Exception as error:
+            _logger.warning('payload not journaled', entity=entity,
+                            error=error)
+
+    @api.multi
+    def _read_payloads(self):
+        """ Reads the journaled payloads, opening each segment once
+         :return: generator of (journal record, payload)
+        """
+        directory = get_journal_directory(self.env.cr.dbname)
+        segments = {}
+        try:
+            for record in self:
+                segment = segments.get(record.segment)
+                if segment is None:
+                    segment = segments[record.segment] = open(
+                        os.path.join(directory, record.segment), 'rb')
+                segment.seek(record.position)
+                data = gzip.decompress(segment.read(record.length))
+                yield record, json.loads(data.decode('utf-8'))
+        finally:
+            for segment in segments.values():
+                segment.close()
+
+    @api.model
+    def replay(self, entity=None, civicrm_ids=None, date_from=None,
+               date_to=None, after=None, limit=REPLAY_PAGE_SIZE):
+        """ Syncs a page of journaled payloads again, in the order they were
+         received, through the batch sync path. Replayed calls bypass the
+         idempotency keys and are not journaled again. The next page is
+         replayed by calling again with the returned resume point.
+         :param entity: str 'contact' or 'contribution', all if None
+         :param civicrm_ids: list of CiviCRM ids, all if None
+         :param date_from: str, first received time in DATETIME_FORMAT
+         :param date_to: str, last received time in DATETIME_FORMAT
+         :param after: [received time, id] resume point of the previous page,
+                       None for the first page
+         :param limit: int, number of journaled payloads of the page
+         :return: dict {'processed': int, 'errors': int,
+                        'after': resume point, False after the last page}
+        """
+        self.check_access_rights('read')
+        domain = []
+        if entity:
+            domain.append(('entity', '=', entity))
+        if civicrm_ids:
+            domain.append(('civicrm_id', 'in', civicrm_ids))
+        if date_from:
+            domain.append(('received_at', '>=', date_from))
+        if date_to:
+            domain.append(('received_at', '<=', date_to))
+        if after:
+            received_at, last_id = after
+            domain += ['|', ('received_at', '>', received_at),
+                       '&', ('received_at', '=', received_at),
+                       ('id', '>', last_id)]
+        records = self.sudo().search(domain, limit=limit)
+
+        context = {'civicrm_sync_replay': True}
+        processed = errors = 0
+        payloads = ((record.entity,
+                     strip_internal_fields(record.entity, payload))
+                    for record, payload in records._read_payloads()
+                    if record.entity in BATCH_MODELS)
+        # Runs of consecutive payloads of the same entity go in one batch
+        for run_entity, run in groupby(payloads, key=lambda item: item[0]):
+            for result in iter_batch_results(
+                    self.env.cr.dbname, self.env.uid, run_entity,
+                    (payload for _, payload in run), context=context):
+                processed += 1
+                errors += bool(result.get('is_error'))
+        last = records[-1:] if len(records) == limit else None
+        resume = [last.received_at, last.id] if last else False
+        _logger.info('journal replayed', processed=processed, errors=errors,
+                     after=resume)
+        return {'processed': processed, 'errors': errors, 'after': resume}
+
+    @api.model
+    def cron_evict(self):
+        """ Deletes the segments whose payloads are all older than the
+         retention period, and their index rows
+        """
+        days = int(self.env['ir.config_parameter'].sudo().get_param(
+            RETENTION_PARAM, DEFAULT_RETENTION_DAYS))
+        cutoff = (datetime.utcnow() - timedelta(days=days)).strftime(
+            DATETIME_FORMAT)
+        self.env.cr.execute("""
+            SELECT segment FROM civicrm_sync_journal
+            GROUP BY segment
+            HAVING max(received_at) < %s
+        """, (cutoff,))
+        segments = [row[0] for row in self.env.cr.fetchall()]
+        if not segments:
+            return
+        self.env.cr.execute("""
+            DELETE FROM civicrm_sync_journal WHERE segment IN %s
+        """, (tuple(segments),))
+        directory = get_journal_directory(self.env.cr.dbname)
+
+        def remove_segments():
+            for segment in segments:
+                try:
+                    os.remove(os.path.join(directory, segment))
+                except OSError as error:
+                    _logger.warning('journal segment not removed',
+                                    segment=segment, error=error)
+        # Files are removed only once their index rows are deleted
+        self.env.cr.after('commit', remove_segments)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import functools
+from contextlib import contextmanager
+
+# Context of the integration writes in lightweight mode: no field tracking,
+# no followers subscription and no creation message
+LIGHTWEIGHT_CONTEXT = {
+    'tracking_disable': True,
+    'mail_notrack': True,
+    'mail_create_nolog': True,
+    'mail_create_nosubscribe': True,
+    'civicrm_sync_lightweight': True,
+}
+
+
+def lightweight(method):
+    """ Decorator running an inbound civicrm_sync call in lightweight mode
+     when the company of the user enables it
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.env.user.company_id.civicrm_lightweight_sync:
+            self = self.with_context(**LIGHTWEIGHT_CONTEXT)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def is_lightweight(env):
+    return bool(env.context.get('civicrm_sync_lightweight'))
+
+
+@contextmanager
+def deferred_recompute(model):
+    """ Defers the recomputation of stored fields to the end of the block in
+     lightweight mode, so a batch of writes recomputes them once. Fields
+     read in the block are still computed on the fly.
+     :param model: any model of the environment
+    """
+    if not is_lightweight(model.env):
+        yield
+        return
+    try:
+        with model.env.norecompute():
+            yield
+    finally:
+        model.recompute()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import itertools
+import json
+import logging
+import threading
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+from odoo.tools import config
+
+# Odoo configuration file option switching sync logs to JSON lines
+JSON_OUTPUT_OPTION = 'civicrm_sync_log_json'
+
+_local = threading.local()
+
+
+def _format_value(value):
+    """ Formats log field value, recordsets are reduced to model and ids
+     :param value: any value
+     :return: str
+    """
+    if hasattr(value, '_name') and hasattr(value, 'ids'):
+        return '{}({})'.format(value._name, ','.join(map(str, value.ids)))
+    return value if isinstance(value, str) else repr(value)
+
+
+def _is_json_output():
+    return str(config.get(JSON_OUTPUT_OPTION, '')).lower() in \
+        ('1', 'true', 'yes')
+
+
+class _SyncLogMessage(object):
+    """ Log message formatted only when a handler emits it """
+    __slots__ = ('event', 'fields', 'correlation')
+
+    def __init__(self, event, fields, correlation):
+        self.event = event
+        self.fields = fields
+        self.correlation = correlation
+
+    def __str__(self):
+        if _is_json_output():
+            record = dict(self.correlation, event=self.event)
+            record.update((key, _format_value(value))
+                          for key, value in self.fields.items())
+            return json.dumps(record, default=str, sort_keys=True)
+        items = sorted(self.correlation.items()) + sorted(self.fields.items())
+        return ' '.join([self.event] + ['{}={}'.format(
+            key, _format_value(value)) for key, value in items])
+
+
+class SyncLogger(object):
+    """ Logger of the sync steps. Takes an event name and keyword fields
+     instead of a preformatted message, so nothing is formatted unless the
+     level is enabled, and adds the current correlation ids to each line.
+    """
+
+    def __init__(self, name):
+        self._logger = logging.getLogger(name)
+        self._counters = defaultdict(itertools.count)
+
+    def debug(self, event, sample=1, **fields):
+        self._log(logging.DEBUG, event, sample, fields)
+
+    def info(self, event, sample=1, **fields):
+        self._log(logging.INFO, event, sample, fields)
+
+    def warning(self, event, sample=1, **fields):
+        self._log(logging.WARNING, event, sample, fields)
+
+    def error(self, event, sample=1, **fields):
+        self._log(logging.ERROR, event, sample, fields)
+
+    def _log(self, level, event, sample, fields):
+        """ Logs one out of every 'sample' messages of the event
+         :param level: logging level
+         :param event: str event name
+         :param sample: int sampling rate
+         :param fields: dictionary of fields to log
+        """
+        if not self._logger.isEnabledFor(level):
+            return
+        if sample > 1 and next(self._counters[event]) % sample:
+            return
+        self._logger.log(level, _SyncLogMessage(
+            event, fields, dict(getattr(_local, 'correlation', None) or {})))
+
+
+def getLogger(name):
+    return SyncLogger(name)
+
+
+@contextmanager
+def correlate(**ids):
+    """ Opens correlation scope: all sync log lines inside carry the same
+     correlation id ('cid') and the given entity ids. Nested scopes keep
+     the correlation id of the outer one.
+     :param ids: entity ids, e.g. contribution=12
+    """
+    parent = getattr(_local, 'correlation', None)
+    correlation = dict(parent or {'cid': uuid.uuid4().hex[:12]})
+    correlation.update((key, value) for key, value in ids.items()
+                       if value is not None)
+    _local.correlation = correlation
+    try:
+        yield correlation
+    finally:
+        _local.correlation = parent
+
+
+def bind(**ids):
+    """ Adds entity ids to the current correlation scope
+     :param ids: entity ids, e.g. invoice=3
+    """
+    correlation = getattr(_local, 'correlation', None)
+    if correlation is not None:
+        correlation.update((key, _format_value(value) if hasattr(
+            value, 'ids') else value) for key, value in ids.items())
+
+
+def correlated(entity):
+    """ Decorator opening correlation scope for civicrm_sync methods,
+     bound to the CiviCRM id of the synced entity
+     :param entity: str, name of the synced entity
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, input_params, *args, **kwargs):
+            civicrm_id = input_params.get('x_civicrm_id') \
+                if isinstance(input_params, dict) else None
+            with correlate(**{entity: civicrm_id}):
+                return method(self, input_params, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+
+from odoo import api, fields, models, _
+
+from . import sync_log
+
+_logger = sync_log.getLogger(__name__)
+
+# Models carrying an x_civicrm_id, by mapped entity
+MAPPED_MODELS = {
+    'contact': 'res.partner',
+    'contribution': 'account.invoice',
+    'line': 'account.invoice.line',
+    'payment': 'account.payment',
+}
+
+# Company of the records by mapped entity, as an SQL expression. CiviCRM ids
+# of contributions, line items and payments are per company, each company
+# syncing with its own CiviCRM instance. Contacts are unique across the
+# companies, like the partner CiviCRM id, and mapped with company 0.
+MAPPED_COMPANIES = {
+    'contact': '0',
+    'contribution': 'coalesce(company_id, 0)',
+    'line': 'coalesce(company_id, 0)',
+    'payment': '(SELECT coalesce(j.company_id, 0) FROM account_journal j '
+               'WHERE j.id = journal_id)',
+}
+
+MAPPING_ENTITIES = [
+    ('contact', 'Contact'),
+    ('contribution', 'Contribution'),
+    ('line', 'Line Item'),
+    ('payment', 'Payment'),
+]
+
+# Maps new records, the newest record of a CiviCRM id being the current one
+# and the previous ones being superseded, e.g. an invoice by its refund
+MAP_QUERY = """
+    INSERT INTO civicrm_sync_mapping AS m
+        (entity, company_id, civicrm_id, res_id, superseded_ids)
+    SELECT %s, company_id, civicrm_id, res_id, NULLIF(superseded_ids, '')
+    FROM unnest(%s::int[], %s::int[], %s::int[], %s::varchar[])
+        AS t(company_id, civicrm_id, res_id, superseded_ids)
+    ON CONFLICT (entity, company_id, civicrm_id) DO UPDATE SET
+        res_id = GREATEST(m.res_id, EXCLUDED.res_id),
+        superseded_ids = CASE
+            WHEN EXCLUDED.res_id = m.res_id THEN m.superseded_ids
+            WHEN EXCLUDED.res_id > m.res_id THEN concat_ws(
+                ',', m.superseded_ids, m.res_id, EXCLUDED.superseded_ids)
+            ELSE concat_ws(',', m.superseded_ids, EXCLUDED.res_id,
+                           EXCLUDED.superseded_ids)
+        END
+"""
+
+# Rebuilds the mappings of CiviCRM ids from the records
+REMAP_QUERY = """
+    INSERT INTO civicrm_sync_mapping AS m
+        (entity, company_id, civicrm_id, res_id, superseded_ids)
+    SELECT %(entity)s, company_id, civicrm_id, ids[array_length(ids, 1)],
+           NULLIF(array_to_string(ids[1:array_length(ids, 1) - 1], ','), '')
+    FROM (SELECT {company} AS company_id, x_civicrm_id AS civicrm_id,
+                 array_agg(id ORDER BY id) AS ids
+          FROM {table}
+          WHERE x_civicrm_id IN %(civicrm_ids)s
+          GROUP BY 1, x_civicrm_id) AS records
+    ON CONFLICT (entity, company_id, civicrm_id) DO UPDATE SET
+        res_id = EXCLUDED.res_id,
+        superseded_ids = EXCLUDED.superseded_ids
+"""
+
+
+class CivicrmSyncMapping(models.Model):
+    """ Odoo record of each CiviCRM id, kept up to date on create, write and
+     unlink of the synced models, so a CiviCRM id is resolved with one
+     indexed lookup. The current record of a CiviCRM id is its newest
+     record, the older ones, e.g. a refunded invoice, are superseded.
+     CiviCRM ids are mapped per company, see MAPPED_COMPANIES, and looked
+     up in the company of the user.
+    """
+    _name = 'civicrm.sync.mapping'
+    _description = 'CiviCRM Id Mapping'
+    _log_access = False
+
+    entity = fields.Selection(MAPPING_ENTITIES, string='Entity',
+                              required=True)
+    company_id = fields.Integer(string='Company Id', required=True,
+                                default=0,
+                                help='Company of the record, 0 for contacts '
+                                     'which are shared by the companies')
+    civicrm_id = fields.Integer(string='CiviCRM Id', required=True)
+    res_id = fields.Integer(string='Record Id', required=True)
+    superseded_ids = fields.Char(string='Superseded Record Ids',
+                                 help='Comma separated ids of the previous '
+                                      'records of the CiviCRM id')
+
+    _sql_constraints = [
+        ('entity_company_civicrm_id_uniq',
+         'unique(entity, company_id, civicrm_id)',
+         _('A CiviCRM id can be mapped only once per entity and company')),
+    ]
+
+    @api.model
+    def _get_company_key(self, entity, company_id=None):
+        """ Gets the company under which the CiviCRM ids of an entity are
+         mapped
+         :param entity: str key of MAPPED_MODELS
+         :param company_id: int res.company id, the user's company if None
+         :return: int res.company id, 0 for contacts
+        """
+        if MAPPED_COMPANIES[entity] == '0':
+            return 0
+        return company_id or self.env.user.company_id.id
+    @api.model
+    def _get_res_ids(self, entity, civicrm_ids, company_id=None):
+        """ Gets the current records of CiviCRM ids with one query
+         :param entity: str key of MAPPED_MODELS
+         :param civicrm_ids: list of CiviCRM ids
+         :param company_id: int res.company id, the user's company if None
+         :return: dict {CiviCRM id: record id} of the mapped ids
+        """
+        civicrm_ids = [civicrm_id for civicrm_id in civicrm_ids
+                       if isinstance(civicrm_id, int) and civicrm_id]
+        if not civicrm_ids:
+            return {}
+        self.env.cr.execute("""
+            SELECT civicrm_id, res_id FROM civicrm_sync_mapping
+            WHERE entity = %s AND company_id = %s AND civicrm_id IN %s
+        """, (entity, self._get_company_key(entity, company_id),
+              tuple(civicrm_ids)))
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _get_record(self, entity, civicrm_id, company_id=None):
+        """ Gets the current record of a CiviCRM id
+         :param entity: str key of MAPPED_MODELS
+         :param civicrm_id: int CiviCRM id
+         :param company_id: int res.company id, the user's company if None
+         :return: record, empty if the id is not mapped
+        """
+        res_id = self._get_res_ids(entity, [civicrm_id], company_id).get(
+            civicrm_id)
+        return self.env[MAPPED_MODELS[entity]].browse(res_id or [])
+
+    @api.model
+    def _map(self, entity, records):
+        """ Maps new records having a CiviCRM id
+         :param entity: str key of MAPPED_MODELS
+         :param records: records of the entity model
+         :return: void
+        """
+        per_company = MAPPED_COMPANIES[entity] != '0'
+        ids_by_key = defaultdict(list)
+        for record in records:
+            if record.x_civicrm_id:
+                company_id = (record.company_id.id or 0) if per_company else 0
+                ids_by_key[company_id, record.x_civicrm_id].append(record.id)
+        if not ids_by_key:
+            return
+        company_ids, civicrm_ids, res_ids, superseded_ids = [], [], [], []
+        for (company_id, civicrm_id), ids in ids_by_key.items():
+            ids.sort()
+            company_ids.append(company_id)
+            civicrm_ids.append(civicrm_id)
+            res_ids.append(ids[-1])
+            superseded_ids.append(','.join(str(id_) for id_ in ids[:-1]))
+        self.env.cr.execute(MAP_QUERY, (entity, company_ids, civicrm_ids,
+                                        res_ids, superseded_ids))
+
+    @api.model
+    def _remap(self, entity, civicrm_ids):
+        """ Rebuilds the mappings of CiviCRM ids from the records, after
+         records were deleted or their CiviCRM id changed
+         :param entity: str key of MAPPED_MODELS
+         :param civicrm_ids: collection of CiviCRM ids
+         :return: void
+        """
+        civicrm_ids = tuple(civicrm_id for civicrm_id in civicrm_ids
+                            if civicrm_id)
+        if not civicrm_ids:
+            return
+        table = self.env[MAPPED_MODELS[entity]]._table
+        self.env.cr.execute("""
+            DELETE FROM civicrm_sync_mapping
+            WHERE entity = %s AND civicrm_id IN %s
+        """, (entity, civicrm_ids))
+        self.env.cr.execute(REMAP_QUERY.format(
+            table=table, company=MAPPED_COMPANIES[entity]), {
+            'entity': entity, 'civicrm_ids': civicrm_ids})
+        _logger.debug('civicrm ids remapped', entity=entity,
+                      civicrm_ids=civicrm_ids)
+
+    @api.model
+    def _get_civicrm_ids(self, entity, records):
+        """ Reads the stored CiviCRM ids of records, before they change
+         :param entity: str key of MAPPED_MODELS
+         :param records: records of the entity model
+         :return: dict {record id: CiviCRM id}
+        """
+        if not records.ids:
+            return {}
+        self.env.cr.execute("""
+            SELECT id, x_civicrm_id FROM {}
+            WHERE id IN %s AND x_civicrm_id IS NOT NULL AND x_civicrm_id != 0
+        """.format(self.env[MAPPED_MODELS[entity]]._table),
+            (tuple(records.ids),))
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _update(self, entity, records, old_civicrm_ids):
+        """ Updates the mappings of records whose CiviCRM id was written
+         :param entity: str key of MAPPED_MODELS
+         :param records: written records of the entity model
+         :param old_civicrm_ids: dict {record id: CiviCRM id} before write
+         :return: void
+        """
+        changed = records.filtered(
+            lambda record: record.x_civicrm_id != old_civicrm_ids.get(
+                record.id, 0))
+        if not changed:
+            return
+        self._remap(entity, {old_civicrm_ids[record.id] for record in changed
+                             if record.id in old_civicrm_ids})
+        self._map(entity, changed)
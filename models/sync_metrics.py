@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the latency histogram buckets
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Minimal number of seconds between two flushes of the in-memory counters
+FLUSH_INTERVAL = 30
+
+METRIC_TYPES = {
+    'civicrm_sync_inbound_total': (
+        'counter', 'Inbound CiviCRM syncs processed'),
+    'civicrm_sync_inbound_errors_total': (
+        'counter', 'Inbound CiviCRM syncs answered with an error'),
+    'civicrm_sync_inbound_duration_seconds': (
+        'histogram', 'Inbound CiviCRM sync processing time'),
+    'civicrm_sync_inbound_rejected_total': (
+        'counter', 'Inbound CiviCRM syncs rejected by the admission control'),
+    'civicrm_sync_inbound_in_flight': (
+        'gauge', 'Inbound CiviCRM syncs running by company'),
+    'civicrm_sync_inbound_deferred_total': (
+        'counter', 'Inbound CiviCRM contributions parked for their contact'),
+    'civicrm_sync_pending_contributions': (
+        'gauge', 'Contributions parked for their contact by state'),
+    'civicrm_sync_outbound_total': (
+        'counter', 'Payments pushed to CiviCRM'),
+    'civicrm_sync_outbound_failures_total': (
+        'counter', 'Payment pushes to CiviCRM which failed'),
+    'civicrm_sync_outbound_retries_total': (
+        'counter', 'Payment pushes to CiviCRM which were a retry'),
+    'civicrm_sync_outbound_lane_total': (
+        'counter', 'Payment pushes to CiviCRM by scheduler lane'),
+    'civicrm_sync_outbound_lane_seconds_total': (
+        'counter', 'Time spent by the payment sync in each scheduler lane'),
+    'civicrm_sync_outbound_request_duration_seconds': (
+        'histogram', 'HTTP request time of payment pushes to CiviCRM'),
+    'civicrm_sync_payments': (
+        'gauge', 'Payments by sync status'),
+    'civicrm_sync_oldest_awaiting_payment_age_seconds': (
+        'gauge', 'Age of the oldest payment awaiting sync'),
+    'civicrm_sync_payment_lane_size': (
+        'gauge', 'Payments due for sync by scheduler lane'),
+    'civicrm_sync_payment_lane_age_seconds': (
+        'gauge', 'Time the oldest payment due for sync waited by lane'),
+}
+
+OLDEST_AWAITING_TIMESTAMP = 'civicrm_sync_oldest_awaiting_payment_timestamp'
+LANE_OLDEST_TIMESTAMP = 'civicrm_sync_payment_lane_oldest_timestamp'
+
+# Gauges stored as a timestamp and rendered as an age
+AGE_GAUGES = {
+    OLDEST_AWAITING_TIMESTAMP:
+        'civicrm_sync_oldest_awaiting_payment_age_seconds',
+    LANE_OLDEST_TIMESTAMP: 'civicrm_sync_payment_lane_age_seconds',
+}
+
+# Payments due for sync by scheduler lane, with the time since they are due:
+# fresh payments since their creation, failed ones since their backoff ended
+LANE_BACKLOG_QUERY = """
+    SELECT CASE WHEN s.retry_count = 0 THEN 'fresh' ELSE 'retry' END,
+           count(*),
+           extract(epoch FROM min(CASE WHEN s.retry_count = 0
+                                       THEN p.create_date
+                                       ELSE coalesce(s.next_retry,
+                                                     s.last_retry)
+                                  END))
+    FROM account_payment_sync_state s
+    JOIN account_payment p ON p.id = s.payment_id
+    WHERE s.status = 'awaiting'
+      AND (s.retry_count = 0 OR s.next_retry IS NULL
+           OR s.next_retry <= (now() AT TIME ZONE 'UTC'))
+    GROUP BY 1
+"""
+
+UPSERT_COUNTER_QUERY = """
+    INSERT INTO civicrm_sync_metric (name, labels, value)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (name, labels)
+    DO UPDATE SET value = civicrm_sync_metric.value + EXCLUDED.value
+"""
+
+UPSERT_GAUGE_QUERY = """
+    INSERT INTO civicrm_sync_metric (name, labels, value)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (name, labels)
+    DO UPDATE SET value = EXCLUDED.value
+"""
+
+
+def _series_order(row):
+    """ Gets the sort key of a stored series, histogram buckets being
+     sorted by increasing upper bound with '+Inf' last
+     :param row: tuple (name, labels, value)
+     :return: tuple
+    """
+    name, labels = row[0], row[1]
+    bucket = re.search(r'(^|,)le="([^"]*)"', labels)
+    if not bucket:
+        return name, labels, 0.0
+    other_labels = labels[:bucket.start()] + labels[bucket.end():]
+    return name, other_labels.strip(','), float(bucket.group(2))
+
+
+def _format_labels(labels):
+    """ Formats labels in the Prometheus exposition format
+     :param labels: dictionary of labels
+     :return: str, e.g. 'entity="contact",le="0.5"'
+    """
+    return ','.join('{}="{}"'.format(key, labels[key])
+                    for key in sorted(labels))
+
+
+class SyncMetrics(object):
+    """ Process wide accumulator of the sync counters and histograms.
+     Values are kept in memory and added to the database rows on flush,
+     so recording a value never costs a query.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(float)
+        self._last_flush = time.time()
+
+    def inc(self, name, value=1.0, **labels):
+        """ Increments counter
+         :param name: metric name
+         :param value: increment
+         :param labels: metric labels
+        """
+        with self._lock:
+            self._pending[(name, _format_labels(labels))] += value
+
+    def observe(self, name, value, **labels):
+        """ Adds value to the histogram
+         :param name: metric name
+         :param value: observed value
+         :param labels: metric labels
+        """
+        with self._lock:
+            for bucket in HISTOGRAM_BUCKETS:
+                if value <= bucket:
+                    bucket_labels = dict(labels, le=bucket)
+                    self._pending[('{}_bucket'.format(name),
+                                   _format_labels(bucket_labels))] += 1
+            bucket_labels = dict(labels, le='+Inf')
+            self._pending[('{}_bucket'.format(name),
+                           _format_labels(bucket_labels))] += 1
+            self._pending[('{}_sum'.format(name),
+                           _format_labels(labels))] += value
+            self._pending[('{}_count'.format(name),
+                           _format_labels(labels))] += 1
+
+    def is_flush_due(self):
+        """ Checks whether the flush interval is elapsed
+         :return: bool
+        """
+        return time.time() - self._last_flush >= FLUSH_INTERVAL
+
+    def drain(self):
+        """ Pops the values accumulated since the last flush
+         :return: dictionary {(name, labels): value}
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+            self._last_flush = time.time()
+        return pending
+
+    def restore(self, pending):
+        """ Adds back drained values which could not be flushed
+         :param pending: dictionary {(name, labels): value}
+        """
+        with self._lock:
+            for key, value in pending.items():
+                self._pending[key] += value
+
+
+metrics = SyncMetrics()
+
+
+def observe_inbound_sync(entity):
+    """ Decorator recording count, errors and latency of an inbound
+     civicrm_sync method
+     :param entity: str, name of the synced entity
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start = time.time()
+            response = method(self, *args, **kwargs)
+            metrics.inc('civicrm_sync_inbound_total', entity=entity)
+            if response.get('is_error'):
+                metrics.inc('civicrm_sync_inbound_errors_total',
+                            entity=entity)
+            metrics.observe('civicrm_sync_inbound_duration_seconds',
+                            time.time() - start, entity=entity)
+            self.env['civicrm.sync.metric'].flush_if_due()
+            return response
+        return wrapper
+    return decorator
+
+
+class CivicrmSyncMetric(models.Model):
+    _name = 'civicrm.sync.metric'
+    _description = 'CiviCRM Sync Metric'
+    _order = 'name, labels'
+
+    name = fields.Char(string='Name', required=True, index=True)
+    labels = fields.Char(string='Labels', required=True, default='')
+    value = fields.Float(string='Value')
+
+    _sql_constraints = [
+        ('name_labels_uniq', 'unique(name, labels)',
+         _('The metric name and labels must be unique')),
+    ]
+
+    @api.model
+    def flush_if_due(self):
+        """ Flushes in-memory metrics if the flush interval is elapsed """
+        if metrics.is_flush_due():
+            self._flush_pending()
+
+    @api.model
+    def _flush_pending(self):
+        """ Adds the in-memory counters to the stored ones. Uses its own
+         cursor so the metric rows are never locked by a sync transaction.
+        """
+        pending = metrics.drain()
+        if not pending:
+            return
+        try:
+            with self.pool.cursor() as cr:
+                for (name, labels), value in sorted(pending.items()):
+                    cr.execute(UPSERT_COUNTER_QUERY, (name, labels, value))
+        except Exception as error:
+            # The values are flushed with the next flush
+            metrics.restore(pending)
+            _logger.warning('CiviCRM sync metrics flush failed: %s', error)
+
+    @api.model
+    def _refresh_backlog(self):
+        """ Stores the current payment backlog gauges """
+        cr = self.env.cr
+        cr.execute("""
+            SELECT status, count(*)
+            FROM account_payment_sync_state
+            WHERE status IS NOT NULL
+            GROUP BY status
+        """)
+        counts = dict(cr.fetchall())
+        for status in ('awaiting', 'synced', 'failed'):
+            cr.execute(UPSERT_GAUGE_QUERY, (
+                'civicrm_sync_payments',
+                _format_labels({'status': status}),
+                counts.get(status, 0)))
+
+        cr.execute("""
+            SELECT extract(epoch FROM min(p.create_date))
+            FROM account_payment_sync_state s
+            JOIN account_payment p ON p.id = s.payment_id
+            WHERE s.status = 'awaiting'
+        """)
+        oldest = cr.fetchone()[0]
+        cr.execute(UPSERT_GAUGE_QUERY,
+                   (OLDEST_AWAITING_TIMESTAMP, '', oldest or 0))
+
+        cr.execute(LANE_BACKLOG_QUERY)
+        lanes = {lane: (count, oldest)
+                 for lane, count, oldest in cr.fetchall()}
+        for lane in ('fresh', 'retry'):
+            count, oldest = lanes.get(lane, (0, None))
+            labels = _format_labels({'lane': lane})
+            cr.execute(UPSERT_GAUGE_QUERY,
+                       ('civicrm_sync_payment_lane_size', labels, count))
+            cr.execute(UPSERT_GAUGE_QUERY,
+                       (LANE_OLDEST_TIMESTAMP, labels, oldest or 0))
+
+        cr.execute("""
+            SELECT state, count(*) FROM civicrm_sync_pending GROUP BY state
+        """)
+        counts = dict(cr.fetchall())
+        for state in ('pending', 'failed'):
+            cr.execute(UPSERT_GAUGE_QUERY, (
+                'civicrm_sync_pending_contributions',
+                _format_labels({'state': state}), counts.get(state, 0)))
+
+        companies = self.env['res.company'].sudo().search([])
+        in_flight = self.env['civicrm.sync.admission']._get_in_flight(
+            companies.ids)
+        for company_id, count in in_flight.items():
+            cr.execute(UPSERT_GAUGE_QUERY, (
+                'civicrm_sync_inbound_in_flight',
+                _format_labels({'company': company_id}), count))
+
+    @api.model
+    def cron_flush(self):
+        """ Flushes in-memory metrics and refreshes the backlog gauges """
+        self._flush_pending()
+        self._refresh_backlog()
+
+    @api.model
+    def render_prometheus(self):
+        """ Renders stored metrics in the Prometheus text format
+         :return: str
+        """
+        self.env.cr.execute("""
+            SELECT name, labels, value
+            FROM civicrm_sync_metric
+        """)
+        lines = []
+        described = set()
+        for name, labels, value in sorted(self.env.cr.fetchall(),
+                                          key=_series_order):
+            if name in AGE_GAUGES:
+                name = AGE_GAUGES[name]
+                value = time.time() - value if value else 0
+            base_name = name
+            for suffix in ('_bucket', '_sum', '_count'):
+                if name.endswith(suffix) and \
+                        name[:-len(suffix)] in METRIC_TYPES:
+                    base_name = name[:-len(suffix)]
+            if base_name in METRIC_TYPES and base_name not in described:
+                metric_type, description = METRIC_TYPES[base_name]
+                lines.append('# HELP {} {}'.format(base_name, description))
+                lines.append('# TYPE {} {}'.format(base_name, metric_type))
+                described.add(base_name)
+            series = '{}{{{}}}'.format(name, labels) if labels else name
+            lines.append('{} {}'.format(series, repr(float(value))))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import json
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import odoo
+from odoo import api, fields, models, SUPERUSER_ID
+from odoo.tools import DEFAULT_SERVER_DATETIME_FORMAT as DATETIME_FORMAT
+
+from . import sync_log
+from .sync_batch import iter_batch_results
+
+_logger = sync_log.getLogger(__name__)
+
+# Seconds during which created contacts are coalesced before their pending
+# contributions are resolved, so a contact import resolves in few batches
+DEBOUNCE_SECONDS = 2
+
+# Maximal number of pending contributions resolved in one batch
+RESOLVE_BATCH_SIZE = 100
+
+# Minutes after which the contributions claimed by a resolution which died
+# can be claimed again
+LEASE_MINUTES = 30
+
+# Number of days a contribution stays parked before it is dropped
+TTL_PARAM = 'odoo_civicrm_sync.pending_ttl_days'
+DEFAULT_TTL_DAYS = 7
+
+PENDING_STATES = [
+    ('pending', 'Pending'),
+    ('failed', 'Failed'),
+]
+
+# Leases parked contributions whose contact exists and which are not leased
+# by another resolution. Rows locked by a concurrent claim are skipped.
+CLAIM_QUERY = """
+    WITH claimable AS (
+        SELECT p.id
+        FROM civicrm_sync_pending p
+        WHERE p.state = 'pending' AND p.id > %(after_id)s
+          AND (p.lease_until IS NULL
+               OR p.lease_until < (now() AT TIME ZONE 'UTC'))
+          AND EXISTS (SELECT 1 FROM civicrm_sync_mapping m
+                      WHERE m.entity = 'contact'
+                        AND m.civicrm_id = p.contact_civicrm_id)
+          {contact_filter}
+        ORDER BY p.id
+        LIMIT %(limit)s
+        FOR UPDATE OF p SKIP LOCKED
+    )
+    UPDATE civicrm_sync_pending p
+    SET lease_until = (now() AT TIME ZONE 'UTC') + %(lease)s::interval
+    FROM claimable
+    WHERE p.id = claimable.id
+    RETURNING p.id, p.user_id, p.payload
+"""
+
+
+class PendingResolver(object):
+    """ Resolves the contributions parked for missing contacts shortly after
+     the contacts are created. Contact ids are enqueued once their
+     transaction is committed and resolved by a background thread of the
+     worker process. Contacts lost with the process are resolved by the
+     scheduled action.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = defaultdict(set)
+        self._thread = None
+
+    def enqueue(self, dbname, contact_civicrm_ids):
+        """ Adds contacts to the next resolution
+         :param dbname: str database name
+         :param contact_civicrm_ids: list of CiviCRM contact ids
+        """
+        with self._condition:
+            self._pending[dbname].update(contact_civicrm_ids)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='odoo.civicrm_pending_resolver')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+            # Let the contacts of the next transactions join the batch
+            time.sleep(DEBOUNCE_SECONDS)
+            with self._condition:
+                pending, self._pending = self._pending, defaultdict(set)
+            for dbname, contact_civicrm_ids in pending.items():
+                self._resolve(dbname, sorted(contact_civicrm_ids))
+
+    def _resolve(self, dbname, contact_civicrm_ids):
+        threading.current_thread().dbname = dbname
+        try:
+            with api.Environment.manage(), \
+                    odoo.registry(dbname).cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                env['civicrm.sync.pending']._resolve(contact_civicrm_ids)
+        except Exception as error:
+            _logger.error('pending contributions not resolved',
+                          contacts=contact_civicrm_ids, error=error)
+
+
+resolver = PendingResolver()
+
+
+class CivicrmSyncPending(models.Model):
+    """ Contributions received before their contact, parked until the
+     contact is synced
+    """
+    _name = 'civicrm.sync.pending'
+    _description = 'CiviCRM Pending Contribution'
+    _log_access = False
+    _order = 'id'
+
+    contact_civicrm_id = fields.Integer(string='Contact CiviCRM Id',
+                                        required=True, index=True)
+    contribution_civicrm_id = fields.Integer(
+        string='Contribution CiviCRM Id', index=True)
+    user_id = fields.Many2one('res.users', string='User', required=True,
+                              ondelete='cascade',
+                              help='User who sent the contribution')
+    payload = fields.Text(string='Payload', required=True)
+    state = fields.Selection(PENDING_STATES, string='State', required=True,
+                             default='pending', index=True)
+    error = fields.Text(string='Error')
+    received_at = fields.Datetime(string='Received At', required=True)
+    lease_until = fields.Datetime(string='Lease Expiry',
+                                  help='The contribution is being synced '
+                                       'until this date')
+
+    @api.model
+    def _park(self, contact_civicrm_id, input_params):
+        """ Parks a contribution until its contact is synced. The
+         contribution replaces the one parked with the same CiviCRM id,
+         pending or failed.
+         :param contact_civicrm_id: int missing CiviCRM contact id
+         :param input_params: dictionary input parameters of the sync, as
+                              received
+         :return: void
+        """
+        self._forget(input_params.get('x_civicrm_id'), states=None)
+        self.env.cr.execute("""
+            INSERT INTO civicrm_sync_pending
+                (contact_civicrm_id, contribution_civicrm_id, user_id,
+                 payload, state, received_at)
+            VALUES (%s, %s, %s, %s, 'pending', now() AT TIME ZONE 'UTC')
+        """, (contact_civicrm_id, input_params.get('x_civicrm_id'),
+              self.env.uid, json.dumps(input_params, default=str)))
+        _logger.info('contribution parked', contact=contact_civicrm_id)
+
+    @api.model
+    def _forget(self, contribution_civicrm_id, states=('failed',)):
+        """ Deletes the contributions parked with a CiviCRM id, once the
+         contribution is received again
+         :param contribution_civicrm_id: int CiviCRM contribution id
+         :param states: tuple of states of the deleted contributions, all
+                        states if None
+         :return: void
+        """
+        if not contribution_civicrm_id:
+            return
+        query = """
+            DELETE FROM civicrm_sync_pending
+            WHERE contribution_civicrm_id = %s
+        """
+        params = [contribution_civicrm_id]
+        if states is not None:
+            query += " AND state IN %s"
+            params.append(tuple(states))
+        self.env.cr.execute(query, params)
+
+    @api.model
+    def _enqueue(self, contact_civicrm_id):
+        """ Resolves the contributions parked for a new contact once the
+         current transaction is committed
+         :param contact_civicrm_id: int CiviCRM contact id
+         :return: void
+        """
+        self.env.cr.execute("""
+            SELECT 1 FROM civicrm_sync_pending
+            WHERE contact_civicrm_id = %s AND state = 'pending'
+            LIMIT 1
+        """, (contact_civicrm_id,))
+        if not self.env.cr.fetchone():
+            return
+        dbname = self.env.cr.dbname
+        self.env.cr.after('commit', lambda: resolver.enqueue(
+            dbname, [contact_civicrm_id]))
+
+    @api.model
+    def _resolve(self, contact_civicrm_ids=None):
+        """ Syncs the parked contributions whose contact now exists, in the
+         order they were received. Each contribution is synced in its own
+         transaction with the user who sent it.
+         :param contact_civicrm_ids: list of CiviCRM contact ids, all the
+                                     existing contacts if None
+         :return: dict {'processed': int, 'errors': int}
+        """
+        processed = errors = 0
+        after_id = 0
+        while True:
+            batch = self._claim_resolvable(contact_civicrm_ids, after_id)
+            if not batch:
+                break
+            batch_processed, batch_errors = self._sync_parked(batch)
+            processed += batch_processed
+            errors += batch_errors
+            after_id = batch[-1][0]
+        if processed:
+            _logger.info('pending contributions resolved',
+                         processed=processed, errors=errors)
+        return {'processed': processed, 'errors': errors}
+
+    @api.model
+    def _claim_resolvable(self, contact_civicrm_ids, after_id):
+        """ Leases a batch of parked contributions whose contact exists.
+         The lease is committed with its own cursor, so concurrent
+         resolutions skip the contributions at once. Leases of a resolution
+         which died expire and are claimed again.
+         :param contact_civicrm_ids: list of CiviCRM contact ids or None
+         :param after_id: int, only contributions parked after this one
+         :return: list of (id, user_id, payload) sorted by id
+        """
+        params = {
+            'after_id': after_id,
+            'limit': RESOLVE_BATCH_SIZE,
+            'lease': '{} minutes'.format(LEASE_MINUTES),
+        }
+        contact_filter = ''
+        if contact_civicrm_ids is not None:
+            contact_filter = 'AND p.contact_civicrm_id IN %(contact_ids)s'
+            params['contact_ids'] = tuple(contact_civicrm_ids) or (None,)
+        with self.pool.cursor() as cr:
+            cr.execute(CLAIM_QUERY.format(contact_filter=contact_filter),
+                       params)
+            return sorted(cr.fetchall())
+
+    @api.model
+    def _sync_parked(self, batch):
+        """ Syncs leased parked contributions through the batch sync path
+         and deletes them, or keeps the failed ones with their error. A
+         contribution rejected by the admission control stays pending.
+         The results are stored with their own cursor, releasing the leases.
+         :param batch: list of (id, user_id, payload)
+         :return: tuple (number processed, number of errors)
+        """
+        dbname = self.env.cr.dbname
+        context = {'civicrm_sync_replay': True}
+        done_ids, failed = [], []
+        try:
+            # Consecutive contributions of one user are synced together
+            for user_id, run in itertools.groupby(
+                    batch, key=lambda item: item[1]):
+                run = list(run)
+                results = iter_batch_results(
+                    dbname, user_id, 'contribution',
+                    (json.loads(payload) for _, _, payload in run),
+                    context=context)
+                for (pending_id, _, _), result in zip(run, results):
+                    if result.get('retry_after'):
+                        continue
+                    if result.get('is_error'):
+                        failed.append((pending_id, '\n'.join(
+                            result.get('error_log') or [])))
+                    else:
+                        done_ids.append(pending_id)
+        finally:
+            with self.pool.cursor() as cr:
+                if done_ids:
+                    cr.execute("""
+                        DELETE FROM civicrm_sync_pending WHERE id IN %s
+                    """, (tuple(done_ids),))
+                for pending_id, error in failed:
+                    cr.execute("""
+                        UPDATE civicrm_sync_pending
+                        SET state = 'failed', error = %s
+                        WHERE id = %s
+                    """, (error, pending_id))
+                cr.execute("""
+                    UPDATE civicrm_sync_pending SET lease_until = NULL
+                    WHERE id IN %s
+                """, (tuple(pending_id for pending_id, _, _ in batch),))
+        return len(done_ids) + len(failed), len(failed)
+
+    @api.model
+    def cron_resolve(self):
+        """ Resolves the parked contributions whose contact exists and drops
+         the ones older than the retention period
+        """
+        self._resolve()
+        days = int(self.env['ir.config_parameter'].sudo().get_param(
+            TTL_PARAM, DEFAULT_TTL_DAYS))
+        cutoff = (datetime.utcnow() - timedelta(days=days)).strftime(
+            DATETIME_FORMAT)
+        self.env.cr.execute("""
+            DELETE FROM civicrm_sync_pending
+            WHERE received_at < %s
+            RETURNING contact_civicrm_id, contribution_civicrm_id
+        """, (cutoff,))
+        for contact_civicrm_id, contribution_civicrm_id in \
+                self.env.cr.fetchall():
+            _logger.warning('parked contribution dropped',
+                            contact=contact_civicrm_id,
+                            civicrm_id=contribution_civicrm_id)
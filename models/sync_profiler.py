@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import cProfile
+import functools
+import io
+import pstats
+import random
+import re
+import time
+import zlib
+from collections import defaultdict
+
+from odoo import api, fields, models, SUPERUSER_ID
+
+from . import sync_log
+
+_logger = sync_log.getLogger(__name__)
+
+# Share of the calls which are profiled, 0 disables the profiler
+SAMPLE_RATE_PARAM = 'odoo_civicrm_sync.profile_sample_rate'
+# Minimal duration in seconds of a profiled call for its profile to be kept
+THRESHOLD_PARAM = 'odoo_civicrm_sync.profile_threshold'
+DEFAULT_THRESHOLD = 10.0
+# Number of kept profiles
+RETENTION_PARAM = 'odoo_civicrm_sync.profile_retention'
+DEFAULT_RETENTION = 100
+
+# Number of functions and of SQL queries listed in a profile report
+REPORT_FUNCTIONS = 40
+REPORT_QUERIES = 20
+
+
+class SqlTrace(object):
+    """ Records the time spent in each query of a cursor, grouped by query
+     text with the parameters left out
+    """
+
+    def __init__(self, cr):
+        self._cr = cr
+        self._execute = cr.execute
+        self.timings = defaultdict(lambda: [0, 0.0])
+
+    def __enter__(self):
+        def execute(query, params=None, *args, **kwargs):
+            start = time.time()
+            try:
+                return self._execute(query, params, *args, **kwargs)
+            finally:
+                timing = self.timings[re.sub(r'\s+', ' ', str(query))[:500]]
+                timing[0] += 1
+                timing[1] += time.time() - start
+        self._cr.execute = execute
+        return self
+
+    def __exit__(self, *exc_info):
+        del self._cr.execute
+
+    def report(self):
+        lines = ['{:>6} {:>9}  {}'.format('calls', 'seconds', 'query')]
+        timings = sorted(self.timings.items(), key=lambda item: -item[1][1])
+        for query, (count, duration) in timings[:REPORT_QUERIES]:
+            lines.append('{:>6} {:>9.3f}  {}'.format(count, duration, query))
+        return '\n'.join(lines)
+
+
+def profiled(entry_point):
+    """ Decorator profiling a sample of the calls of a sync entry point and
+     keeping the profile of the calls slower than the threshold
+     :param entry_point: str, name of the entry point
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profile_model = self.env['civicrm.sync.profile']
+            sample_rate, threshold = profile_model._get_settings()
+            if not sample_rate or random.random() >= sample_rate:
+                return method(self, *args, **kwargs)
+
+            payload = args[0] if args and isinstance(args[0], dict) else {}
+            profiler = cProfile.Profile()
+            queries_before = self.env.cr.sql_log_count
+            start = time.time()
+            with SqlTrace(self.env.cr) as sql_trace:
+                profiler.enable()
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    profiler.disable()
+                    duration = time.time() - start
+                    if duration >= threshold:
+                        profile_model._store(
+                            entry_point, payload.get('x_civicrm_id'),
+                            duration,
+                            self.env.cr.sql_log_count - queries_before,
+                            profiler, sql_trace)
+        return wrapper
+    return decorator
+
+
+class CivicrmSyncProfile(models.Model):
+    _name = 'civicrm.sync.profile'
+    _description = 'CiviCRM Sync Slow Call Profile'
+    _order = 'id desc'
+
+    entry_point = fields.Char(string='Entry Point', required=True)
+    payload_id = fields.Char(string='CiviCRM Id', index=True)
+    duration = fields.Float(string='Duration (s)')
+    query_count = fields.Integer(string='Queries')
+    profile = fields.Binary(string='Profile', attachment=False,
+                            help='zlib compressed profile report')
+
+    @api.model
+    def _get_settings(self):
+        """ Gets profiler settings
+         :return: tuple (sample rate, threshold in seconds)
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return (float(get_param(SAMPLE_RATE_PARAM, 0)),
+                float(get_param(THRESHOLD_PARAM, DEFAULT_THRESHOLD)))
+
+    @api.model
+    def _store(self, entry_point, payload_id, duration, query_count,
+               profiler, sql_trace):
+        """ Stores compressed profile with its own cursor, so it is kept
+         even if the profiled call is rolled back, and prunes old profiles
+        """
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(REPORT_FUNCTIONS)
+        report = '{}\n\n{}'.format(sql_trace.report(), stream.getvalue())
+        try:
+            with api.Environment.manage(), self.pool.cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                profiles = env['civicrm.sync.profile']
+                profiles.create({
+                    'entry_point': entry_point,
+                    'payload_id': payload_id and str(payload_id),
+                    'duration': duration,
+                    'query_count': query_count,
+                    'profile': base64.b64encode(
+                        zlib.compress(report.encode('utf-8'))),
+                })
+                profiles._prune()
+        except Exception as error:
+            _logger.warning('slow call profile not stored',
+                            entry_point=entry_point, error=error)
+
+    @api.model
+    def _prune(self):
+        """ Deletes the profiles beyond the retention count """
+        retention = int(self.env['ir.config_parameter'].sudo().get_param(
+            RETENTION_PARAM, DEFAULT_RETENTION))
+        self.env.cr.execute("""
+            DELETE FROM civicrm_sync_profile
+            WHERE id < (SELECT min(id) FROM (
+                SELECT id FROM civicrm_sync_profile
+                ORDER BY id DESC LIMIT %s) AS kept)
+        """, (retention,))
+
+    @api.multi
+    def get_report(self):
+        """ Decompresses profile report
+         :return: str
+        """
+        self.ensure_one()
+        if not self.profile:
+            return ''
+        return zlib.decompress(base64.b64decode(self.profile)).decode('utf-8')
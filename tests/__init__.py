@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+
+from . import test_payment_payloads
+from . import test_sync_idempotency
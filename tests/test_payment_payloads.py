@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests.common import TransactionCase
+
+
+class TestPaymentPayloads(TransactionCase):
+    """ Checks that the sync data of payments is fetched with a number of
+     queries which doesn't depend on the number of payments
+    """
+
+    def setUp(self):
+        super(TestPaymentPayloads, self).setUp()
+        self.journal = self.env['account.journal'].search(
+            [('type', '=', 'bank')], limit=1)
+        if not self.journal:
+            self.skipTest('No bank journal')
+        self.partner = self.env['res.partner'].create({
+            'name': 'CiviCRM Donor',
+            'email': 'donor@example.com',
+        })
+        self.payment_method = self.env.ref(
+            'account.account_payment_method_manual_in')
+        self.civicrm_id = 900000
+
+    def _create_payments(self, count):
+        """ Creates payments of CiviCRM invoices
+         :param count: int number of payments
+         :return: account.payment models
+        """
+        payments = self.env['account.payment']
+        for _ in range(count):
+            self.civicrm_id += 1
+            invoice = self.env['account.invoice'].create({
+                'partner_id': self.partner.id,
+                'account_id':
+                    self.partner.property_account_receivable_id.id,
+                'x_civicrm_id': self.civicrm_id,
+            })
+            payments |= payments.create({
+                'payment_type': 'inbound',
+                'partner_type': 'customer',
+                'partner_id': self.partner.id,
+                'amount': 10.0,
+                'journal_id': self.journal.id,
+                'payment_method_id': self.payment_method.id,
+                'invoice_ids': [(6, 0, invoice.ids)],
+            })
+        return payments
+
+    def _count_fetch_queries(self, payments):
+        """ Counts the queries of fetching the payloads of payments
+         :param payments: account.payment models
+         :return: tuple (int number of queries, dict of payloads)
+        """
+        self.env.invalidate_all()
+        payment_sync = self.env['payment.sync']
+        start = self.env.cr.sql_log_count
+        payloads = payment_sync._fetch_payloads(payments)
+        return self.env.cr.sql_log_count - start, payloads
+
+    def test_fetch_payloads_query_count(self):
+        single_count, single_payloads = self._count_fetch_queries(
+            self._create_payments(1))
+        payments = self._create_payments(20)
+        chunk_count, chunk_payloads = self._count_fetch_queries(payments)
+        self.assertEqual(len(single_payloads), 1)
+        self.assertEqual(sorted(chunk_payloads), sorted(payments.ids))
+        self.assertEqual(single_count, chunk_count)
+        for payment in payments:
+            payload = chunk_payloads[payment.id]
+            self.assertEqual(payload.invoice_id, payment.invoice_ids.id)
+            self.assertEqual(payload.journal_name, self.journal.name)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests.common import TransactionCase
+
+
+class TestSyncIdempotency(TransactionCase):
+    """ Checks which sync responses are replayed to retried calls """
+
+    def setUp(self):
+        super(TestSyncIdempotency, self).setUp()
+        self.idempotency = self.env['civicrm.sync.idempotency']
+
+    def _complete(self, key, response):
+        """ Claims the key and completes it with the response
+         :param key: str idempotency key
+         :param response: dictionary response of the call
+         :return: stored response of the key claimed again or None
+        """
+        self.assertIsNone(self.idempotency._claim('contribution', key))
+        self.idempotency._complete(key, response)
+        return self.idempotency._claim('contribution', key)
+
+    def test_successful_response_replayed(self):
+        response = {'is_error': 0, 'invoice_id': 1}
+        self.assertEqual(self._complete('a' * 40, response), response)
+
+    def test_failed_response_released(self):
+        self.assertIsNone(self._complete('b' * 40, {
+            'is_error': 1, 'error_log': ['failed']}))
+
+    def test_deferred_response_released(self):
+        self.assertIsNone(self._complete('c' * 40, {
+            'is_error': 0, 'deferred': 1, 'contact_civicrm_id': 12}))
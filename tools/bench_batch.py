@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Throughput of the JSON batch endpoint compared to XML-RPC.
+
+Syncs --items new contacts one XML-RPC ``civicrm_sync`` call at a time,
+then as many other contacts through ``/civicrm_sync/contact/batch`` in
+batches of --batch-size, and reports items per second for both paths:
+
+    python3 tools/bench_batch.py --url http://localhost:8069 --db loadtest \\
+        --user admin --password admin --items 1000 --batch-size 100 --gzip
+
+The batch endpoint uses the database selected by the Odoo server (single
+database or --db-filter), which must be --db. Never run it against a
+production database: it creates partners.
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import time
+import urllib.request
+
+from load_test import OdooClient, make_contact, percentile
+
+
+def bench_xmlrpc(options, contacts):
+    odoo = OdooClient(options)
+    latencies, errors = [], 0
+    start = time.time()
+    for contact in contacts:
+        call_start = time.time()
+        response = odoo.execute('res.partner', 'civicrm_sync', contact)
+        latencies.append(time.time() - call_start)
+        errors += bool(response.get('is_error'))
+    return time.time() - start, latencies, errors
+
+
+def post_batch(options, contacts):
+    body = json.dumps(contacts, separators=(',', ':')).encode('utf-8')
+    credentials = base64.b64encode('{}:{}'.format(
+        options.user, options.password).encode('utf-8')).decode('ascii')
+    headers = {
+        'Content-Type': 'application/octet-stream',
+        'Authorization': 'Basic {}'.format(credentials),
+    }
+    if options.gzip:
+        body = gzip.compress(body)
+        headers.update({'Content-Encoding': 'gzip',
+                        'Accept-Encoding': 'gzip'})
+    request = urllib.request.Request(
+        '{}/civicrm_sync/contact/batch'.format(options.url),
+        data=body, headers=headers, method='POST')
+    with urllib.request.urlopen(request) as response:
+        data = response.read()
+        if response.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def bench_batch(options, contacts):
+    latencies, errors = [], 0
+    start = time.time()
+    for index in range(0, len(contacts), options.batch_size):
+        batch = contacts[index:index + options.batch_size]
+        call_start = time.time()
+        results = post_batch(options, batch)
+        latencies.append(time.time() - call_start)
+        errors += sum(1 for result in results if result.get('is_error'))
+    return time.time() - start, latencies, errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8069')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--items', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--gzip', action='store_true',
+                        help='gzip compress the batch requests')
+    parser.add_argument('--id-offset', type=int, default=0,
+                        help='first CiviCRM id, derived from the time if 0')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    base = options.id_offset or int(time.time()) % 10 ** 6 * 1000
+    xmlrpc_contacts = [make_contact(base + index)
+                       for index in range(options.items)]
+    batch_contacts = [make_contact(base + options.items + index)
+                      for index in range(options.items)]
+
+    for name, bench, contacts in (('xml-rpc', bench_xmlrpc, xmlrpc_contacts),
+                                  ('batch', bench_batch, batch_contacts)):
+        elapsed, latencies, errors = bench(options, contacts)
+        print('{:<8} {:>6} items {:>8.1f} items/s  {:>5} calls  '
+              'p50 {:.3f}s  max {:.3f}s  errors {}'.format(
+                  name, len(contacts), len(contacts) / elapsed,
+                  len(latencies), percentile(latencies, 0.5),
+                  max(latencies), errors))
+
+
+if __name__ == '__main__':
+    main()
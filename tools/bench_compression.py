@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of compressed transport for CiviCRM sync exchanges.
+
+Reports bytes on wire and end-to-end time with and without gzip for:
+
+- outbound payment pushes: batches of payment transactions posted one by
+  one over a keep-alive connection to the CiviCRM emulator (see
+  civicrm_emulator.py), whose --bandwidth emulates the link;
+- inbound contributions: XML-RPC requests with a growing number of line
+  items. With --db they are sent to the compressed XML-RPC endpoint of a
+  local Odoo through the read-only account.invoice.civicrm_sync_plan
+  method, otherwise only sizes and the transfer time at --bandwidth are
+  reported.
+
+    python3 tools/bench_compression.py --bandwidth 1000000 --latency 0.02 \\
+        --payments 1,10,100 --line-items 1,50,500
+"""
+
+import argparse
+import gzip
+import http.client
+import time
+import xml.etree.ElementTree as ElementTree
+import xmlrpc.client
+
+import civicrm_emulator
+
+
+def payment_xml(index):
+    """ Builds a payment transaction like PaymentSync._create_xml_with_data
+    """
+    data = [
+        {'to_financial_account_name': 'Bank'},
+        {'total_amount': 120.0 + index},
+        {'trxn_date': int(time.time())},
+        {'currency': 'GBP'},
+        {'invoice_id': 100000 + index},
+        {'credit_account_code': 101200},
+        {'contribution_status': 'Completed'},
+    ]
+    request_xml = ElementTree.Element('AATAvailReq')
+    params = ElementTree.SubElement(request_xml, 'params')
+    param = ElementTree.SubElement(params, 'param')
+    value = ElementTree.SubElement(param, 'value')
+    struct = ElementTree.SubElement(value, 'struct')
+    for item in data:
+        for key, val in item.items():
+            financial_trxn = ElementTree.SubElement(struct, 'financial_trxn')
+            ElementTree.SubElement(financial_trxn, 'name').text = str(key)
+            ElementTree.SubElement(financial_trxn, 'value').text = str(val)
+    return ElementTree.tostring(request_xml, 'utf8', 'xml')
+
+
+def contribution(line_items):
+    now = int(time.time())
+    return {
+        'x_civicrm_id': 900000 + line_items,
+        'contact_civicrm_id': 1,
+        'name': 'Benchmark contribution',
+        'account_code': 121000,
+        'currency_code': 'GBP',
+        'date_invoice': now,
+        'line_items': [{
+            'x_civicrm_id': 9000000 + index,
+            'product_code': 'CVMEM',
+            'name': 'Membership line {}'.format(index),
+            'quantity': 1.0,
+            'price_unit': 25.0,
+            'account_code': 400000,
+        } for index in range(line_items)],
+        'payments': [{
+            'x_civicrm_id': 9100000 + line_items,
+            'journal_name': 'Bank',
+            'status': 'Completed',
+            'amount': 25.0 * line_items,
+            'payment_date': now,
+            'currency_code': 'GBP',
+        }],
+    }
+
+
+def push_payments(options, count, compressed, stats):
+    """ Posts count payment transactions over one connection
+     :return: (seconds, bytes sent, bytes received)
+    """
+    stats.bytes_in = stats.bytes_out = 0
+    connection = http.client.HTTPConnection('127.0.0.1', options.port)
+    path = '/?entity=OdooSync&action=transaction&key=bench&api_key=bench'
+    start = time.time()
+    for index in range(count):
+        body = payment_xml(index)
+        headers = {'Content-Type': 'application/xml'}
+        if compressed:
+            body = gzip.compress(body)
+            headers.update({'Content-Encoding': 'gzip',
+                            'Accept-Encoding': 'gzip'})
+        connection.request('POST', path, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+        if response.getheader('Content-Encoding') == 'gzip':
+            gzip.decompress(data)
+    elapsed = time.time() - start
+    connection.close()
+    return elapsed, stats.bytes_in, stats.bytes_out
+
+
+def bench_outbound(options):
+    emulator_options = civicrm_emulator.parse_args([
+        '--port', str(options.port), '--latency', str(options.latency),
+        '--bandwidth', str(options.bandwidth)])
+    server, stats = civicrm_emulator.serve(emulator_options)
+    print('Outbound payment pushes')
+    print('{:>9} {:>12} {:>12} {:>9} {:>9} {:>9}'.format(
+        'payments', 'plain bytes', 'gzip bytes', 'ratio', 'plain s',
+        'gzip s'))
+    try:
+        for count in options.payments:
+            plain = push_payments(options, count, False, stats)
+            compressed = push_payments(options, count, True, stats)
+            plain_bytes = plain[1] + plain[2]
+            gzip_bytes = compressed[1] + compressed[2]
+            print('{:>9} {:>12} {:>12} {:>9.2f} {:>9.3f} {:>9.3f}'.format(
+                count, plain_bytes, gzip_bytes, gzip_bytes / plain_bytes,
+                plain[0], compressed[0]))
+    finally:
+        server.shutdown()
+
+
+class CountingTransport(xmlrpc.client.Transport):
+    """ Transport gzip compressing requests and recording the request size
+    """
+
+    def __init__(self, compressed):
+        xmlrpc.client.Transport.__init__(self)
+        self.accept_gzip_encoding = compressed
+        self.encode_threshold = 0 if compressed else None
+        self.bytes_out = 0
+
+    def send_content(self, connection, request_body):
+        self.bytes_out += len(request_body)
+        xmlrpc.client.Transport.send_content(self, connection, request_body)
+
+
+def call_plan(options, params, compressed):
+    """ Calls civicrm_sync_plan through the compressed XML-RPC endpoint
+     :return: (seconds, bytes sent)
+    """
+    transport = CountingTransport(compressed)
+    proxy = xmlrpc.client.ServerProxy(
+        '{}/civicrm_sync/xmlrpc/2/object'.format(options.url),
+        transport=transport, allow_none=True)
+    start = time.time()
+    proxy.execute_kw(options.db, options.uid, options.password,
+                     'account.invoice', 'civicrm_sync_plan', [params], {})
+    return time.time() - start, transport.bytes_out
+
+
+def bench_inbound(options):
+    if options.db:
+        common = xmlrpc.client.ServerProxy(
+            '{}/xmlrpc/2/common'.format(options.url))
+        options.uid = common.authenticate(options.db, options.user,
+                                          options.password, {})
+        if not options.uid:
+            raise SystemExit('Authentication failed')
+    print('Inbound contributions')
+    print('{:>9} {:>12} {:>12} {:>9} {:>9} {:>9} {:>9}'.format(
+        'lines', 'plain bytes', 'gzip bytes', 'ratio', 'gzip ms',
+        'plain s', 'gzip s'))
+    for line_items in options.line_items:
+        params = contribution(line_items)
+        body = xmlrpc.client.dumps(
+            (options.db or 'db', 1, 'password', 'account.invoice',
+             'civicrm_sync', [params], {}), 'execute_kw').encode('utf-8')
+        start = time.time()
+        compressed_body = gzip.compress(body)
+        compress_ms = (time.time() - start) * 1000
+        if options.db:
+            plain_time = call_plan(options, params, False)[0]
+            gzip_time = call_plan(options, params, True)[0]
+        elif options.bandwidth:
+            plain_time = len(body) / options.bandwidth
+            gzip_time = len(compressed_body) / options.bandwidth + \
+                compress_ms / 1000
+        else:
+            plain_time = gzip_time = float('nan')
+        print('{:>9} {:>12} {:>12} {:>9.2f} {:>9.2f} {:>9.3f} {:>9.3f}'
+              .format(line_items, len(body), len(compressed_body),
+                      len(compressed_body) / len(body), compress_ms,
+                      plain_time, gzip_time))
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--payments', type=int_list, default=[1, 10, 100],
+                        help='comma separated outbound batch sizes')
+    parser.add_argument('--line-items', type=int_list,
+                        default=[1, 50, 500],
+                        help='comma separated inbound line item counts')
+    parser.add_argument('--port', type=int, default=8898,
+                        help='port of the CiviCRM emulator started by the '
+                             'benchmark')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='emulator mean response latency in seconds')
+    parser.add_argument('--bandwidth', type=float, default=1000000.0,
+                        help='emulated link bandwidth in bytes per second')
+    parser.add_argument('--url', default='http://localhost:8069')
+    parser.add_argument('--db', help='Odoo database for the inbound '
+                                     'end-to-end benchmark')
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='admin')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    bench_outbound(options)
+    print()
+    bench_inbound(options)
+
+
+if __name__ == '__main__':
+    main()
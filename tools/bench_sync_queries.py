@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Queries per synced contact and contribution, with and without the
+lightweight sync mode.
+
+Syncs --contacts new contacts and --contributions new contributions with
+the company "Lightweight Sync" setting off, then as many with it on, and
+reports the mean and maximal number of SQL queries of each call. Queries
+are counted by the sync profiler, which is enabled for every call during
+the run and restored afterwards:
+
+    python3 tools/bench_sync_queries.py --url http://localhost:8069 \\
+        --db loadtest --user admin --password admin --contacts 200 \\
+        --contributions 200
+
+Never run it against a production database: it creates partners, invoices
+and payments and changes the company setting while it runs.
+"""
+
+import argparse
+import time
+
+from load_test import OdooClient, make_contact, make_contribution
+
+PROFILER_PARAMS = ('odoo_civicrm_sync.profile_sample_rate',
+                   'odoo_civicrm_sync.profile_threshold',
+                   'odoo_civicrm_sync.profile_retention')
+
+
+def get_params(odoo):
+    return {key: odoo.execute('ir.config_parameter', 'get_param', key)
+            for key in PROFILER_PARAMS}
+
+
+def set_params(odoo, params):
+    for key, value in params.items():
+        odoo.execute('ir.config_parameter', 'set_param', key, value or False)
+
+
+def get_last_profile_id(odoo):
+    profiles = odoo.execute('civicrm.sync.profile', 'search_read', [],
+                            fields=['id'], order='id desc', limit=1)
+    return profiles[0]['id'] if profiles else 0
+
+
+def get_query_counts(odoo, after_id):
+    counts = {}
+    for profile in odoo.execute(
+            'civicrm.sync.profile', 'search_read', [('id', '>', after_id)],
+            fields=['entry_point', 'query_count']):
+        counts.setdefault(profile['entry_point'], []).append(
+            profile['query_count'])
+    return counts
+
+
+def run(odoo, options, base, lightweight):
+    odoo.execute('res.company', 'write', [options.company_id],
+                 {'civicrm_lightweight_sync': lightweight})
+    after_id = get_last_profile_id(odoo)
+    contact_ids = [base + index for index in range(options.contacts)]
+    for civicrm_id in contact_ids:
+        odoo.execute('res.partner', 'civicrm_sync', make_contact(civicrm_id))
+    for index in range(options.contributions):
+        civicrm_id = base + index
+        odoo.execute('account.invoice', 'civicrm_sync', make_contribution(
+            options, civicrm_id, contact_ids[index % len(contact_ids)],
+            [civicrm_id * 10 + payment for payment in
+             range(options.payments_per_contribution)]))
+    return get_query_counts(odoo, after_id)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8069')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--contacts', type=int, default=100)
+    parser.add_argument('--contributions', type=int, default=100)
+    parser.add_argument('--lines-per-contribution', type=int, default=3)
+    parser.add_argument('--payments-per-contribution', type=int, default=1)
+    parser.add_argument('--id-offset', type=int, default=0,
+                        help='first CiviCRM id, derived from the time if 0')
+    parser.add_argument('--receivable-account-code', type=int,
+                        default=121000)
+    parser.add_argument('--income-account-code', type=int, default=400000)
+    parser.add_argument('--payment-journal', default='Bank')
+    parser.add_argument('--currency', default='GBP')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    options.contacts = max(options.contacts, 1)
+    odoo = OdooClient(options)
+    options.company_id = odoo.execute(
+        'res.users', 'read', [odoo.uid], ['company_id'])[0]['company_id'][0]
+    lightweight_before = odoo.execute(
+        'res.company', 'read', [options.company_id],
+        ['civicrm_lightweight_sync'])[0]['civicrm_lightweight_sync']
+    params_before = get_params(odoo)
+    set_params(odoo, {
+        'odoo_civicrm_sync.profile_sample_rate': '1',
+        'odoo_civicrm_sync.profile_threshold': '0',
+        'odoo_civicrm_sync.profile_retention': str(
+            2 * (options.contacts + options.contributions) + 100),
+    })
+    base = options.id_offset or int(time.time()) % 10 ** 6 * 1000
+    try:
+        for index, lightweight in enumerate((False, True)):
+            counts = run(odoo, options, base + index * max(
+                options.contacts, options.contributions), lightweight)
+            for entry_point in ('contact', 'contribution'):
+                values = counts.get(entry_point) or [0]
+                print('lightweight {:<4} {:<13} {:>5} calls  mean {:>7.1f} '
+                      'queries  max {:>5}'.format(
+                          'on' if lightweight else 'off', entry_point,
+                          len(counts.get(entry_point) or []),
+                          sum(values) / len(values), max(values)))
+    finally:
+        set_params(odoo, params_before)
+        odoo.execute('res.company', 'write', [options.company_id],
+                     {'civicrm_lightweight_sync': lightweight_before})
+
+
+if __name__ == '__main__':
+    main()
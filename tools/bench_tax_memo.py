@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Contribution sync throughput with and without the tax memo.
+
+Syncs --invoices identical membership contributions (same product, price,
+quantity and tax) with the tax memo disabled, then as many with it
+enabled, and reports invoices per second for both runs:
+
+    python3 tools/bench_tax_memo.py --url http://localhost:8069 --db loadtest \\
+        --user admin --password admin --invoices 10000 --tax-name 'VAT 20%'
+
+Never run it against a production database: it creates a partner and
+invoices.
+"""
+
+import argparse
+import time
+
+from load_test import OdooClient, make_contact, percentile
+
+
+def make_membership(options, civicrm_id, contact_id):
+    return {
+        'x_civicrm_id': civicrm_id,
+        'contact_civicrm_id': contact_id,
+        'name': 'Membership {}'.format(civicrm_id),
+        'account_code': options.receivable_account_code,
+        'currency_code': options.currency,
+        'date_invoice': int(time.time()),
+        'line_items': [{
+            'x_civicrm_id': civicrm_id * 100,
+            'product_code': 'CVMEM',
+            'name': 'Annual membership',
+            'quantity': 1.0,
+            'price_unit': options.price,
+            'account_code': options.income_account_code,
+            'tax_name': [options.tax_name],
+        }],
+        'payments': [],
+    }
+
+
+def bench(odoo, options, civicrm_ids, contact_id, memo):
+    context = {'civicrm_sync_tax_memo': memo}
+    latencies, errors = [], 0
+    start = time.time()
+    for civicrm_id in civicrm_ids:
+        call_start = time.time()
+        response = odoo.execute(
+            'account.invoice', 'civicrm_sync',
+            make_membership(options, civicrm_id, contact_id),
+            context=context)
+        latencies.append(time.time() - call_start)
+        errors += bool(response.get('is_error'))
+    return time.time() - start, latencies, errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8069')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--invoices', type=int, default=10000)
+    parser.add_argument('--tax-name', required=True,
+                        help='name of a percent or fixed sale tax')
+    parser.add_argument('--price', type=float, default=60.0)
+    parser.add_argument('--id-offset', type=int, default=0,
+                        help='first CiviCRM id, derived from the time if 0')
+    parser.add_argument('--receivable-account-code', type=int,
+                        default=121000)
+    parser.add_argument('--income-account-code', type=int, default=400000)
+    parser.add_argument('--currency', default='GBP')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    odoo = OdooClient(options)
+    base = options.id_offset or int(time.time()) % 10 ** 6 * 1000
+    odoo.execute('res.partner', 'civicrm_sync', make_contact(base))
+
+    for index, memo in enumerate((False, True)):
+        first = base + 1 + index * options.invoices
+        elapsed, latencies, errors = bench(
+            odoo, options, range(first, first + options.invoices), base, memo)
+        print('memo {:<5} {:>6} invoices {:>8.1f} invoices/s  '
+              'p50 {:.3f}s  p99 {:.3f}s  errors {}'.format(
+                  'on' if memo else 'off', options.invoices,
+                  options.invoices / elapsed, percentile(latencies, 0.5),
+                  percentile(latencies, 0.99), errors))
+
+
+if __name__ == '__main__':
+    main()
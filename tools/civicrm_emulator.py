@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Local emulator of the CiviCRM OdooSync REST endpoint.
+
+Answers ``entity=OdooSync&action=transaction`` requests like the CiviCRM
+companion extension does, with configurable latency and failures, so the
+payment sync can be exercised against a slow or flaky CiviCRM:
+
+    python3 tools/civicrm_emulator.py --port 8899 --latency 0.5 \\
+        --http-error-rate 0.05 --civicrm-error-rate 0.05 --malformed-rate 0.01
+
+Compressed request bodies (Content-Encoding gzip or deflate) are accepted
+and responses are gzip compressed when the client accepts it, unless
+--no-compression emulates an old extension version answering compressed
+requests with HTTP 415. --bandwidth delays requests and responses by their
+size on the wire to emulate a slow link.
+
+Point the company "CiviCRM URL" to http://localhost:8899/ and fill in any
+site and API key. Request counters are printed every --report-interval
+seconds and on exit.
+"""
+
+import argparse
+import gzip
+import itertools
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+SUCCESS_RESPONSE = (
+    '<?xml version="1.0"?>\n<ResultSet><Result>'
+    '<is_error>0</is_error><transaction_id>{}</transaction_id>'
+    '</Result></ResultSet>')
+
+ERROR_RESPONSE = (
+    '<?xml version="1.0"?>\n<ResultSet><Result>'
+    '<is_error>1</is_error><error_message>{}</error_message>'
+    '</Result></ResultSet>')
+
+MALFORMED_RESPONSE = '<?xml version="1.0"?>\n<ResultSet><Result><is_err'
+
+
+class EmulatorStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.outcomes = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def record(self, outcome):
+        with self._lock:
+            self.outcomes[outcome] += 1
+
+    def record_bytes(self, bytes_in=0, bytes_out=0):
+        with self._lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def report(self):
+        with self._lock:
+            total = sum(self.outcomes.values())
+            outcomes = ', '.join('{}={}'.format(key, value) for key, value
+                                 in sorted(self.outcomes.items()))
+            return '{} requests ({}), {} bytes in, {} bytes out'.format(
+                total, outcomes or 'none', self.bytes_in, self.bytes_out)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(options, stats):
+    transaction_ids = itertools.count(1)
+
+    class OdooSyncHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            if options.verbose:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        def do_POST(self):
+            query = parse_qs(urlparse(self.path).query)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length)
+            stats.record_bytes(bytes_in=length)
+            self._transfer(length)
+
+            encoding = (self.headers.get('Content-Encoding') or '').lower()
+            if encoding and encoding != 'identity':
+                if options.no_compression or \
+                        encoding not in ('gzip', 'deflate'):
+                    stats.record('unsupported_encoding')
+                    return self._reply(415, 'Unsupported Media Type')
+                try:
+                    body = gzip.decompress(body) if encoding == 'gzip' \
+                        else zlib.decompress(body)
+                except (OSError, zlib.error):
+                    stats.record('bad_request')
+                    return self._reply(400, 'Undecodable body')
+
+            if query.get('entity') != ['OdooSync'] or \
+                    query.get('action') != ['transaction']:
+                stats.record('bad_request')
+                return self._reply(400, 'Unknown entity or action')
+
+            latency = random.expovariate(1.0 / options.latency) \
+                if options.latency else 0
+            if options.timeout_rate and random.random() < options.timeout_rate:
+                latency = options.timeout_latency
+            time.sleep(latency)
+
+            draw = random.random()
+            if draw < options.http_error_rate:
+                stats.record('http_error')
+                return self._reply(500, 'Internal Server Error')
+            draw -= options.http_error_rate
+            if draw < options.malformed_rate:
+                stats.record('malformed')
+                return self._reply(200, MALFORMED_RESPONSE)
+            draw -= options.malformed_rate
+            if draw < options.civicrm_error_rate:
+                stats.record('civicrm_error')
+                return self._reply(200, ERROR_RESPONSE.format(
+                    'Emulated error for contribution {}'.format(
+                        random.randint(1, 10 ** 6))))
+            stats.record('success')
+            return self._reply(200, SUCCESS_RESPONSE.format(
+                next(transaction_ids)))
+
+        def _reply(self, status, text):
+            body = text.encode('utf-8')
+            compressed = not options.no_compression and 'gzip' in (
+                self.headers.get('Accept-Encoding') or '').lower()
+            if compressed:
+                body = gzip.compress(body)
+            self._transfer(len(body))
+            stats.record_bytes(bytes_out=len(body))
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/xml')
+            if compressed:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        @staticmethod
+        def _transfer(size):
+            if options.bandwidth:
+                time.sleep(size / options.bandwidth)
+
+    return OdooSyncHandler
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='mean response latency in seconds')
+    parser.add_argument('--timeout-rate', type=float, default=0.0,
+                        help='share of requests answered after '
+                             '--timeout-latency seconds')
+    parser.add_argument('--timeout-latency', type=float, default=60.0)
+    parser.add_argument('--http-error-rate', type=float, default=0.0,
+                        help='share of requests answered with HTTP 500')
+    parser.add_argument('--civicrm-error-rate', type=float, default=0.0,
+                        help='share of requests answered with is_error=1')
+    parser.add_argument('--malformed-rate', type=float, default=0.0,
+                        help='share of requests answered with broken XML')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='answer compressed requests with HTTP 415 and '
+                             'never compress responses')
+    parser.add_argument('--bandwidth', type=float, default=0.0,
+                        help='emulated link bandwidth in bytes per second, '
+                             '0 for no limit')
+    parser.add_argument('--report-interval', type=float, default=10.0)
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(args)
+
+
+def serve(options, stats=None):
+    """ Starts the emulator in a background thread
+     :return: (server, stats)
+    """
+    stats = stats or EmulatorStats()
+    server = ThreadingHTTPServer((options.host, options.port),
+                                 make_handler(options, stats))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, stats
+
+
+def main():
+    options = parse_args()
+    server, stats = serve(options)
+    print('CiviCRM emulator listening on http://{}:{}/'.format(
+        options.host, options.port))
+    try:
+        while True:
+            time.sleep(options.report_interval)
+            print(stats.report())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        print(stats.report())
+
+
+if __name__ == '__main__':
+    main()
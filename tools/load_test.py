@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""Concurrent load test of the CiviCRM inbound sync.
+
+Drives ``res.partner.civicrm_sync`` and ``account.invoice.civicrm_sync``
+from many concurrent XML-RPC clients against a local Odoo test database,
+while the payment sync scheduled action pushes payments to a local CiviCRM
+emulator (see civicrm_emulator.py) with configurable latency and failures:
+
+    python3 tools/load_test.py --url http://localhost:8069 --db loadtest \\
+        --user admin --password admin --clients 16 --contacts 200 \\
+        --contributions 1000 --resend-rate 0.1 --emulator-port 8899 \\
+        --emulator-latency 0.5 --emulator-http-error-rate 0.05
+
+Never run it against a production database: it creates partners,
+invoices and payments, and with --emulator-port it points the user's
+company CiviCRM URL to the emulator.
+
+Reports throughput, latency percentiles, serialization failures,
+deadlocks and contributions which ended up with more than one open
+invoice.
+"""
+
+import argparse
+import queue
+import random
+import threading
+import time
+import xmlrpc.client
+from collections import Counter, defaultdict
+
+import civicrm_emulator
+
+SERIALIZATION_FAILURE = 'could not serialize access'
+DEADLOCK = 'deadlock detected'
+
+
+def percentile(values, rate):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(rate * len(values)))]
+
+
+class Results(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(Counter)
+
+    def record(self, entity, latency, outcome):
+        with self._lock:
+            self.latencies[entity].append(latency)
+            self.outcomes[entity][outcome] += 1
+
+    def report(self, elapsed):
+        lines = []
+        for entity in sorted(self.latencies):
+            latencies = self.latencies[entity]
+            lines.append(
+                '{:<13} {:>6} calls {:>8.1f}/s  p50 {:.3f}s  p95 {:.3f}s  '
+                'p99 {:.3f}s  max {:.3f}s'.format(
+                    entity, len(latencies), len(latencies) / elapsed,
+                    percentile(latencies, 0.5), percentile(latencies, 0.95),
+                    percentile(latencies, 0.99), max(latencies)))
+            lines.append('{:<13} {}'.format('', ', '.join(
+                '{}={}'.format(key, value) for key, value
+                in sorted(self.outcomes[entity].items()))))
+        return '\n'.join(lines)
+
+
+class OdooClient(object):
+
+    def __init__(self, options):
+        self.options = options
+        common = xmlrpc.client.ServerProxy(
+            '{}/xmlrpc/2/common'.format(options.url), allow_none=True)
+        self.uid = common.authenticate(options.db, options.user,
+                                       options.password, {})
+        if not self.uid:
+            raise SystemExit('Authentication failed')
+        self.models = xmlrpc.client.ServerProxy(
+            '{}/xmlrpc/2/object'.format(options.url), allow_none=True)
+
+    def execute(self, model, method, *args, **kwargs):
+        return self.models.execute_kw(
+            self.options.db, self.uid, self.options.password, model, method,
+            list(args), kwargs)
+
+
+def classify(response=None, fault=None):
+    """ Classifies the outcome of a sync call """
+    text = fault.faultString if fault else ' '.join(
+        str(error) for error in response.get('error_log') or [])
+    if SERIALIZATION_FAILURE in text:
+        return 'serialization_failure'
+    if DEADLOCK in text:
+        return 'deadlock'
+    if fault:
+        return 'fault'
+    if response.get('retry_after'):
+        return 'retry_after'
+    return 'error' if response.get('is_error') else 'ok'
+
+
+def make_contact(civicrm_id):
+    return {
+        'x_civicrm_id': civicrm_id,
+        'is_company': False,
+        'name': 'Load Test {}'.format(civicrm_id),
+        'display_name': 'Load Test {}'.format(civicrm_id),
+        'email': 'load.test.{}@example.org'.format(civicrm_id),
+        'active': True,
+        'customer': True,
+        'write_date': int(time.time()),
+    }
+
+
+def make_contribution(options, civicrm_id, contact_id, payment_ids):
+    now = int(time.time())
+    amount = round(random.choice((10, 25, 50, 120)) *
+                   options.lines_per_contribution, 2)
+    return {
+        'x_civicrm_id': civicrm_id,
+        'contact_civicrm_id': contact_id,
+        'name': 'Load test contribution {}'.format(civicrm_id),
+        'account_code': options.receivable_account_code,
+        'currency_code': options.currency,
+        'date_invoice': now,
+        'line_items': [{
+            'x_civicrm_id': civicrm_id * 100 + index,
+            'product_code': 'CVMEM',
+            'name': 'Membership {}'.format(index),
+            'quantity': 1.0,
+            'price_unit': amount / options.lines_per_contribution,
+            'account_code': options.income_account_code,
+        } for index in range(options.lines_per_contribution)],
+        'payments': [{
+            'x_civicrm_id': payment_id or None,
+            'journal_name': options.payment_journal,
+            'status': 'Completed',
+            'amount': round(amount / len(payment_ids), 2),
+            'payment_date': now,
+            'currency_code': options.currency,
+        } for payment_id in payment_ids],
+    }
+
+
+def build_work(options):
+    """ Builds the contact and contribution calls. Resent contributions are
+     queued twice in a row, so two clients push them concurrently like a
+     CiviCRM retry on timeout.
+    """
+    base = options.id_offset or int(time.time()) % 10 ** 6 * 1000
+    contact_ids = [base + index for index in range(options.contacts)]
+    contacts = [('contact', make_contact(civicrm_id))
+                for civicrm_id in contact_ids]
+    contributions = []
+    payment_ids = iter(range(base * 10, base * 20))
+    for index in range(options.contributions):
+        civicrm_id = base + index
+        # Payments without CiviCRM id are marked as awaiting sync and
+        # pushed back to CiviCRM by the payment sync
+        outbound = random.random() < options.outbound_payment_rate
+        contribution = make_contribution(
+            options, civicrm_id, random.choice(contact_ids),
+            [0 if outbound else next(payment_ids) for _ in
+             range(options.payments_per_contribution)])
+        contributions.append(('contribution', contribution))
+        if not outbound and random.random() < options.resend_rate:
+            contributions.append(('contribution', contribution))
+    return contacts, contributions
+
+
+def run_clients(options, work, results):
+    calls = queue.Queue()
+    for item in work:
+        calls.put(item)
+
+    def client():
+        odoo = OdooClient(options)
+        model = {'contact': 'res.partner', 'contribution': 'account.invoice'}
+        while True:
+            try:
+                entity, params = calls.get_nowait()
+            except queue.Empty:
+                return
+            start = time.time()
+            try:
+                response = odoo.execute(model[entity], 'civicrm_sync',
+                                        dict(params))
+                outcome = classify(response=response)
+            except xmlrpc.client.Fault as fault:
+                outcome = classify(fault=fault)
+            results.record(entity, time.time() - start, outcome)
+
+    threads = [threading.Thread(target=client)
+               for _ in range(options.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def trigger_payment_sync(options, stop):
+    """ Runs the payment sync scheduled action until stop is set """
+    odoo = OdooClient(options)
+    cron_id = odoo.execute('ir.model.data', 'xmlid_to_res_id',
+                           'odoo_civicrm_sync.sync_payments_to_civi')
+    runs = Counter()
+    while not stop.wait(options.payment_sync_interval):
+        try:
+            odoo.execute('ir.cron', 'method_direct_trigger', [cron_id])
+            runs['ok'] += 1
+        except xmlrpc.client.Fault as fault:
+            runs[classify(fault=fault)] += 1
+    print('payment sync runs: {}'.format(', '.join(
+        '{}={}'.format(key, value) for key, value in sorted(runs.items()))))
+
+
+def count_duplicates(options, contributions):
+    """ Counts contributions with more than one invoice not refunded """
+    odoo = OdooClient(options)
+    civicrm_ids = sorted({params['x_civicrm_id'] for _, params
+                          in contributions})
+    balance = Counter()
+    for index in range(0, len(civicrm_ids), 500):
+        invoices = odoo.execute(
+            'account.invoice', 'search_read',
+            [('x_civicrm_id', 'in', civicrm_ids[index:index + 500])],
+            fields=['x_civicrm_id', 'type'])
+        for invoice in invoices:
+            balance[invoice['x_civicrm_id']] += \
+                -1 if 'refund' in invoice['type'] else 1
+    return sum(1 for count in balance.values() if count > 1)
+
+
+def configure_emulator(options):
+    emulator_options = civicrm_emulator.parse_args([
+        '--port', str(options.emulator_port),
+        '--latency', str(options.emulator_latency),
+        '--http-error-rate', str(options.emulator_http_error_rate),
+        '--civicrm-error-rate', str(options.emulator_civicrm_error_rate),
+        '--malformed-rate', str(options.emulator_malformed_rate),
+    ])
+    server, stats = civicrm_emulator.serve(emulator_options)
+    odoo = OdooClient(options)
+    user = odoo.execute('res.users', 'read', [odoo.uid], ['company_id'])[0]
+    odoo.execute('res.company', 'write', [user['company_id'][0]], {
+        'civicrm_instance_url': 'http://127.0.0.1:{}/'.format(
+            options.emulator_port),
+        'civicrm_site_key': 'load-test',
+        'civicrm_api_key': 'load-test',
+    })
+    return server, stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8069')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--contacts', type=int, default=100)
+    parser.add_argument('--contributions', type=int, default=500)
+    parser.add_argument('--lines-per-contribution', type=int, default=1)
+    parser.add_argument('--payments-per-contribution', type=int, default=1)
+    parser.add_argument('--resend-rate', type=float, default=0.0,
+                        help='share of contributions pushed twice '
+                             'concurrently')
+    parser.add_argument('--outbound-payment-rate', type=float, default=0.0,
+                        help='share of contributions whose payments have no '
+                             'CiviCRM id, so they are pushed to CiviCRM')
+    parser.add_argument('--id-offset', type=int, default=0,
+                        help='first CiviCRM id, derived from the time if 0')
+    parser.add_argument('--receivable-account-code', type=int,
+                        default=121000)
+    parser.add_argument('--income-account-code', type=int, default=400000)
+    parser.add_argument('--payment-journal', default='Bank')
+    parser.add_argument('--currency', default='GBP')
+    parser.add_argument('--payment-sync-interval', type=float, default=0,
+                        help='seconds between payment sync runs during the '
+                             'test, 0 to disable')
+    parser.add_argument('--emulator-port', type=int, default=0,
+                        help='start the CiviCRM emulator on this port and '
+                             'point the company CiviCRM URL to it')
+    parser.add_argument('--emulator-latency', type=float, default=0.1)
+    parser.add_argument('--emulator-http-error-rate', type=float, default=0.0)
+    parser.add_argument('--emulator-civicrm-error-rate', type=float,
+                        default=0.0)
+    parser.add_argument('--emulator-malformed-rate', type=float, default=0.0)
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    server = emulator_stats = None
+    if options.emulator_port:
+        server, emulator_stats = configure_emulator(options)
+
+    contacts, contributions = build_work(options)
+    results = Results()
+    stop = threading.Event()
+    payment_sync = None
+    if options.payment_sync_interval:
+        payment_sync = threading.Thread(target=trigger_payment_sync,
+                                        args=(options, stop))
+        payment_sync.start()
+
+    start = time.time()
+    run_clients(options, contacts, results)
+    run_clients(options, contributions, results)
+    elapsed = time.time() - start
+    stop.set()
+    if payment_sync:
+        payment_sync.join()
+
+    print('{} clients, {:.1f}s'.format(options.clients, elapsed))
+    print(results.report(elapsed))
+    print('contributions with duplicate invoices: {}'.format(
+        count_duplicates(options, contributions)))
+    if server:
+        server.shutdown()
+        print('CiviCRM emulator: {}'.format(emulator_stats.report()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Replays journaled inbound CiviCRM sync payloads.
+
+Syncs the journaled payloads again in the order they were received, through
+the batch sync path, for example to rebuild records after a restore:
+
+    python3 tools/replay_journal.py --url http://localhost:8069 --db odoo \\
+        --user admin --password admin --entity contribution \\
+        --date-from '2026-10-01 00:00:00' --civicrm-ids 12 13
+
+The user must be an accounting manager.
+"""
+
+import argparse
+import time
+
+from load_test import OdooClient
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8069')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--entity', choices=('contact', 'contribution'),
+                        help='entity to replay, all if not set')
+    parser.add_argument('--civicrm-ids', type=int, nargs='+',
+                        help='CiviCRM ids to replay, all if not set')
+    parser.add_argument('--date-from',
+                        help='first received time, UTC %%Y-%%m-%%d %%H:%%M:%%S')
+    parser.add_argument('--date-to',
+                        help='last received time, UTC %%Y-%%m-%%d %%H:%%M:%%S')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='payloads replayed by each call')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    odoo = OdooClient(options)
+    start = time.time()
+    processed = errors = 0
+    after = None
+    # Each call replays one page, so no call outlives the request limits
+    while True:
+        result = odoo.execute(
+            'civicrm.sync.journal', 'replay', entity=options.entity,
+            civicrm_ids=options.civicrm_ids, date_from=options.date_from,
+            date_to=options.date_to, after=after, limit=options.page_size)
+        processed += result['processed']
+        errors += result['errors']
+        after = result['after']
+        if not after:
+            break
+        print('{} payloads replayed, resuming after {}'.format(
+            processed, after))
+    elapsed = time.time() - start
+    print('{} payloads replayed in {:.1f}s ({:.1f}/s), {} errors'.format(
+        processed, elapsed, processed / elapsed if elapsed else 0, errors))
+
+
+if __name__ == '__main__':
+    main()